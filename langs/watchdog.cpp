@@ -1,23 +1,46 @@
+#include <dirent.h>
 #include <fcntl.h>
-#include <poll.h>
 #include <signal.h>
+#include <sys/epoll.h>
+#include <sys/stat.h>
 #include <sys/resource.h>
+#include <sys/syscall.h>
+#include <sys/timerfd.h>
 #include <sys/types.h>
 #include <sys/wait.h>
 #include <unistd.h>
-#include <atomic>
+#include <cerrno>
 #include <chrono>
+#include <cstdlib>
 #include <fstream>
 #include <iostream>
 #include <nlohmann/json.hpp>
 #include <sstream>
 #include <string>
-#include <thread>
 #include <vector>
 
 #define MAX_STDOUT_LENGTH 4096
 #define MAX_STDERR_LENGTH 4096
 
+// memory.currentを読む間隔[ms]
+#define MEMORY_SAMPLE_INTERVAL_MS 10
+// ユーザープログラムが終了した後、(バックグラウンドで動かし続けている子孫などが)出力のパイプを
+// 開いたままにしている場合に、EOFを待つ時間[ms]。過ぎたら子孫をkillして打ち切る
+#define DRAIN_GRACE_MS 100
+
+// cgroup v2のマウント先(cgroup名前空間の中では、コンテナ(exec)のcgroupがルートに見える)
+// (NativeBackendでは読み取り専用なので、ユーザープログラムからはリミットを書き換えられない)
+#define CGROUP_ROOT "/sys/fs/cgroup"
+// NativeBackendが、コンテナ(exec)のcgroupだけを書き込み可能でマウントする場所(src/judge/sandbox/native.pyと同じ)。
+// rootしか辿れないディレクトリの下にあり、ファイルもホストのrootの所有なので、権限を落としたユーザープログラムからは書き込めない
+#define DELEGATED_CGROUP_ROOT "/run/judge/cgroup"
+// タスクごとのcgroupを使う場合に、watchdog自身を移すcgroup
+#define WATCHDOG_CGROUP DELEGATED_CGROUP_ROOT "/watchdog"
+
+#ifndef SYS_pidfd_open
+#define SYS_pidfd_open 434
+#endif
+
 using json = nlohmann::json;
 
 json readFromStdin() {
@@ -46,24 +69,51 @@ json readFromFile(const std::string& filename) {
   return json::parse(jsonString);
 }
 
-std::vector<pid_t> get_child_pids(pid_t parent_pid) {
-  std::vector<pid_t> children;
-  std::string cmd = std::string("pgrep -P ") + std::to_string(parent_pid);
-
-  // コマンドを実行
-  FILE* stream = popen(cmd.c_str(), "r");
-  if (!stream) {
-    throw std::runtime_error("popen failed");
+// /procを走査して、pidの子孫のプロセスを列挙する
+std::vector<pid_t> get_descendant_pids(pid_t pid) {
+  std::vector<std::pair<pid_t, pid_t>> processes;  // (pid, ppid)
+  DIR* proc = opendir("/proc");
+  if (proc == nullptr) {
+    return {};
   }
-
-  char buffer[128];
-  while (fgets(buffer, sizeof(buffer), stream) != nullptr) {
-    pid_t pid = std::stoi(std::string(buffer));
-    children.push_back(pid);
+  while (dirent* entry = readdir(proc)) {
+    char* end;
+    long process_id = std::strtol(entry->d_name, &end, 10);
+    if (*end != '\0' || process_id <= 0) {
+      continue;
+    }
+    std::ifstream stat_file(std::string("/proc/") + entry->d_name + "/stat");
+    std::string stat;
+    if (!std::getline(stat_file, stat)) {
+      continue;
+    }
+    // "pid (comm) state ppid ..." (commに空白や括弧が含まれることがあるので、最後の')'の後を読む)
+    size_t pos = stat.rfind(')');
+    if (pos == std::string::npos) {
+      continue;
+    }
+    std::istringstream fields(stat.substr(pos + 1));
+    std::string state;
+    pid_t ppid;
+    if (fields >> state >> ppid) {
+      processes.emplace_back(static_cast<pid_t>(process_id), ppid);
+    }
   }
-
-  pclose(stream);
-  return children;
+  closedir(proc);
+
+  std::vector<pid_t> descendants;
+  std::vector<pid_t> parents = {pid};
+  while (!parents.empty()) {
+    pid_t parent = parents.back();
+    parents.pop_back();
+    for (const auto& [child, ppid] : processes) {
+      if (ppid == parent) {
+        descendants.push_back(child);
+        parents.push_back(child);
+      }
+    }
+  }
+  return descendants;
 }
 
 class BoundedString : public std::string {
@@ -116,43 +166,241 @@ class BoundedString : public std::string {
   size_t remaining() const { return max_capacity - this->length(); }
 };
 
-void kill_recursive(pid_t pid) {
-  try {
-    // まず子プロセスを終了
-    std::vector<pid_t> children = get_child_pids(pid);
-    for (pid_t child : children) {
-      kill_recursive(child);
-    }
+bool write_file(const std::string& path, const std::string& value) {
+  int fd = open(path.c_str(), O_WRONLY | O_CLOEXEC);
+  if (fd == -1) {
+    return false;
+  }
+  bool ok = write(fd, value.data(), value.size()) == static_cast<ssize_t>(value.size());
+  close(fd);
+  return ok;
+}
+
+std::string read_file(const std::string& path) {
+  std::ifstream file(path);
+  std::stringstream buffer;
+  buffer << file.rdbuf();
+  return buffer.str();
+}
 
-    // 対象プロセスを終了
-    if (kill(pid, SIGKILL) < 0) {
-      // std::cerr << "Failed to kill process " << pid << std::endl;
+// watchdogのcgroupにwatchdog以外のプロセスが無く(execごとにcgroupを作るNativeBackend)、memoryコントローラが使える場合は、
+// watchdog自身を子cgroupに移して、タスクごとの子cgroupを作れるようにする。
+// (cgroup v2では、プロセスがいるcgroupの子cgroupでmemoryコントローラを使えないため)
+// コンテナの他のプロセスと同じcgroupにいる(DockerBackend)場合や、書き込み可能なcgroupが渡されていない場合はfalseを返す
+bool enable_task_cgroups() {
+  if (access(DELEGATED_CGROUP_ROOT "/cgroup.procs", W_OK) == -1) {
+    return false;
+  }
+  std::istringstream controllers(read_file(DELEGATED_CGROUP_ROOT "/cgroup.controllers"));
+  std::string controller;
+  bool has_memory = false;
+  while (controllers >> controller) {
+    has_memory = has_memory || controller == "memory";
+  }
+  if (!has_memory) {
+    return false;
+  }
+  std::istringstream procs(read_file(DELEGATED_CGROUP_ROOT "/cgroup.procs"));
+  pid_t process_id;
+  while (procs >> process_id) {
+    if (process_id != getpid()) {
+      return false;
     }
-  } catch (const std::exception& e) {
-    std::cerr << "Error in kill_recursive: " << e.what() << std::endl;
   }
+
+  if (mkdir(WATCHDOG_CGROUP, 0755) == -1 && errno != EEXIST) {
+    return false;
+  }
+  if (!write_file(WATCHDOG_CGROUP "/cgroup.procs", "0")) {
+    rmdir(WATCHDOG_CGROUP);
+    return false;
+  }
+  if (!write_file(DELEGATED_CGROUP_ROOT "/cgroup.subtree_control", "+memory")) {
+    // 元に戻す
+    write_file(DELEGATED_CGROUP_ROOT "/cgroup.procs", "0");
+    rmdir(WATCHDOG_CGROUP);
+    return false;
+  }
+  return true;
 }
 
-bool is_process_alive(pid_t pid) {
-  if (kill(pid, 0) == 0) {
+// 1つのタスクのプロセスだけを入れるcgroup。memory.maxで制限し、memory.peakとmemory.eventsで
+// そのタスクだけの最大メモリ使用量とOOM killを読む(watchdog自身やコンテナの他のプロセスのメモリは含まない)
+class TaskCgroup {
+  std::string path;
+  int procs_fd = -1;
+
+ public:
+  // 作成に失敗した場合はfalseを返す
+  bool create(int index, int memoryLimitMB) {
+    path = std::string(DELEGATED_CGROUP_ROOT) + "/task-" + std::to_string(index);
+    if (mkdir(path.c_str(), 0755) == -1) {
+      return false;
+    }
+    if (memoryLimitMB > 0 && !write_file(path + "/memory.max", std::to_string(static_cast<int64_t>(memoryLimitMB) * 1024 * 1024))) {
+      remove();
+      return false;
+    }
+    // 無い場合(swapが無効なカーネル)は無視する
+    write_file(path + "/memory.swap.max", "0");
+    // OOM killの対象を1つのプロセスではなく、タスクのプロセス全体にする
+    write_file(path + "/memory.oom.group", "1");
+    procs_fd = open((path + "/cgroup.procs").c_str(), O_WRONLY | O_CLOEXEC);
+    if (procs_fd == -1) {
+      remove();
+      return false;
+    }
     return true;
   }
-  return errno != ESRCH;
+
+  // fork()した子プロセスで、権限を落とす前に呼ぶ(cgroup.procsはrootの権限で開いてある)
+  bool enter() { return write(procs_fd, "0", 1) == 1; }
+
+  std::string file(const std::string& name) const { return path + "/" + name; }
+
+  // memory.peakが無い(Linux 5.19より前の)場合は-1
+  int64_t peak_memory() const {
+    std::string peak = read_file(file("memory.peak"));
+    return peak.empty() ? -1 : std::strtoll(peak.c_str(), nullptr, 10);
+  }
+
+  bool oom_killed() const {
+    std::istringstream events(read_file(file("memory.events")));
+    std::string key;
+    int64_t value;
+    while (events >> key >> value) {
+      if (key == "oom_kill") {
+        return value > 0;
+      }
+    }
+    return false;
+  }
+
+  // プロセスグループを抜けた子孫も含めて、cgroupの全てのプロセスをkillする(Linux 5.14以降)
+  void kill_all() const { write_file(file("cgroup.kill"), "1"); }
+
+  void remove() {
+    if (procs_fd != -1) {
+      close(procs_fd);
+      procs_fd = -1;
+    }
+    // killしたプロセスが終了するとcgroupを削除できる
+    for (int i = 0; i < 1000 && rmdir(path.c_str()) == -1 && errno == EBUSY; i++) {
+      usleep(1000);
+    }
+  }
+};
+
+void kill_tree(pid_t pid) {
+  // ユーザープログラムは自分のプロセスグループで動かしている。
+  // 子孫を列挙している間にforkし続けないように、先にグループ全体を止めてから列挙し、
+  // グループをkillした後に、グループを抜けた(setsidなどをした)子孫もkillする
+  kill(-pid, SIGSTOP);
+  std::vector<pid_t> descendants = get_descendant_pids(pid);
+  kill(-pid, SIGKILL);
+  for (pid_t descendant : descendants) {
+    kill(descendant, SIGKILL);
+  }
 }
 
-int main(int argc, char** argv) {
-  json jsonData;
-  if (argc == 2) {
-    jsonData = readFromFile(argv[1]);
-  } else {
-    jsonData = readFromStdin();
+int pidfd_open(pid_t pid) { return syscall(SYS_pidfd_open, pid, 0); }
+
+// first_ms後に(interval_ms > 0 の場合はその後interval_msごとに)読めるようになるtimerfdを作る
+int create_timer(int first_ms, int interval_ms) {
+  int fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC);
+  if (fd == -1) {
+    std::perror("timerfd_create failed");
+    exit(1);
   }
+  itimerspec spec{};
+  spec.it_value.tv_sec = first_ms / 1000;
+  spec.it_value.tv_nsec = static_cast<long>(first_ms % 1000) * 1000000L;
+  spec.it_interval.tv_sec = interval_ms / 1000;
+  spec.it_interval.tv_nsec = static_cast<long>(interval_ms % 1000) * 1000000L;
+  if (timerfd_settime(fd, 0, &spec, nullptr) == -1) {
+    std::perror("timerfd_settime failed");
+    exit(1);
+  }
+  return fd;
+}
+
+void epoll_add(int epfd, int fd, uint32_t events) {
+  epoll_event event{};
+  event.events = events;
+  event.data.fd = fd;
+  if (epoll_ctl(epfd, EPOLL_CTL_ADD, fd, &event) == -1) {
+    std::perror("epoll_ctl failed");
+    exit(1);
+  }
+}
+
+// epollから外して閉じ、fdを-1にする
+void epoll_close(int epfd, int& fd) {
+  if (fd == -1) {
+    return;
+  }
+  epoll_ctl(epfd, EPOLL_CTL_DEL, fd, nullptr);
+  close(fd);
+  fd = -1;
+}
 
+void set_nonblocking(int fd) { fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK); }
+
+// 期限切れの回数を読んで、timerfdを読めない状態に戻す
+void consume_timer(int fd) {
+  uint64_t expirations;
+  if (read(fd, &expirations, sizeof(expirations)) < 0) {
+    // 読めない場合は、期限切れになっていない
+  }
+}
+
+int64_t read_memory_current(int fd) {
+  if (fd == -1) {
+    return 0;
+  }
+  char buffer[32];
+  ssize_t count = pread(fd, buffer, sizeof(buffer) - 1, 0);
+  if (count <= 0) {
+    return 0;
+  }
+  buffer[count] = '\0';
+  return std::strtoll(buffer, nullptr, 10);
+}
+
+// 非ブロッキングのfdから読めるだけ読んでoutに追加する。EOFになった場合はfalseを返す
+// outの上限を超えた場合はoverflowedをtrueにし、以降の出力は読み捨てる
+bool read_available(int fd, BoundedString& out, bool& overflowed) {
+  char buffer[4096];
+  while (true) {
+    ssize_t count = read(fd, buffer, sizeof(buffer));
+    if (count > 0) {
+      if (!overflowed) {
+        try {
+          out += std::string(buffer, count);
+        } catch (const std::length_error& e) {
+          overflowed = true;
+        }
+      }
+      continue;
+    }
+    if (count == 0) {
+      return false;
+    }
+    if (errno == EINTR) {
+      continue;
+    }
+    // EAGAINの場合は、今読める分は読み切った(それ以外のエラーはEOFとして扱う)
+    return errno == EAGAIN || errno == EWOULDBLOCK;
+  }
+}
+
+json run_task(const json& jsonData, TaskCgroup* cgroup) {
   /**
    * JSONデータは以下のような形式になっている
    * {
    *   "command": "cmd [args...]",
    *   "stdin": "stdin data",
+   *   "stdinPath": "/path/to/stdin", (省略可。空でない場合はstdinの代わりにこのファイルを標準入力にする)
    *   "timeoutMS": 3000,
    *   "memoryLimitMB": 1024,
    *   "uid": 1000,
@@ -161,6 +409,7 @@ int main(int argc, char** argv) {
    */
   std::string command;
   std::string stdin_str;
+  std::string stdin_path;
   int timeoutMS = 0;
   int memoryLimitMB = 0;
   int uid = 0;
@@ -172,6 +421,9 @@ int main(int argc, char** argv) {
     memoryLimitMB = jsonData.at("memoryLimitMB");
     uid = jsonData.at("uid");
     gid = jsonData.at("gid");
+    if (jsonData.contains("stdinPath")) {
+      stdin_path = jsonData.at("stdinPath");
+    }
   } catch (const json::out_of_range& e) {
     std::printf("Key not found: %s\n", e.what());
     exit(1);
@@ -186,6 +438,12 @@ int main(int argc, char** argv) {
     exit(1);
   }
 
+  // タスクのcgroupを作れない場合は、コンテナ全体のmemory.currentで計測・制限する
+  static int task_index = 0;
+  if (cgroup != nullptr && !cgroup->create(task_index++, memoryLimitMB)) {
+    cgroup = nullptr;
+  }
+
   pid_t pid = fork();
   if (pid == -1) {
     // フォーク失敗
@@ -193,6 +451,15 @@ int main(int argc, char** argv) {
     exit(1);
   } else if (pid == 0) {
     // 子プロセス
+    // 子孫もまとめてkillできるように、自分のプロセスグループを作る
+    setpgid(0, 0);
+    // タスクのcgroupに入る(以降に使ったメモリが、このタスクのメモリになる)
+    if (cgroup != nullptr && !cgroup->enter()) {
+      std::perror("enter task cgroup failed");
+      exit(1);
+    }
+    // watchdogで無視しているSIGPIPEを、ユーザープログラムではデフォルトの動作に戻す
+    signal(SIGPIPE, SIG_DFL);
     // 標準出力と標準エラーをパイプにリダイレクト
     close(STDOUT_FILENO);
     close(STDERR_FILENO);
@@ -203,6 +470,16 @@ int main(int argc, char** argv) {
     close(stdout_pipe[1]);
     close(stderr_pipe[1]);
 
+    // 標準入力のファイルは、ユーザープログラムから直接読めないようにrootしか読めないので、権限を変更する前に開く
+    int stdin_file = -1;
+    if (!stdin_path.empty()) {
+      stdin_file = open(stdin_path.c_str(), O_RDONLY);
+      if (stdin_file == -1) {
+        std::perror("open stdin file failed");
+        exit(1);
+      }
+    }
+
     // プロセス権限の変更
     if (setgid(gid) != 0) {
       std::perror("setgid failed");
@@ -213,11 +490,17 @@ int main(int argc, char** argv) {
       exit(1);
     }
 
-    // stdin_pipe[0]から標準入力を読み込む
+    // stdin_pipe[0](またはstdinPathのファイル)から標準入力を読み込む
     close(stdin_pipe[1]);
     close(STDIN_FILENO);
-    dup2(stdin_pipe[0], STDIN_FILENO);
-    close(stdin_pipe[0]);
+    if (stdin_file != -1) {
+      dup2(stdin_file, STDIN_FILENO);
+      close(stdin_file);
+      close(stdin_pipe[0]);
+    } else {
+      dup2(stdin_pipe[0], STDIN_FILENO);
+      close(stdin_pipe[0]);
+    }
 
     // 対象コマンドを実行
     execl("/bin/sh", "sh", "-c", command.c_str(), NULL);
@@ -225,6 +508,9 @@ int main(int argc, char** argv) {
     exit(1);
   } else {
     // 親プロセス
+    // 子プロセスのsetpgidより先にkillすることがあるので、親からも設定しておく
+    setpgid(pid, pid);
+    auto start_time = std::chrono::steady_clock::now();
     close(stdout_pipe[1]);
     close(stderr_pipe[1]);
     close(stdin_pipe[0]);
@@ -235,159 +521,178 @@ int main(int argc, char** argv) {
     int timeMS = 0;
     int memoryKB = 0;
     bool OLE = false; // Output Limit Exceeded
-
-    auto start_time = std::chrono::steady_clock::now();
-    std::atomic<bool> finished(false);
     int64_t max_memory = 0;
 
-    // タイムアウト用のタイマースレッド
-    std::thread timeout_thread([&]() {
-      while (!finished.load()) {
-        auto now = std::chrono::steady_clock::now();
-        // printf("%ldms elapsed, finished: %d\n", std::chrono::duration_cast<std::chrono::milliseconds>(now - start_time).count(), finished.load());
-        if (std::chrono::duration_cast<std::chrono::milliseconds>(now - start_time).count() >= timeoutMS) {
-          // タイムアウト
-          // printf("timeout, kill %d\n", pid);
-          // shで実行している場合、子プロセスが残っているため、再帰的に終了する必要がある。
-          // そうしないと、子プロセスが実行され続けてしまうし、stdoutやstderrがパイプにEOFが送られない。
-          finished.store(true);
-          kill_recursive(pid);
-          // printf("waitpid: %d\n", waitpid(pid, NULL, 0));
-          break;
+    // 子プロセスの終了(pidfd)、出力、標準入力の書き込み、タイムアウト(timerfd)、メモリ使用量の確認(timerfd)を
+    // 1つのepollで待つ。スリープしながら確認しないので、タイムアウトをすぐに検知でき、待っている間はCPUを使わない
+    int epfd = epoll_create1(EPOLL_CLOEXEC);
+    if (epfd == -1) {
+      std::perror("epoll_create1 failed");
+      exit(1);
+    }
+    int stdout_fd = stdout_pipe[0];
+    int stderr_fd = stderr_pipe[0];
+    int stdin_fd = stdin_pipe[1];
+    set_nonblocking(stdout_fd);
+    set_nonblocking(stderr_fd);
+    epoll_add(epfd, stdout_fd, EPOLLIN);
+    epoll_add(epfd, stderr_fd, EPOLLIN);
+    size_t stdin_written = 0;
+    if (stdin_str.empty()) {
+      // EOFを送信
+      close(stdin_fd);
+      stdin_fd = -1;
+    } else {
+      set_nonblocking(stdin_fd);
+      epoll_add(epfd, stdin_fd, EPOLLOUT);
+    }
+    // pidfdが使えない(Linux 5.3より前の)場合は、メモリ使用量を確認するたびにwaitpidで終了を確認する
+    int pid_fd = pidfd_open(pid);
+    if (pid_fd != -1) {
+      epoll_add(epfd, pid_fd, EPOLLIN);
+    }
+    int deadline_fd = -1;
+    if (timeoutMS > 0) {
+      deadline_fd = create_timer(timeoutMS, 0);
+      epoll_add(epfd, deadline_fd, EPOLLIN);
+    }
+    int sample_fd = create_timer(MEMORY_SAMPLE_INTERVAL_MS, MEMORY_SAMPLE_INTERVAL_MS);
+    epoll_add(epfd, sample_fd, EPOLLIN);
+    std::string memory_current = cgroup != nullptr ? cgroup->file("memory.current") : CGROUP_ROOT "/memory.current";
+    int memory_fd = open(memory_current.c_str(), O_RDONLY | O_CLOEXEC);
+
+    int status = 0;
+    bool exited = false;
+    bool killed = false;
+    bool stdout_overflowed = false;
+    bool stderr_overflowed = false;
+    auto end_time = start_time;
+
+    auto kill_once = [&]() {
+      if (!killed) {
+        killed = true;
+        kill_tree(pid);
+        if (cgroup != nullptr) {
+          cgroup->kill_all();
         }
-        std::this_thread::sleep_for(std::chrono::milliseconds(50));
       }
-      if (is_process_alive(pid)) {
-        kill_recursive(pid);
-      }
-    });
-
-    // リソース監視スレッド
-    std::thread monitor_thread([&]() {
-      std::ifstream mem_file("/sys/fs/cgroup/memory.current");
-      char buffer[4096];
-      while (!finished.load()) {
-        // メモリ使用量を取得
-        int64_t current_memory;
-        if (mem_file.is_open()) {
-          mem_file >> current_memory;
-          mem_file.seekg(0);
-        }
-
-        if (current_memory > max_memory) {
-          max_memory = current_memory;
-        }
-
-        if (current_memory >
-            static_cast<int64_t>(memoryLimitMB) * 1024 * 1024) {
-          // メモリ制限超過
-          finished.store(true);
+    };
+    auto on_exit = [&]() {
+      exited = true;
+      end_time = std::chrono::steady_clock::now();
+      epoll_close(epfd, pid_fd);
+      epoll_close(epfd, deadline_fd);
+    };
+
+    while (!exited || stdout_fd != -1 || stderr_fd != -1) {
+      int wait_ms = -1;
+      if (exited) {
+        // 子プロセスは終了したが、子孫が出力のパイプを開いたままにしている
+        auto elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(std::chrono::steady_clock::now() - end_time).count();
+        if (elapsed >= DRAIN_GRACE_MS) {
+          kill(-pid, SIGKILL);
+          if (cgroup != nullptr) {
+            cgroup->kill_all();
+          }
+          read_available(stdout_fd, stdout_str, stdout_overflowed);
+          read_available(stderr_fd, stderr_str, stderr_overflowed);
           break;
         }
+        wait_ms = DRAIN_GRACE_MS - static_cast<int>(elapsed);
+      }
 
-        // 標準出力を取得(リアルタイム)
-        try {
-          // poll stdout_pipe[0] to check it is readable
-          pollfd fds[1];
-          fds[0].fd = stdout_pipe[0];
-          fds[0].events = POLLIN;
-          int ret = poll(fds, 1, 0);
-          if (ret > 0) {
-            // if readable, read from stdout_pipe[0]
-            ssize_t count;
-            if ((count = read(stdout_pipe[0], buffer, sizeof(buffer))) > 0) {
-              // printf("reading %ld bytes from stdout\n", count);
-              stdout_str += std::string(buffer, count);
-            }
-          }
-        } catch (const std::length_error& e) {
-          finished.store(true);
-          OLE = true;
-          break;
+      epoll_event events[8];
+      int count = epoll_wait(epfd, events, 8, wait_ms);
+      if (count == -1) {
+        if (errno == EINTR) {
+          continue;
         }
+        std::perror("epoll_wait failed");
+        exit(1);
+      }
 
-        // 標準エラーを取得(リアルタイム)
-        try {
-          // poll stderr_pipe[0] to check it is readable
-          pollfd fds[1];
-          fds[0].fd = stderr_pipe[0];
-          fds[0].events = POLLIN;
-          int ret = poll(fds, 1, 0);
-          if (ret > 0) {
-            // if readable, read from stderr_pipe[0]
-            ssize_t count;
-            if ((count = read(stderr_pipe[0], buffer, sizeof(buffer))) > 0) {
-              // printf("reading %ld bytes from stderr\n", count);
-              stderr_str += std::string(buffer, count);
+      for (int i = 0; i < count; i++) {
+        int fd = events[i].data.fd;
+        if (fd == stdout_fd || fd == stderr_fd) {
+          bool is_stdout = fd == stdout_fd;
+          bool& overflowed = is_stdout ? stdout_overflowed : stderr_overflowed;
+          bool open = read_available(fd, is_stdout ? stdout_str : stderr_str, overflowed);
+          if (overflowed && !OLE) {
+            // 出力が長すぎる
+            OLE = true;
+            if (!exited) {
+              kill_once();
             }
           }
-        } catch (const std::length_error& e) {
-          finished.store(true);
-          break;
-        }
-
-        std::this_thread::sleep_for(std::chrono::milliseconds(10));
-      }
-      mem_file.close();
-    });
-
-    // 子プロセスに標準入力を流す
-    {
-      int remaining = stdin_str.size();
-      const char* ptr = stdin_str.c_str();
-      while (remaining > 0) {
-        int written = write(stdin_pipe[1], ptr, remaining);
-        if (written <= 0) {
-          std::perror("write to stdin pipe failed");
-          exit(1);
+          if (!open) {
+            epoll_close(epfd, is_stdout ? stdout_fd : stderr_fd);
+          }
+        } else if (fd == stdin_fd) {
+          // 子プロセスに標準入力を流す(子プロセスが読み切らずに終了した場合はEPIPEになる)
+          ssize_t written = write(stdin_fd, stdin_str.data() + stdin_written, stdin_str.size() - stdin_written);
+          if (written > 0) {
+            stdin_written += written;
+          }
+          if (stdin_written == stdin_str.size() || (written < 0 && errno != EAGAIN && errno != EINTR)) {
+            // EOFを送信
+            epoll_close(epfd, stdin_fd);
+          }
+        } else if (fd == pid_fd) {
+          waitpid(pid, &status, 0);
+          on_exit();
+        } else if (fd == deadline_fd) {
+          consume_timer(deadline_fd);
+          // タイムアウト
+          // shで実行している場合、子プロセスが残っているため、子孫までまとめて終了する必要がある。
+          // そうしないと、子プロセスが実行され続けてしまうし、stdoutやstderrがパイプにEOFが送られない。
+          kill_once();
+        } else if (fd == sample_fd) {
+          consume_timer(sample_fd);
+          int64_t current_memory = read_memory_current(memory_fd);
+          if (current_memory > max_memory) {
+            max_memory = current_memory;
+          }
+          // タスクのcgroupを使う場合は、memory.maxでカーネルが制限する
+          if (!exited && cgroup == nullptr && memoryLimitMB > 0 && current_memory > static_cast<int64_t>(memoryLimitMB) * 1024 * 1024) {
+            // メモリ制限超過
+            kill_once();
+          }
+          if (pid_fd == -1 && !exited && waitpid(pid, &status, WNOHANG) == pid) {
+            on_exit();
+          }
         }
-        remaining -= written;
-        ptr += written;
       }
     }
-    // EOFを送信
-    close(stdin_pipe[1]);
-
-    // 子プロセスの終了を待つ
-    int status;
-    waitpid(pid, &status, 0);
-    finished.store(true);
-    monitor_thread.join();
-    // printf("monitor thread finished\n");
-    // 実行時間を計算
-    auto end_time = std::chrono::steady_clock::now();
-    timeMS = std::chrono::duration_cast<std::chrono::milliseconds>(end_time - start_time).count();
-
-    timeout_thread.join();
-    // printf("timeout thread finished\n");
 
-    // 最大メモリ使用量 (KB)
-    memoryKB = static_cast<int>(max_memory) / 1024;
-
-    // 残りの標準出力を取得
-    try {
-      char buffer[4096];
-      ssize_t count;
-      while ((count = read(stdout_pipe[0], buffer, sizeof(buffer))) > 0) {
-        stdout_str += std::string(buffer, count);
-      }
-    } catch (const std::length_error& e) {
-      OLE = true;
+    epoll_close(epfd, stdout_fd);
+    epoll_close(epfd, stderr_fd);
+    epoll_close(epfd, stdin_fd);
+    epoll_close(epfd, sample_fd);
+    if (memory_fd != -1) {
+      close(memory_fd);
     }
-
-    // 残りの標準エラーを取得
-    try {
-      char buffer[4096];
-      ssize_t count;
-      while ((count = read(stderr_pipe[0], buffer, sizeof(buffer))) > 0) {
-        stderr_str += std::string(buffer, count);
+    close(epfd);
+
+    bool oom_killed = false;
+    if (cgroup != nullptr) {
+      // 計測の間隔より短いメモリ使用量の増加も含めた、正確な最大値
+      int64_t peak_memory = cgroup->peak_memory();
+      if (peak_memory > max_memory) {
+        max_memory = peak_memory;
       }
-    } catch (const std::length_error& e) {
-      OLE = true;
+      oom_killed = cgroup->oom_killed();
+      // 残っている子孫を終了して、cgroupを削除する
+      cgroup->kill_all();
+      cgroup->remove();
+    }
+    // watchdogがPID 1の場合(NativeBackend)、killした子孫はwatchdogの子になるので、ゾンビにならないように回収する
+    while (waitpid(-1, nullptr, WNOHANG) > 0) {
     }
 
-    close(stdout_pipe[0]);
-    close(stderr_pipe[0]);
+    // 実行時間を計算
+    timeMS = std::chrono::duration_cast<std::chrono::milliseconds>(end_time - start_time).count();
+    // 最大メモリ使用量 (KB)
+    memoryKB = static_cast<int>(max_memory / 1024);
 
     if (WIFEXITED(status)) {
       exit_code = WEXITSTATUS(status);
@@ -397,7 +702,7 @@ int main(int argc, char** argv) {
       exit_code = -1;
     }
 
-    // 結果をJSONで出力
+    // 結果をJSONで返す
     json result;
     result["exit_code"] = exit_code;
     result["stdout"] = stdout_str;
@@ -405,8 +710,55 @@ int main(int argc, char** argv) {
     result["timeMS"] = timeMS;
     result["memoryKB"] = memoryKB;
     result["TLE"] = timeoutMS > 0 && timeMS >= timeoutMS;
-    result["MLE"] = memoryLimitMB > 0 && memoryKB / 1024 >= memoryLimitMB;
+    if (cgroup != nullptr) {
+      // memory.maxを超えようとしてOOM killされた場合だけがMLE
+      result["MLE"] = memoryLimitMB > 0 && oom_killed;
+    } else {
+      result["MLE"] = memoryLimitMB > 0 && memoryKB / 1024 >= memoryLimitMB;
+    }
     result["OLE"] = OLE;
-    std::cout << result.dump(4) << std::endl;
+    return result;
+  }
+}
+
+int main(int argc, char** argv) {
+  json jsonData;
+  if (argc == 2) {
+    jsonData = readFromFile(argv[1]);
+  } else {
+    jsonData = readFromStdin();
+  }
+
+  // 子プロセスが標準入力を読み切らずに終了しても、watchdogが終了しないようにする
+  signal(SIGPIPE, SIG_IGN);
+
+  TaskCgroup task_cgroup;
+  TaskCgroup* cgroup = enable_task_cgroups() ? &task_cgroup : nullptr;
+
+  // {"tasks": [...], "stopAfterFailures": N} の形式の場合は、TLE・MLE・OLEになったタスクがN個になった時点で、
+  // 残りのタスクを実行せずに終了する(N = 0の場合は全て実行する)
+  int stopAfterFailures = 0;
+  if (jsonData.is_object() && jsonData.contains("tasks")) {
+    stopAfterFailures = jsonData.value("stopAfterFailures", 0);
+    json tasks = jsonData.at("tasks");
+    jsonData = tasks;
+  }
+
+  if (jsonData.is_array()) {
+    // タスクのリストが渡された場合は、順番に実行し、1タスクにつき1行のJSONで結果を出力する
+    // (各行は、そのタスクが終わった時点で出力される)
+    int failures = 0;
+    for (const auto& task : jsonData) {
+      json result = run_task(task, cgroup);
+      std::cout << result.dump() << std::endl;
+      if (result["TLE"].get<bool>() || result["MLE"].get<bool>() || result["OLE"].get<bool>()) {
+        failures++;
+      }
+      if (stopAfterFailures > 0 && failures >= stopAfterFailures) {
+        break;
+      }
+    }
+  } else {
+    std::cout << run_task(jsonData, cgroup).dump(4) << std::endl;
   }
 }
@@ -0,0 +1,23 @@
+#!/bin/bash
+
+set -e
+
+SCRIPT_DIR=$(cd $(dirname $0); pwd)
+
+# nativeバックエンド(JUDGE_SANDBOX_BACKEND=native)で使う、イメージのルートファイルシステムを用意する
+# 事前にprepare-sandbox.shで、crunのインストールとイメージのビルドを済ませておくこと
+# 使い方: sudo ./prepare-native-sandbox.sh [JUDGE_NATIVE_SANDBOX_ROOT]
+ROOT=${1:-/var/lib/dsa-judge/sandbox}
+
+for IMAGE in checker-lang-gcc binary-runner; do
+    echo "${IMAGE}のルートファイルシステムを${ROOT}/images/${IMAGE}/rootfsに展開します。"
+    rm -rf $ROOT/images/$IMAGE
+    mkdir -p $ROOT/images/$IMAGE/rootfs
+    CONTAINER=$(docker create $IMAGE)
+    docker export $CONTAINER | tar -x -C $ROOT/images/$IMAGE/rootfs
+    # watchdogにexecごとのcgroupを渡すマウントポイント(ルートファイルシステムは読み取り専用でマウントするので、先に作っておく)
+    mkdir -p $ROOT/images/$IMAGE/rootfs/run/judge
+    docker rm $CONTAINER > /dev/null
+done
+
+mkdir -p $ROOT/volumes $ROOT/containers
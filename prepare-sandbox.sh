@@ -7,6 +7,8 @@ SCRIPT_DIR=$(cd $(dirname $0); pwd)
 # サンドボックスコンテナのCPUを隔離
 # Linux以外にも対応するために、この処理は行わない
 # この設定はサンドボックスのパフォーマンスを高くするために行うものであるため、特に必要不可欠でもない
+# ジャッジサーバーから行う場合は、.envでJUDGE_ISOLATE_CPUS=true, JUDGE_CPUSET=0-1 とする
+# (各ジャッジへの専有CPUの割り当てはJUDGE_PIN_CPUS=true)
 # mkdir -p /sys/fs/cgroup/judge.slice/
 # systemctl set-property judge.slice AllowedCPUs=0-1
 # echo 'isolated' > /sys/fs/cgroup/judge.slice/cpuset.cpus.partition
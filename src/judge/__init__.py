@@ -1,116 +1,423 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 import datetime
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import functools
 from .db.crud import *
 from .db.models import *
 from .db import records
-from .db.database import SessionLocal
+from .db.database import SessionLocal, engine
 from .sandbox.my_error import Error
-from .judge import JudgeInfo
+from .judge import JudgeInfo, revoke_claim, forget_claim
+from .scheduler import JobScheduler, create_scheduler
+from .metrics import judge_metrics
+from .admission import (
+    AdmissionController, JUDGE_MAX_WORKERS, JUDGE_CAPACITY_REFRESH_SEC, job_memory_mb, testcase_shard_count, max_testcase_shards,
+    CGROUP_ROOT, CGROUP_PARENT, JUDGE_CPUSET, JUDGE_ISOLATE_CPUS, create_cpu_allocator, read_pinnable_cpus
+)
+from .sandbox.cpuset import CpuAllocator, setup_isolated_partition, parse_cpu_list, define_cpuset_logger
+from .container_pool import ContainerPool, create_container_pool
+from .resource_volume import ResourceVolumeManager, create_resource_volume_manager
+from .volume_pool import VolumePool, create_volume_pool
+from .docker_client import docker_clients
+from .pipeline import StagedPipeline, JUDGE_STAGED_PIPELINE
 
 from .log.config import judge_logger
 from .sandbox.execute import define_sandbox_logger
-from queue import Queue
-from threading import Lock, Thread
-import time
+from dotenv import load_dotenv
+import os
+import socket
 import traceback
 
+load_dotenv()
+
+# DBポーリング間隔の下限・上限[秒]
+# ジョブが見つからない間は間隔を倍々に伸ばし、ジョブが見つかるか/kickされたら下限に戻す
+JOB_POLL_MIN_INTERVAL_SEC = float(os.getenv("JOB_POLL_MIN_INTERVAL_SEC", "0.1"))
+JOB_POLL_MAX_INTERVAL_SEC = float(os.getenv("JOB_POLL_MAX_INTERVAL_SEC", "5.0"))
+
+# 複数台のジャッジサーバーを1つのDBに繋ぐ場合に、各サーバーを識別するID
+JUDGE_NODE_ID = os.getenv("JUDGE_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# ジャッジリクエストのclaimの有効期限[秒]。この1/3の間隔でハートビートにより延長する
+JUDGE_LEASE_SEC = int(os.getenv("JUDGE_LEASE_SEC", "60"))
+# 有効期限の無い"running"のジャッジリクエスト(claimの仕組みが無い古いジャッジサーバーが実行中のもの)を、
+# 取得し直すまでに待つ時間[秒]。この間に一度も更新されなかったものだけを取得し直す
+JUDGE_LEASELESS_RECLAIM_SEC = int(os.getenv("JUDGE_LEASELESS_RECLAIM_SEC", "1800"))
+
 class JobManager:
-    def __init__(self, max_workers=5, queue_size=40):
-        self.worker_pool = WorkerPool(max_workers=max_workers)
-        self.job_queue = Queue(maxsize=queue_size)
+    """
+    FastAPIのイベントループ上で動くジョブ管理
+    * _fill_job_queue: 空いているワーカーの数だけDBからジャッジリクエストをclaimし、job_queueに積む
+    * _dispatch_jobs: job_queueのジャッジリクエストを、ワーカーが空き次第WorkerPoolに割り当てる
+    * _heartbeat: claimしているジャッジリクエストの有効期限を延長する
+    * _refresh_capacity: ホストの容量を読み直し、同時実行数とメモリ予算(とCPUの割り当て対象)を更新する。
+      あわせてDockerデーモンへの疎通を確認する
+    ジャッジ処理そのもの(Docker, DBの同期API呼び出し)はWorkerPoolのスレッドで行う。
+    JUDGE_STAGED_PIPELINE=trueの場合は、WorkerPoolの代わりにStagedPipeline(pipeline.py)で、
+    prepare -> build -> run -> persist の段階ごとに別のスレッドで行う。
+    """
+    def __init__(
+        self,
+        max_workers: int = JUDGE_MAX_WORKERS,
+        scheduler: JobScheduler | None = None,
+        cpu_allocator: CpuAllocator | None = None,
+        container_pool: ContainerPool | None = None,
+        resource_volumes: ResourceVolumeManager | None = None,
+        volume_pool: VolumePool | None = None,
+        staged_pipeline: bool = JUDGE_STAGED_PIPELINE,
+    ):
+        # max_workers <= 0 の場合、同時実行数はホストのCPU数から決める
+        # cpu_allocatorを渡した場合、各ジャッジに専有CPUを割り当て、同時実行数は割り当てられる数までになる
+        # (パイプラインの場合は、run段階の同時実行数がこれらで決まる)
+        self.worker_pool: WorkerPool | StagedPipeline
+        if staged_pipeline:
+            self.worker_pool = StagedPipeline(
+                admission=AdmissionController(max_workers=max_workers),
+                cpu_allocator=cpu_allocator,
+                container_pool=container_pool,
+                resource_volumes=resource_volumes,
+                volume_pool=volume_pool,
+            )
+        else:
+            self.worker_pool = WorkerPool(
+                admission=AdmissionController(max_workers=max_workers),
+                cpu_allocator=cpu_allocator,
+            )
+        self.job_queue: asyncio.Queue[records.Submission] = asyncio.Queue()
+        # 起動済みのコンテナを貸し出すプール(Noneの場合はジャッジごとにコンテナを作成する)
+        self.container_pool = container_pool
+        # 問題ごとのリソースボリューム(Noneの場合はジャッジごとにファイルをコピーする)
+        self.resource_volumes = resource_volumes
+        # 作成済みの作業用ボリュームを貸し出すプール(Noneの場合はジャッジごとにボリュームを作成する)
+        self.volume_pool = volume_pool
+        # claimするジャッジリクエストを選ぶスケジューラー
+        self.scheduler = scheduler if scheduler is not None else create_scheduler()
+        self._running = False
+        # DBポーリングを即座に行わせるためのイベント
+        self._wakeup = asyncio.Event()
+        self._poll_interval = JOB_POLL_MIN_INTERVAL_SEC
+        # このジャッジサーバーがclaimしていて、まだ完了していないジャッジリクエストのID
+        self.node_id = JUDGE_NODE_ID
+        self._claimed_ids: set[int] = set()
+        # job_queueから取り出したが、メモリ予算が空くのを待っているジャッジリクエストの数
+        self._waiting_for_admission = 0
+        self._tasks: list[asyncio.Task] = []
+        self._heartbeat_task: asyncio.Task | None = None
+
+    def start(self):
+        """
+        イベントループ上で呼び出すこと
+        """
         self._running = True
-        
-        # Job Queue補充用スレッド
-        self.queue_filler_thread = Thread(target=self._fill_job_queue)
-        self.queue_filler_thread.daemon = True
-        self.queue_filler_thread.start()
-        
-        # Worker Pool管理用スレッド
-        self.worker_manager_thread = Thread(target=self._manage_workers)
-        self.worker_manager_thread.daemon = True
-        self.worker_manager_thread.start()
+        if isinstance(self.worker_pool, StagedPipeline):
+            self.worker_pool.start()
+        self._tasks = [
+            asyncio.create_task(self._fill_job_queue()),
+            asyncio.create_task(self._dispatch_jobs()),
+            asyncio.create_task(self._refresh_capacity()),
+        ]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
     
-    def _fill_job_queue(self):
+    def kick(self):
         """
-        5秒おきにDBからジョブを取得してキューに追加
+        次のDBポーリングを待たずに、ジョブの取得を即座に行わせる
+        """
+        self._wakeup.set()
+
+    async def _fill_job_queue(self):
+        """
+        DBからジョブを取得してキューに追加
+        kick()されるか、ポーリング間隔(適応的に変化)が経過するたびに実行する
         """
         while self._running:
+            # 取得中に届いたkickを取りこぼさないように、取得前にクリアする
+            self._wakeup.clear()
+            fetched = 0
             try:
-                # キューの空き容量
-                space_available = self.job_queue.maxsize - self.job_queue.qsize()
+                # 空いているワーカーの分だけclaimする。
+                # 先取りしてキューに溜め込むと、他のジャッジサーバーが処理できたジョブを抱え込んでしまう。
+                space_available = (
+                    self.worker_pool.available_workers() - self.job_queue.qsize() - self._waiting_for_admission
+                )
                 if space_available > 0:
                     # DBから見実行のジョブを取得
-                    with SessionLocal() as db:
-                        submission_list = fetch_queued_judge_and_change_status_to_running(db, space_available)
+                    submission_list = await asyncio.to_thread(self._claim, space_available)
+                    self._claimed_ids.update(submission.id for submission in submission_list)
                     for submission in submission_list:
-                        self.job_queue.put(submission)
+                        self.job_queue.put_nowait(submission)
+                    fetched = len(submission_list)
             except Exception as e:
                 judge_logger.error(f"Error filling job queue: {e}")
                 judge_logger.error(f"スタックトレース:\n{traceback.format_exc()}")
 
-            time.sleep(5)
+            # ジョブが見つかった場合は間隔を下限に戻し、見つからなかった場合は間隔を伸ばす
+            if fetched > 0:
+                self._poll_interval = JOB_POLL_MIN_INTERVAL_SEC
+            else:
+                self._poll_interval = min(self._poll_interval * 2, JOB_POLL_MAX_INTERVAL_SEC)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+                # kickされた場合は、新しいジョブがある可能性が高いので間隔を下限に戻す
+                self._poll_interval = JOB_POLL_MIN_INTERVAL_SEC
+            except asyncio.TimeoutError:
+                pass
+
+    def _claim(self, n: int) -> list[records.Submission]:
+        with SessionLocal() as db:
+            return fetch_queued_judge_and_change_status_to_running(
+                db, n, node_id=self.node_id, lease_sec=JUDGE_LEASE_SEC, leaseless_reclaim_sec=JUDGE_LEASELESS_RECLAIM_SEC,
+                rank=self.scheduler.rank, charge=self.scheduler.charge,
+                candidate_limit=self.scheduler.candidate_limit,
+                order_by_deadline=self.scheduler.order_by_deadline
+            )
     
-    def _manage_workers(self):
+    async def _dispatch_jobs(self):
         """
-        完了したジョブの処理と新しいジョブの割り当て
+        ジョブをワーカーに割り当てる。ワーカーが空いた時点(ジョブの完了時)に即座に次のジョブを割り当てる
+        メモリ予算が足りない場合は、他のジョブが終わって予算が空くまで待つ
         """
         while self._running:
             try:
-                # 完了したジョブの処理
-                completed_jobs = self.worker_pool.collect_completed_jobs()
-                for job in completed_jobs:
-                    judge_logger.info(f"job: \"{job[0]}\", date: {job[1]}, result: {job[2]}")
-                
-                # 利用可能なワーカーにジョブを割り当て
-                while not self.job_queue.empty() and self.worker_pool.available_workers() > 0:
-                    submission = self.job_queue.get()
-                    self.worker_pool.submit_job(f"submission-{submission.id}", process_one_judge_request, submission)
+                await self.worker_pool.wait_for_available_worker()
+                submission = await self.job_queue.get()
+                # コンテナプールを使う場合は、Judgeテストケースを1つの実行用コンテナで順に実行する
+                shard_count = 1 if self.container_pool is not None else testcase_shard_count(
+                    len([task for task in submission.problem.test_cases if task.type == records.EvaluationType.Judge])
+                )
+                memory_mb = job_memory_mb(submission.problem.memoryMB, shard_count)
+                self._waiting_for_admission += 1
+                try:
+                    await self.worker_pool.wait_for_admission(memory_mb)
+                finally:
+                    self._waiting_for_admission -= 1
+                on_done = lambda _, submission=submission: self._on_job_done(submission)
+                if isinstance(self.worker_pool, StagedPipeline):
+                    self.worker_pool.submit_judge(
+                        f"submission-{submission.id}", submission, memory_mb=memory_mb, on_done=on_done
+                    )
+                    continue
+                self.worker_pool.submit_job(
+                    f"submission-{submission.id}",
+                    process_one_judge_request,
+                    submission,
+                    self.container_pool,
+                    self.resource_volumes,
+                    self.volume_pool,
+                    memory_mb=memory_mb,
+                    on_done=on_done,
+                )
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 judge_logger.error(f"Error managing workers: {e}")
                 judge_logger.error(f"スタックトレース:\n{traceback.format_exc()}")
 
-            # 0.1秒待機
-            time.sleep(0.1)
-    
-    def stop(self):
+    def _on_job_done(self, submission: records.Submission):
+        self._claimed_ids.discard(submission.id)
+        forget_claim(submission.id)
+        record_deadline_metrics(submission)
+        # ワーカーに空きができたので、すぐに補充させる
+        self.kick()
+
+    async def _heartbeat(self):
+        """
+        claimしているジャッジリクエストの有効期限を定期的に延長する
+        シャットダウン中も、実行中のジャッジリクエストが残っている間は延長を続ける(stop()でキャンセルされる)
+        """
+        while True:
+            try:
+                claimed_id_list = list(self._claimed_ids)
+                if len(claimed_id_list) > 0:
+                    renewed_id_list = await asyncio.to_thread(self._renew_leases, claimed_id_list)
+                    # 延長しようとした間に完了したものは除く
+                    lost_id_list = (set(claimed_id_list) - set(renewed_id_list)) & self._claimed_ids
+                    if len(lost_id_list) > 0:
+                        judge_logger.warning(f"claim lost (lease expired or reclaimed by another node): {sorted(lost_id_list)}")
+                        # 実行中のジャッジを打ち切らせる(結果は登録されない)
+                        for submission_id in lost_id_list:
+                            revoke_claim(submission_id)
+            except Exception as e:
+                judge_logger.error(f"Error renewing leases: {e}")
+                judge_logger.error(f"スタックトレース:\n{traceback.format_exc()}")
+
+            await asyncio.sleep(JUDGE_LEASE_SEC / 3)
+
+    async def _refresh_capacity(self):
+        """
+        ホストの容量を定期的に読み直し、同時実行数とメモリ予算を実行中に変更する
+        """
+        while self._running:
+            await asyncio.sleep(JUDGE_CAPACITY_REFRESH_SEC)
+            try:
+                changed = await asyncio.to_thread(self.worker_pool.admission.refresh)
+                cpu_allocator = self.worker_pool.cpu_allocator
+                if cpu_allocator is not None:
+                    changed |= cpu_allocator.update(await asyncio.to_thread(read_pinnable_cpus))
+                if changed:
+                    admission = self.worker_pool.admission
+                    judge_logger.info(f"capacity changed: max_workers={self.worker_pool.max_workers}, memory_budget_mb={admission.memory_budget_mb}")
+                    self.worker_pool.capacity_changed()
+                    self.kick()
+                err = await asyncio.to_thread(docker_clients.check_health)
+                if not err.silence():
+                    judge_logger.error(err.message)
+            except Exception as e:
+                judge_logger.error(f"Error refreshing capacity: {e}")
+                judge_logger.error(f"スタックトレース:\n{traceback.format_exc()}")
+
+    def _renew_leases(self, submission_id_list: list[int]) -> list[int]:
+        with SessionLocal() as db:
+            return renew_submission_leases(
+                db, node_id=self.node_id, submission_id_list=submission_id_list, lease_sec=JUDGE_LEASE_SEC
+            )
+
+    async def stop(self):
+        """
+        新しいジョブの取得・割り当てを止め、実行中のジョブが全て終わるまで待つ。
+        claimしたがまだ割り当てていないジョブは、job_queueに残ったまま破棄される。
+        """
         self._running = False
-        self.queue_filler_thread.join()
-        self.worker_manager_thread.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.worker_pool.join()
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        self.worker_pool.shutdown()
+
+
+# ジャッジ用スレッド数の上限。実際の同時実行数はAdmissionControllerが決める
+WORKER_THREAD_LIMIT = 64
 
 
 class WorkerPool:
-    max_workers: int
+    admission: AdmissionController
+    cpu_allocator: CpuAllocator | None
     executor: ThreadPoolExecutor
-    active_jobs: dict
+    active_jobs: dict[str, asyncio.Future]
+    _changed: asyncio.Event
 
-    def __init__(self, max_workers: int):
-        self.max_workers = max_workers
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, admission: AdmissionController, cpu_allocator: CpuAllocator | None = None):
+        self.admission = admission
+        self.cpu_allocator = cpu_allocator
+        self.executor = ThreadPoolExecutor(max_workers=WORKER_THREAD_LIMIT)
         self.active_jobs = {}
+        # ワーカーの空き状況が変化したことを通知する
+        self._changed = asyncio.Event()
+        self._update_metrics()
+
+    @property
+    def max_workers(self) -> int:
+        max_workers = min(self.admission.max_workers, WORKER_THREAD_LIMIT)
+        if self.cpu_allocator is not None:
+            max_workers = min(max_workers, self.cpu_allocator.slots())
+        return max_workers
 
     def available_workers(self) -> int:
         return self.max_workers - len(self.active_jobs)
 
-    def collect_completed_jobs(self) -> list:
-        now_completed = [job for job, future in self.active_jobs.items() if future.done()]
-        completed_jobrecord = [(job[0], job[1], future.result()) for job, future in self.active_jobs.items() if future.done()]
-        for job in now_completed:
-            self.active_jobs.pop(job)
-        return completed_jobrecord
-
-    def submit_job(self, job: str, func, *args, **kwargs):
-        if self.available_workers() > 0:
-            future = self.executor.submit(func, *args, **kwargs)
-            self.active_jobs[(job, datetime.now())] = future
+    def capacity_changed(self) -> None:
+        self._update_metrics()
+        self._changed.set()
+
+    def _update_metrics(self) -> None:
+        judge_metrics.set("workers_max", self.max_workers)
+        judge_metrics.set("workers_active", len(self.active_jobs))
+        judge_metrics.set("memory_budget_mb", self.admission.memory_budget_mb)
+        judge_metrics.set("memory_reserved_mb", self.admission.reserved_memory_mb())
+        if self.cpu_allocator is not None:
+            judge_metrics.set("cpus_pinnable", len(self.cpu_allocator.cpus))
+            judge_metrics.set("cpus_free", len(self.cpu_allocator.free_cpus()))
+
+    async def _wait_until(self, predicate) -> None:
+        # イベントループ上でのみ状態が変化するので、確認からwaitまでの間に通知を取りこぼすことはない
+        while not predicate():
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def wait_for_available_worker(self) -> None:
+        await self._wait_until(lambda: self.available_workers() > 0)
+
+    async def wait_for_admission(self, memory_mb: int) -> None:
+        await self._wait_until(
+            lambda: self.available_workers() > 0 and self.admission.can_admit(memory_mb) and self._can_allocate_cpus()
+        )
+
+    def _can_allocate_cpus(self) -> bool:
+        if self.cpu_allocator is None:
             return True
-        return False
+        # 割り当て対象のCPUが減った直後は、slots()に余裕があっても空きCPUが足りないことがある
+        return len(self.cpu_allocator.free_cpus()) >= self.cpu_allocator.cpus_per_job
+
+    async def join(self) -> None:
+        await self._wait_until(lambda: len(self.active_jobs) == 0)
 
-def process_one_judge_request(submission: records.Submission) -> Error:
-    judge_logger.debug(f"JudgeInfo(submission_id={submission.id}, lecture_id={submission.lecture_id}, assignment_id={submission.assignment_id}, eval={submission.eval}) will be created...")
-    judge_info = JudgeInfo(submission)
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit_job(self, job: str, func, *args, memory_mb: int = 0, on_done=None) -> bool:
+        """
+        memory_mb[MB]のメモリを予約して、ジョブをスレッドで実行する。完了するとイベントループ上で
+        on_done(結果)が呼ばれ、ワーカーとメモリ(と専有CPU)が即座に解放される。
+        funcはfunc(*args, cpuset=割り当てたCPUのリスト)の形で呼ばれる(CPUを割り当てない場合はcpuset=None)。
+        """
+        if self.available_workers() <= 0 or not self._can_allocate_cpus():
+            return False
+        cpuset = self.cpu_allocator.allocate(job) if self.cpu_allocator is not None else None
+        started_at = datetime.now()
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, cpuset=cpuset)
+        )
+        self.active_jobs[job] = future
+        self.admission.admit(job, memory_mb)
+        self._update_metrics()
+
+        def _done(future: asyncio.Future):
+            self.active_jobs.pop(job, None)
+            self.admission.release(job)
+            if self.cpu_allocator is not None:
+                self.cpu_allocator.release(job)
+            self._update_metrics()
+            if future.cancelled():
+                result = "cancelled"
+            elif future.exception() is not None:
+                result = future.exception()
+            else:
+                result = future.result()
+            judge_logger.info(f"job: \"{job}\", date: {started_at}, result: {result}")
+            if on_done is not None:
+                on_done(result)
+            self._changed.set()
+
+        future.add_done_callback(_done)
+        return True
+
+
+def record_deadline_metrics(submission: records.Submission) -> None:
+    """
+    締め切りまでに提出されたのに、キューで待たされてジャッジ完了が締め切りを過ぎたものを数える
+    """
+    judge_metrics.increment("jobs_judged")
+    if submission.deadline is None:
+        return
+    judge_metrics.increment("jobs_judged_with_deadline")
+    if datetime.now() > submission.deadline:
+        judge_metrics.increment("jobs_judged_after_deadline")
+        judge_logger.warning(f"submission-{submission.id} was submitted at {submission.ts} but judged after its deadline {submission.deadline}")
+
+
+def process_one_judge_request(
+    submission: records.Submission,
+    container_pool: ContainerPool | None = None,
+    resource_volumes: ResourceVolumeManager | None = None,
+    volume_pool: VolumePool | None = None,
+    cpuset: list[int] | None = None
+) -> Error:
+    judge_logger.debug(f"JudgeInfo(submission_id={submission.id}, lecture_id={submission.lecture_id}, assignment_id={submission.assignment_id}, eval={submission.eval}, cpuset={cpuset}) will be created...")
+    judge_info = JudgeInfo(submission, cpuset=cpuset, container_pool=container_pool, resource_volumes=resource_volumes, volume_pool=volume_pool)
     judge_logger.debug("START JUDGE...")
     err = Error.Nothing()
     try:
@@ -129,23 +436,86 @@ async def lifespan(app: FastAPI):
     # sandboxのデバッグ文(どのDockerコマンドを実行しました、etc)を出力するロガーの設定
     define_sandbox_logger(logger=judge_logger)
     define_crud_logger(logger=judge_logger)
+    define_cpuset_logger(logger=judge_logger)
     judge_logger.info("LIFESPAN LOGIC INITIALIZED...")
-    job_manager = JobManager(max_workers=6, queue_size=20)
+    # claimに使う列が無い既存のDBに、列を追加する
+    await asyncio.to_thread(add_submission_claim_columns, engine)
+    if JUDGE_ISOLATE_CPUS:
+        # サンドボックス用のCPUを隔離する。失敗してもジャッジは続けられるので、警告だけ出す
+        if not JUDGE_CPUSET or not CGROUP_PARENT:
+            judge_logger.warning("JUDGE_ISOLATE_CPUS=true requires JUDGE_CPUSET and CGROUP_PARENT")
+        else:
+            err = setup_isolated_partition(CGROUP_ROOT, CGROUP_PARENT, parse_cpu_list(JUDGE_CPUSET))
+            if not err.silence():
+                judge_logger.warning(err.message)
+    container_pool = create_container_pool()
+    if container_pool is not None:
+        if max_testcase_shards() > 1:
+            judge_logger.warning("JUDGE_TESTCASE_SHARDS is ignored because JUDGE_CONTAINER_POOL_SIZE>0 (testcases run in one runner container)")
+        container_pool.start()
+    resource_volumes = create_resource_volume_manager()
+    if resource_volumes is not None:
+        # 前回の起動時に残ったリソースボリュームを削除する
+        await asyncio.to_thread(resource_volumes.remove_orphans)
+    volume_pool = create_volume_pool()
+    if volume_pool is not None:
+        volume_pool.start()
+    job_manager = JobManager(
+        cpu_allocator=create_cpu_allocator(),
+        container_pool=container_pool,
+        resource_volumes=resource_volumes,
+        volume_pool=volume_pool
+    )
+    job_manager.start()
+    app.state.job_manager = job_manager
     yield
-    job_manager.stop()
     judge_logger.info("LIFESPAN LOGIC DEACTIVATED...")
     # 現在実行しているジャッジリクエストを最後まで実行し、保留状態のものは破棄する
-    job_manager.worker_pool.executor.shutdown(wait=True, cancel_futures=True)
-    completed_jobrecord_list = job_manager.worker_pool.collect_completed_jobs()
-    for completed_jobrecord in completed_jobrecord_list:
-        judge_logger.info(f"job: \"{completed_jobrecord[0]}\", date: {completed_jobrecord[1]}, result: {completed_jobrecord[2]}")
+    await job_manager.stop()
     # statusをrunningにしてしまっているタスクをqueuedに戻す
     # そして途中結果を削除する
     with SessionLocal() as db:
-        undo_running_submissions(db)
+        undo_running_submissions(db, node_id=job_manager.node_id)
+    if container_pool is not None:
+        # 待機中のコンテナとボリュームを削除する
+        await asyncio.to_thread(container_pool.close)
+    if resource_volumes is not None:
+        await asyncio.to_thread(resource_volumes.close)
+    if volume_pool is not None:
+        await asyncio.to_thread(volume_pool.close)
+    docker_clients.close()
 
 app = FastAPI(
     title="DSA Judge Server",
-    description="このサーバーはバックグラウンドでジャッジリクエストを処理します。エンドポイントは公開していません。",
+    description="このサーバーはバックグラウンドでジャッジリクエストを処理します。公開しているのは、ジョブ取得を促す/kickと、統計情報の/metricsのみです。",
     version="0.1.0",
     lifespan=lifespan)
+
+
+@app.post("/kick")
+async def kick():
+    """
+    ジャッジリクエストをqueuedにした直後に呼び出すと、DBポーリングを待たずにジョブの取得が始まる。
+    DBを参照させるだけで、リクエストの内容は一切使わない。
+    """
+    app.state.job_manager.kick()
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    ジャッジサーバーの統計情報
+    * jobs_judged: ジャッジしたリクエストの数
+    * jobs_judged_with_deadline: そのうち、締め切りまでに提出されたものの数
+    * jobs_judged_after_deadline: そのうち、キューで待たされてジャッジ完了が締め切りを過ぎたものの数
+    * workers_max, workers_active: 同時実行数の上限と、実行中のジャッジの数
+    * memory_budget_mb, memory_reserved_mb: ジャッジに使ってよいメモリ量と、実行中のジャッジが予約しているメモリ量
+    * cpus_pinnable, cpus_free: 専有CPUの割り当てに使うCPUの数と、そのうち空いている数(JUDGE_PIN_CPUS=trueの場合)
+    * archive_cache_hits, archive_cache_misses, archive_cache_bytes: 問題ごとのarranged_filesのtarのキャッシュのヒット数・ミス数と、保持しているサイズ[バイト]
+    * docker_requests_total, docker_requests_in_flight, docker_request_errors, docker_reconnects:
+      Dockerデーモンへのリクエスト数、実行中のリクエスト数、失敗したリクエスト数、クライアントを作り直した回数
+    * phase_<段階>_ms_total, phase_<段階>_count: ジャッジの各段階にかかった時間[ms]の合計と、計測した回数
+      (prepare, upload, build, runner_wait, judge, persist, total と、バックグラウンドで行う runner_start, build_teardown, shard_start と、シャードで行う shard_copy)
+    """
+    return judge_metrics.snapshot()
@@ -0,0 +1,203 @@
+"""
+ジャッジの同時実行数とメモリ使用量を制御するアドミッションコントローラー
+
+ホスト(及びサンドボックスコンテナを置くcgroup v2のCGROUP_PARENT)のCPU数・メモリ上限を読み取り、
+* 同時実行数の上限 = CPU数 (JUDGE_MAX_WORKERSで固定可能)
+* メモリ予算 = メモリ上限 - JUDGE_MEMORY_RESERVE_MB
+とする。各ジャッジは、問題のメモリ制限から計算したメモリ量を予約してから実行を開始し、
+予算を超える場合は他のジャッジが終わるまで待つ。容量は定期的に読み直し、実行中に反映する。
+"""
+from pathlib import Path
+from dotenv import load_dotenv
+import math
+import os
+
+from .sandbox.cpuset import CpuAllocator, parse_cpu_list, read_cpu_list
+
+load_dotenv()
+
+CGROUP_ROOT = Path(os.getenv("CGROUP_ROOT", "/sys/fs/cgroup"))
+CGROUP_PARENT = os.getenv("CGROUP_PARENT")
+# 同時実行数の上限。0の場合はCPU数から自動で決める
+JUDGE_MAX_WORKERS = int(os.getenv("JUDGE_MAX_WORKERS", "0"))
+# ジャッジサーバー自身やOSのために確保しておくメモリ[MB]
+JUDGE_MEMORY_RESERVE_MB = int(os.getenv("JUDGE_MEMORY_RESERVE_MB", "1024"))
+# 容量を読み直す間隔[秒]
+JUDGE_CAPACITY_REFRESH_SEC = float(os.getenv("JUDGE_CAPACITY_REFRESH_SEC", "30"))
+# ジャッジごとに専有CPUを割り当てるか
+JUDGE_PIN_CPUS = os.getenv("JUDGE_PIN_CPUS", "false").lower() == "true"
+# 割り当てに使うCPU("2-7"など)。空の場合はCGROUP_PARENTのcpuset.cpus.effective(無ければこのプロセスのCPUアフィニティ)
+JUDGE_CPUSET = os.getenv("JUDGE_CPUSET", "")
+# 1つのジャッジに割り当てるCPUの数
+JUDGE_CPUS_PER_JOB = int(os.getenv("JUDGE_CPUS_PER_JOB", "1"))
+# 起動時にCGROUP_PARENTをcpuset.cpus.partition=isolatedにし、JUDGE_CPUSETをサンドボックス専用にするか
+JUDGE_ISOLATE_CPUS = os.getenv("JUDGE_ISOLATE_CPUS", "false").lower() == "true"
+# ビルド専用にするCPU("0-1"など)。実行用の専有CPUの割り当て対象から除き、JUDGE_STAGED_PIPELINE=trueの場合は
+# ビルド用コンテナをこのCPUで動かす(JUDGE_ISOLATE_CPUS=trueの場合は、JUDGE_CPUSETの中から選ぶこと)
+JUDGE_BUILD_CPUSET = os.getenv("JUDGE_BUILD_CPUSET", "")
+# 1つのジャッジのJudgeテストケースを振り分けて並列に実行する実行用コンテナの数。1の場合は1つのコンテナで順に実行する
+JUDGE_TESTCASE_SHARDS = int(os.getenv("JUDGE_TESTCASE_SHARDS", "1"))
+
+# ビルド用コンテナのメモリ制限[MB]
+BUILD_CONTAINER_MEMORY_MB = 1024
+# 実行用コンテナには、問題のメモリ制限にこの分の余裕を持たせる
+# (watchdogがメモリ制限超過を検知し、ユーザープログラムをkillできるようにするため)
+RUNNER_CONTAINER_MEMORY_MARGIN_MB = 512
+
+
+def max_testcase_shards() -> int:
+    """
+    1つのジャッジで同時に使う実行用コンテナの最大数。JUDGE_PIN_CPUS=trueの場合は、
+    各コンテナに1つ以上の専有CPUを割り当てられる数(JUDGE_CPUS_PER_JOB)までにする
+    """
+    shards = max(1, JUDGE_TESTCASE_SHARDS)
+    if JUDGE_PIN_CPUS:
+        shards = min(shards, max(1, JUDGE_CPUS_PER_JOB))
+    return shards
+
+
+def testcase_shard_count(judge_testcase_count: int, cpu_count: int | None = None) -> int:
+    """
+    Judgeテストケースがjudge_testcase_count個の提出で、実際に使う実行用コンテナの数。
+    cpu_count(割り当てられた専有CPUの数)を指定した場合は、各コンテナに1つ以上のCPUを専有させられる数までにする
+    """
+    shards = min(max_testcase_shards(), judge_testcase_count)
+    if cpu_count is not None:
+        shards = min(shards, cpu_count)
+    return max(1, shards)
+
+
+def job_memory_mb(problem_memory_mb: int, shard_count: int = 1) -> int:
+    """
+    1つのジャッジが使うメモリの最大量[MB]。実行用コンテナはビルド中に起動しておくが、
+    ビルドが終わるまではsleepしているだけなので、ビルド用コンテナと実行用コンテナが同時にメモリを使うことはない。
+    Judgeテストケースを複数(shard_count)の実行用コンテナで並列に実行する場合は、その数だけ実行用コンテナのメモリを使う。
+    """
+    runner_memory_mb = problem_memory_mb + RUNNER_CONTAINER_MEMORY_MARGIN_MB
+    return max(BUILD_CONTAINER_MEMORY_MB, shard_count * runner_memory_mb)
+
+
+def _read_cgroup_file(cgroup: Path, name: str) -> str | None:
+    try:
+        return (cgroup / name).read_text().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_chain(cgroup_parent: str | None) -> list[Path]:
+    """
+    CGROUP_PARENTからcgroupのルートまで辿ったcgroupのリスト
+    """
+    chain = [CGROUP_ROOT]
+    if cgroup_parent:
+        current = CGROUP_ROOT
+        for part in Path(cgroup_parent.strip("/")).parts:
+            current = current / part
+            chain.append(current)
+    return chain
+
+
+def read_cpu_capacity(cgroup_parent: str | None = CGROUP_PARENT) -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    for cgroup in _cgroup_chain(cgroup_parent):
+        # cpu.max: "<quota> <period>" or "max <period>"
+        cpu_max = _read_cgroup_file(cgroup, "cpu.max")
+        if cpu_max is not None:
+            quota, _, period = cpu_max.partition(" ")
+            if quota != "max" and period:
+                cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+        # cpuset.cpus.effective: "0-3,6"
+        effective = _read_cgroup_file(cgroup, "cpuset.cpus.effective")
+        if effective:
+            cpus = min(cpus, len(parse_cpu_list(effective)))
+    return max(1, cpus)
+
+
+def read_memory_capacity_mb(cgroup_parent: str | None = CGROUP_PARENT) -> int:
+    memory_bytes: int | None = None
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    memory_bytes = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    for cgroup in _cgroup_chain(cgroup_parent):
+        memory_max = _read_cgroup_file(cgroup, "memory.max")
+        if memory_max is not None and memory_max != "max":
+            memory_bytes = int(memory_max) if memory_bytes is None else min(memory_bytes, int(memory_max))
+    if memory_bytes is None:
+        raise RuntimeError("failed to read memory capacity")
+    return memory_bytes // (1024 * 1024)
+
+
+class AdmissionController:
+    max_workers: int  # 同時実行数の上限
+    memory_budget_mb: int  # ジャッジに使ってよいメモリ量
+    reserved: dict[str, int]  # 実行中のジョブ -> 予約しているメモリ量[MB]
+
+    def __init__(self, max_workers: int = JUDGE_MAX_WORKERS):
+        # max_workers > 0 の場合は同時実行数を固定する
+        self._fixed_max_workers = max_workers
+        self.max_workers = 1
+        self.memory_budget_mb = 0
+        self.reserved = {}
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        ホストの容量を読み直す。同時実行数かメモリ予算が変わった場合はTrueを返す
+        """
+        before = (self.max_workers, self.memory_budget_mb)
+        if self._fixed_max_workers > 0:
+            self.max_workers = self._fixed_max_workers
+        else:
+            self.max_workers = read_cpu_capacity()
+        self.memory_budget_mb = max(0, read_memory_capacity_mb() - JUDGE_MEMORY_RESERVE_MB)
+        return before != (self.max_workers, self.memory_budget_mb)
+
+    def reserved_memory_mb(self) -> int:
+        return sum(self.reserved.values())
+
+    def available_workers(self) -> int:
+        return self.max_workers - len(self.reserved)
+
+    def can_admit(self, memory_mb: int) -> bool:
+        if self.available_workers() <= 0:
+            return False
+        return self.fits_memory(memory_mb)
+
+    def fits_memory(self, memory_mb: int) -> bool:
+        # 予算より大きいジョブでも、他に何も実行していなければ実行する(永久に待たせないため)
+        if len(self.reserved) == 0:
+            return True
+        return self.reserved_memory_mb() + memory_mb <= self.memory_budget_mb
+
+    def admit(self, job: str, memory_mb: int) -> None:
+        self.reserved[job] = memory_mb
+
+    def release(self, job: str) -> None:
+        self.reserved.pop(job, None)
+
+
+def read_pinnable_cpus() -> list[int]:
+    """
+    ジャッジに割り当てるCPUのリスト
+    """
+    if JUDGE_CPUSET and not JUDGE_ISOLATE_CPUS:
+        cpus = parse_cpu_list(JUDGE_CPUSET)
+    else:
+        # isolatedパーティションを作った場合は、そのcpuset.cpus.effectiveがJUDGE_CPUSETになっている
+        cpus = read_cpu_list(CGROUP_ROOT, CGROUP_PARENT)
+    build_cpus = set(parse_cpu_list(JUDGE_BUILD_CPUSET))
+    return [cpu for cpu in cpus if cpu not in build_cpus]
+
+
+def create_cpu_allocator() -> CpuAllocator | None:
+    """
+    JUDGE_PIN_CPUS=falseの場合はNone(CPUを割り当てず、サンドボックスは全てのCPUを使う)
+    """
+    if not JUDGE_PIN_CPUS:
+        return None
+    return CpuAllocator(read_pinnable_cpus(), cpus_per_job=JUDGE_CPUS_PER_JOB)
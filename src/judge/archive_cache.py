@@ -0,0 +1,110 @@
+"""
+問題ごとのarranged_files(問題で用意されたファイル)のtarのキャッシュ
+
+arranged_filesは同じ問題の全ての提出で同じなので、提出のたびに読み込んでtarにするのは無駄である
+(採点バッチでは、同じ課題の提出が数百件続けてジャッジされる)。
+ArchiveCacheは、作成済みのtarのメンバー(iter_tar_membersの出力)を問題ごとにメモリに保持し、
+提出のアップロード時にそのまま流し込めるようにする。
+* 各ファイルのパス・サイズ・更新時刻が変わった場合は作り直す
+* 合計サイズがJUDGE_ARCHIVE_CACHE_MBを超えたら、最も長く使われていない問題のものから捨てる(LRU)
+"""
+from collections import OrderedDict
+from dotenv import load_dotenv
+from threading import Lock
+import os
+
+from .sandbox.execute import TarEntry, iter_tar_members
+from .metrics import judge_metrics
+
+load_dotenv()
+
+# キャッシュに使うメモリの上限[MB]。0の場合はキャッシュしない
+JUDGE_ARCHIVE_CACHE_MB = int(os.getenv("JUDGE_ARCHIVE_CACHE_MB", "256"))
+
+
+def fingerprint_of(entries: list[TarEntry]) -> tuple:
+    """
+    tarの内容が変わったことを検出するための値。ファイルの中身は読まず、statの結果だけを使う
+    """
+    fingerprint = []
+    for entry in entries:
+        stat = entry.srcInHost.stat()
+        fingerprint.append(
+            (str(entry.srcInHost), entry.arcname, entry.uid, entry.gid, entry.mode, stat.st_size, stat.st_mtime_ns)
+        )
+    return tuple(fingerprint)
+
+
+class ArchiveCache:
+    budget_bytes: int  # キャッシュに使うメモリの上限[バイト]
+    _archives: OrderedDict  # キー -> (fingerprint, tarのメンバー)。最近使われたものほど後ろ
+    _size: int  # 保持しているtarの合計サイズ[バイト]
+    _lock: Lock
+    _build_locks: dict  # キー -> 作成中のtarを、同時に複数のスレッドで作らないためのロック
+
+    def __init__(self, budget_mb: int = JUDGE_ARCHIVE_CACHE_MB):
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._archives = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+        self._build_locks = {}
+
+    def get(self, key, entries: list[TarEntry]) -> bytes | None:
+        """
+        entriesのtarのメンバーを返す。キャッシュに無い(か古い)場合は作成してキャッシュする。
+        ファイルが読めない場合や、上限より大きい場合はNoneを返す(呼び出し側でentriesを直接アップロードすること)
+        """
+        if self.budget_bytes <= 0:
+            return None
+        try:
+            fingerprint = fingerprint_of(entries)
+        except OSError:
+            return None
+
+        archive = self._lookup(key, fingerprint)
+        if archive is not None:
+            judge_metrics.increment("archive_cache_hits")
+            return archive
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, Lock())
+        with build_lock:
+            # 待っている間に他のスレッドが作成していれば、それを使う
+            archive = self._lookup(key, fingerprint)
+            if archive is not None:
+                judge_metrics.increment("archive_cache_hits")
+                return archive
+
+            judge_metrics.increment("archive_cache_misses")
+            try:
+                archive = b"".join(iter_tar_members(entries))
+            except OSError:
+                return None
+            if len(archive) > self.budget_bytes:
+                return None
+            self._store(key, fingerprint, archive)
+            return archive
+
+    def _lookup(self, key, fingerprint: tuple) -> bytes | None:
+        with self._lock:
+            cached = self._archives.get(key)
+            if cached is None or cached[0] != fingerprint:
+                return None
+            self._archives.move_to_end(key)
+            return cached[1]
+
+    def _store(self, key, fingerprint: tuple, archive: bytes) -> None:
+        with self._lock:
+            old = self._archives.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._archives[key] = (fingerprint, archive)
+            self._size += len(archive)
+            while self._size > self.budget_bytes:
+                _, (_, evicted) = self._archives.popitem(last=False)
+                self._size -= len(evicted)
+            judge_metrics.set("archive_cache_bytes", self._size)
+
+
+# (lecture_id, assignment_id, eval) -> arranged_filesのtarのメンバー
+arranged_files_cache = ArchiveCache()
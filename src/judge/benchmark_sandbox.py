@@ -0,0 +1,88 @@
+# サンドボックスのバックエンドごとの、1回のジャッジにかかるサンドボックス操作の時間を計測する
+# 実行方法
+# $ cd src
+# $ sudo python -m judge.benchmark_sandbox --backend docker native -n 20
+import argparse
+import statistics
+import time
+
+from .sandbox.backend import SandboxBackend
+from .sandbox.execute import VolumeMountInfo
+from .sandbox_backend import create_sandbox_backend
+from .container_pool import BUILD_IMAGE, JUDGE_CONTAINER_ARGUMENTS, CGROUP_PARENT
+
+PHASES = ["create_volume", "create_container", "start", "exec", "remove"]
+
+
+def run_once(backend: SandboxBackend, command: list[str]) -> dict[str, float]:
+    """
+    ボリューム作成 -> コンテナ作成 -> 起動 -> コマンド実行 -> 削除 の各段階の時間[ms]
+    """
+    elapsed: dict[str, float] = {}
+
+    start = time.perf_counter()
+    volume, err = backend.create_volume()
+    if not err.silence():
+        raise RuntimeError(err.message)
+    elapsed["create_volume"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    container = backend.create_container(
+        imageName=BUILD_IMAGE,
+        arguments=JUDGE_CONTAINER_ARGUMENTS,
+        cgroupParent=CGROUP_PARENT,
+        user="root",
+        groups=["root"],
+        memoryLimitMB=512,
+        pidsLimit=100,
+        volumeMountInfoList=[VolumeMountInfo(path="/home/guest", volume=volume, read_only=False)],
+    )
+    elapsed["create_container"] = (time.perf_counter() - start) * 1000
+
+    try:
+        start = time.perf_counter()
+        err = container.start()
+        if not err.silence():
+            raise RuntimeError(err.message)
+        elapsed["start"] = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        result, err = container.exec_run(command=command, user="root", timeoutSec=10.0)
+        if not err.silence() or result.exitCode != 0:
+            raise RuntimeError(f"{err.message} {result}")
+        elapsed["exec"] = (time.perf_counter() - start) * 1000
+    finally:
+        start = time.perf_counter()
+        container.remove()
+        volume.remove()
+        elapsed["remove"] = (time.perf_counter() - start) * 1000
+
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="サンドボックスのバックエンドのベンチマーク")
+    parser.add_argument("--backend", nargs="+", default=["docker", "native"], help="計測するバックエンド")
+    parser.add_argument("-n", type=int, default=20, help="計測回数")
+    parser.add_argument("--command", nargs="+", default=["true"], help="コンテナ内で実行するコマンド")
+    args = parser.parse_args()
+
+    for name in args.backend:
+        backend = create_sandbox_backend(name)
+        # 1回目はイメージの読み込みなどを含むので、計測しない
+        run_once(backend, args.command)
+        samples = [run_once(backend, args.command) for _ in range(args.n)]
+
+        print(f"== {name} (n={args.n}) [ms]")
+        print(f"{'phase':<18}{'mean':>10}{'median':>10}{'p95':>10}")
+        for phase in PHASES + ["total"]:
+            if phase == "total":
+                values = sorted(sum(sample.values()) for sample in samples)
+            else:
+                values = sorted(sample[phase] for sample in samples)
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            print(f"{phase:<18}{statistics.mean(values):>10.1f}{statistics.median(values):>10.1f}{p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# watchdogのタイムアウトの精度と、1つのサンドボックスあたりのwatchdogのオーバーヘッドを計測する
+# (サンドボックスの外で、ビルドしたwatchdogを直接実行する)
+# 実行方法
+# $ g++ -O2 -o /tmp/watchdog langs/watchdog.cpp
+# $ cd src
+# $ python -m judge.benchmark_watchdog --watchdog /tmp/watchdog -n 20
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import time
+
+CASES = ["tle_overshoot", "task_overhead", "idle_cpu"]
+
+
+def make_task(command: str, timeoutMS: int) -> dict:
+    return {
+        "command": command,
+        "stdin": "",
+        "timeoutMS": timeoutMS,
+        "memoryLimitMB": 0,
+        "uid": os.getuid(),
+        "gid": os.getgid(),
+    }
+
+
+def run_watchdog(watchdog: str, tasks: list[dict]) -> tuple[list[dict], float, float]:
+    """
+    watchdogでtasksを実行し、(結果のリスト, 経過時間[ms], watchdogと子プロセスが使ったCPU時間[ms]) を返す
+    """
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    completed = subprocess.run([watchdog], input=json.dumps(tasks), capture_output=True, text=True, check=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (usage_after.ru_utime + usage_after.ru_stime - usage_before.ru_utime - usage_before.ru_stime) * 1000
+
+    # 1タスクにつき1行のJSONが出力される
+    results = [json.loads(line) for line in completed.stdout.splitlines() if line.startswith("{")]
+    if len(results) != len(tasks):
+        raise RuntimeError(f"unexpected watchdog output: {completed.stdout} {completed.stderr}")
+    return results, elapsed, cpu
+
+
+def run_once(watchdog: str, timeoutMS: int, batch: int) -> dict[str, float]:
+    samples: dict[str, float] = {}
+
+    # TLEを検知するまでの遅れ: 報告されたtimeMS - timeoutMS
+    results, _, _ = run_watchdog(watchdog, [make_task("sleep 10", timeoutMS)])
+    if not results[0]["TLE"]:
+        raise RuntimeError(f"expected TLE: {results[0]}")
+    samples["tle_overshoot"] = results[0]["timeMS"] - timeoutMS
+
+    # すぐ終わるタスクをまとめて実行した場合の、1タスクあたりの時間
+    _, elapsed, _ = run_watchdog(watchdog, [make_task("true", 1000)] * batch)
+    samples["task_overhead"] = elapsed / batch
+
+    # 何もしないタスクを待っている間に、watchdogが1秒あたりに使うCPU時間
+    _, elapsed, cpu = run_watchdog(watchdog, [make_task("sleep 1", 2000)])
+    samples["idle_cpu"] = cpu / (elapsed / 1000)
+
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="watchdogのベンチマーク")
+    parser.add_argument("--watchdog", nargs="+", required=True, help="計測するwatchdogの実行ファイル(複数指定すると比較する)")
+    parser.add_argument("-n", type=int, default=20, help="計測回数")
+    parser.add_argument("--timeout-ms", type=int, default=500, help="tle_overshootで使うタイムアウト[ms]")
+    parser.add_argument("--batch", type=int, default=50, help="task_overheadで1回に実行するタスク数")
+    args = parser.parse_args()
+
+    for watchdog in args.watchdog:
+        samples = [run_once(watchdog, args.timeout_ms, args.batch) for _ in range(args.n)]
+
+        print(f"== {watchdog} (n={args.n})")
+        print(f"{'case':<24}{'mean':>10}{'median':>10}{'p95':>10}")
+        for case, unit in zip(CASES, ["ms", "ms/task", "ms/sec"]):
+            values = sorted(sample[case] for sample in samples)
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            print(f"{case + ' [' + unit + ']':<24}{statistics.mean(values):>10.1f}{statistics.median(values):>10.1f}{p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
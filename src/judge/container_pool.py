@@ -0,0 +1,336 @@
+"""
+起動済みのサンドボックスを使い回すコンテナプール
+
+ジャッジごとに ボリューム作成 -> ビルド用コンテナの作成・起動 -> 削除 -> 実行用コンテナの作成・起動 を
+行うと、テストを始める前にDockerデーモンとのやり取りで数百ミリ秒かかる。
+ContainerPoolは、作業用ボリュームと、それをマウントした起動済みのビルド用・実行用コンテナの組(SandboxSet)を
+あらかじめJUDGE_CONTAINER_POOL_SIZE組用意しておき、ジャッジに貸し出す。
+* 貸し出し時に、ジャッジごとに異なるメモリーリミットと専有CPUを docker update で設定する
+* プールのコンテナは、ルートファイルシステムを読み取り専用にし、書き込めるパス(/tmpなど)は全てtmpfsか作業用ボリュームにする。
+  前の提出が書き込んだファイルが、次の(別の学生の)提出から見えないようにするため
+* 返却されたSandboxSetは、残っているプロセスをkillし、tmpfs・IPCオブジェクト・作業用ボリュームを初期状態に戻してから再利用する。
+  コンテナが止まっている(タイムアウトでkillされたなど)場合や、JUDGE_CONTAINER_POOL_MAX_USES回使った場合は破棄し、
+  新しく作り直す
+* リセット・作り直しはプール専用のスレッドで行うので、ジャッジの処理時間には含まれない
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import threading
+import os
+
+from .sandbox.backend import SandboxContainer, SandboxVolume
+from .sandbox.execute import VolumeMountInfo
+from .sandbox.my_error import Error
+from .admission import BUILD_CONTAINER_MEMORY_MB
+from .volume_pool import create_working_volume
+from .sandbox_backend import get_sandbox_backend
+from .log.config import judge_logger
+
+load_dotenv()
+
+CGROUP_PARENT = os.getenv("CGROUP_PARENT")
+# プールに用意しておくSandboxSetの数。0の場合はプールを使わず、ジャッジごとにコンテナを作成する
+JUDGE_CONTAINER_POOL_SIZE = int(os.getenv("JUDGE_CONTAINER_POOL_SIZE", "0"))
+# 1つのSandboxSetを使い回す回数の上限
+JUDGE_CONTAINER_POOL_MAX_USES = int(os.getenv("JUDGE_CONTAINER_POOL_MAX_USES", "100"))
+
+BUILD_IMAGE = "checker-lang-gcc"
+RUNNER_IMAGE = "binary-runner"
+
+# プールのコンテナで、ゲストユーザーが書き込める(イメージ内で誰でも書き込める)パスにマウントするtmpfs。
+# ルートファイルシステムは読み取り専用にするので、それ以外のパスには書き込めない
+POOL_TMPFS_MOUNTS = {
+    "/tmp": "rw,nosuid,nodev,mode=1777,size=256m",
+    "/var/tmp": "rw,nosuid,nodev,mode=1777,size=64m",
+    "/run/lock": "rw,nosuid,nodev,noexec,mode=1777,size=1m",
+}
+
+# 返却されたコンテナを初期状態に戻すコマンド
+# kill -9 -1 は、PID 1(sleep)とシェル自身以外の全てのプロセスをkillする。
+# その後、書き込める場所(tmpfs, /dev/shm, POSIXメッセージキュー)を空にし、System VのIPCオブジェクトを削除する
+RESET_PROCESSES_COMMAND = [
+    "sh", "-c",
+    "kill -9 -1 2>/dev/null; "
+    f"find {' '.join(POOL_TMPFS_MOUNTS)} /dev/shm /dev/mqueue -mindepth 1 -delete; "
+    "ipcrm --all 2>/dev/null; exit 0"
+]
+# 作業用ボリューム(/home/guest)を空にし、ボリューム作成直後と同じく/etc/skelの内容だけにする
+RESET_WORKDIR_COMMAND = [
+    "sh", "-c",
+    "find /home/guest -mindepth 1 -delete && cp -a /etc/skel/. /home/guest/ && chown -R guest:guest /home/guest"
+]
+
+
+# ジャッジごとに作成するコンテナは最大1時間起動し、プールのコンテナは削除するまで起動し続ける
+JUDGE_CONTAINER_ARGUMENTS = ["sleep", "3600"]
+POOL_CONTAINER_ARGUMENTS = ["sleep", "infinity"]
+
+
+def create_build_container(
+    working_volume: SandboxVolume,
+    cpuset: list[int] | None = None,
+    arguments: list[str] = JUDGE_CONTAINER_ARGUMENTS,
+    resource_mount: VolumeMountInfo | None = None,
+    read_only_rootfs: bool = False,
+) -> SandboxContainer:
+    """
+    コンパイル用のコンテナを作成する(起動はしない)
+    resource_mountには、問題のリソースボリュームの(読み取り専用の)マウントを指定できる
+    read_only_rootfs=Trueの場合は、ルートファイルシステムを読み取り専用にし、POOL_TMPFS_MOUNTSにtmpfsをマウントする
+    """
+    return get_sandbox_backend().create_container(
+        imageName=BUILD_IMAGE,
+        arguments=arguments,
+        cgroupParent=CGROUP_PARENT,
+        user="root",
+        groups=["root"],
+        cpuset=cpuset,
+        memoryLimitMB=BUILD_CONTAINER_MEMORY_MB,
+        pidsLimit=100,
+        workDir="/home/guest",
+        volumeMountInfoList=[
+            VolumeMountInfo(path="/home/guest", volume=working_volume, read_only=False)
+        ] + ([resource_mount] if resource_mount is not None else []),
+        readOnlyRootfs=read_only_rootfs,
+        tmpfsMounts=POOL_TMPFS_MOUNTS if read_only_rootfs else None,
+    )
+
+
+def create_runner_container(
+    working_volume: SandboxVolume,
+    memoryLimitMB: int,
+    cpuset: list[int] | None = None,
+    arguments: list[str] = JUDGE_CONTAINER_ARGUMENTS,
+    resource_mount: VolumeMountInfo | None = None,
+    source_mount: VolumeMountInfo | None = None,
+    read_only_rootfs: bool = False,
+) -> SandboxContainer:
+    """
+    実行用のコンテナを作成する(起動はしない)
+    resource_mountには、問題のリソースボリュームの(読み取り専用の)マウントを指定できる
+    source_mountには、ビルド結果をコピーしてくる作業用ボリュームの(読み取り専用の)マウントを指定できる
+    read_only_rootfsはcreate_build_containerと同じ
+    """
+    return get_sandbox_backend().create_container(
+        imageName=RUNNER_IMAGE,
+        arguments=arguments,
+        cgroupParent=CGROUP_PARENT,
+        user="root",
+        groups=["root"],
+        cpuset=cpuset,
+        memoryLimitMB=memoryLimitMB,
+        pidsLimit=100,
+        workDir="/home/guest",
+        volumeMountInfoList=[
+            VolumeMountInfo(path="/home/guest", volume=working_volume, read_only=False)
+        ] + [mount for mount in (resource_mount, source_mount) if mount is not None],
+        readOnlyRootfs=read_only_rootfs,
+        tmpfsMounts=POOL_TMPFS_MOUNTS if read_only_rootfs else None,
+    )
+
+
+class SandboxSet:
+    volume: SandboxVolume  # /home/guestにマウントする作業用ボリューム
+    build_container: SandboxContainer  # 起動済みのビルド用コンテナ
+    runner_container: SandboxContainer  # 起動済みの実行用コンテナ
+    uses: int  # 貸し出した回数
+
+    def __init__(self, volume: SandboxVolume, build_container: SandboxContainer, runner_container: SandboxContainer):
+        self.volume = volume
+        self.build_container = build_container
+        self.runner_container = runner_container
+        self.uses = 0
+
+    @classmethod
+    def create(cls) -> tuple["SandboxSet | None", Error]:
+        volume, err = create_working_volume()
+        if not err.silence():
+            return None, err
+
+        containers: list[SandboxContainer] = []
+        try:
+            # 別の提出に使い回すので、ルートファイルシステムに書き込めないようにする
+            containers.append(create_build_container(volume, arguments=POOL_CONTAINER_ARGUMENTS, read_only_rootfs=True))
+            # メモリーリミットは貸し出し時に設定する
+            containers.append(create_runner_container(
+                volume, memoryLimitMB=BUILD_CONTAINER_MEMORY_MB, arguments=POOL_CONTAINER_ARGUMENTS, read_only_rootfs=True
+            ))
+            for container in containers:
+                err = container.start()
+                if not err.silence():
+                    raise RuntimeError(err.message)
+        except Exception as e:
+            for container in containers:
+                container.remove()
+            volume.remove()
+            return None, Error(f"Failed to create sandbox set: {e}")
+
+        return SandboxSet(volume, containers[0], containers[1]), Error.Nothing()
+
+    def reset(self) -> Error:
+        """
+        返却されたSandboxSetを初期状態に戻す
+        """
+        for container in (self.build_container, self.runner_container):
+            if container.get_status() != "running":
+                return Error(f"container {container.containerID} is not running")
+            result, err = container.exec_run(RESET_PROCESSES_COMMAND, user="root", timeoutSec=10.0)
+            if not err.silence():
+                return err
+        result, err = self.build_container.exec_run(RESET_WORKDIR_COMMAND, user="root", timeoutSec=30.0)
+        if not err.silence():
+            return err
+        if result.exitCode != 0:
+            return Error(f"Failed to reset working volume: {result.stderr}")
+        return Error.Nothing()
+
+    def remove(self) -> Error:
+        err = Error.Nothing()
+        for container in (self.build_container, self.runner_container):
+            container_err = container.remove()
+            if not container_err.silence():
+                err = container_err
+        # コンテナを削除してからでないとボリュームは削除できない
+        volume_err = self.volume.remove()
+        if not volume_err.silence():
+            err = volume_err
+        return err
+
+
+class ContainerPool:
+    size: int  # 維持するSandboxSetの数(待機中 + 貸し出し中 + リセット・作成中)
+    max_uses: int
+    _ready: deque[SandboxSet]  # 待機中のSandboxSet
+    _live: int  # 存在するSandboxSetの数
+    _closed: bool
+    _lock: threading.Lock
+    _executor: ThreadPoolExecutor  # SandboxSetの作成・リセット・削除を行うスレッド
+
+    def __init__(self, size: int = JUDGE_CONTAINER_POOL_SIZE, max_uses: int = JUDGE_CONTAINER_POOL_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._ready = deque()
+        self._live = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="container-pool")
+
+    def start(self) -> None:
+        """
+        バックグラウンドでSandboxSetを用意し始める
+        """
+        self._replenish()
+
+    def _replenish(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            shortage = self.size - self._live
+            self._live += max(0, shortage)
+        for _ in range(shortage):
+            self._executor.submit(self._create_into_pool)
+
+    def _create_into_pool(self) -> None:
+        sandbox_set, err = SandboxSet.create()
+        with self._lock:
+            if sandbox_set is None or self._closed:
+                self._live -= 1
+            else:
+                self._ready.append(sandbox_set)
+                sandbox_set = None
+        if not err.silence():
+            # Dockerデーモンの異常などで作成に失敗した場合は、次の貸し出し・返却まで作り直さない
+            judge_logger.error(f"container pool: {err.message}")
+        if sandbox_set is not None:
+            sandbox_set.remove()
+
+    def acquire(self, runner_memory_mb: int, cpuset: list[int] | None = None) -> tuple[SandboxSet | None, Error]:
+        """
+        SandboxSetを貸し出す。待機中のものが無ければ、その場で作成する。
+        実行用コンテナのメモリーリミットをrunner_memory_mb[MB]にし、両方のコンテナをcpusetのCPUに固定する
+        (cpuset=Noneの場合は、CPUの設定を変更しない)。
+        """
+        with self._lock:
+            sandbox_set = self._ready.popleft() if len(self._ready) > 0 else None
+            if sandbox_set is None:
+                self._live += 1
+
+        if sandbox_set is None:
+            judge_logger.info("container pool is empty. creating a new sandbox set...")
+            sandbox_set, err = SandboxSet.create()
+            if sandbox_set is None:
+                with self._lock:
+                    self._live -= 1
+                return None, err
+
+        err = sandbox_set.build_container.update_limits(cpuset=cpuset)
+        if err.silence():
+            err = sandbox_set.runner_container.update_limits(memoryLimitMB=runner_memory_mb, cpuset=cpuset)
+        if not err.silence():
+            self._discard(sandbox_set)
+            return None, err
+
+        sandbox_set.uses += 1
+        return sandbox_set, Error.Nothing()
+
+    def release(self, sandbox_set: SandboxSet, broken: bool = False) -> None:
+        """
+        SandboxSetを返却する。リセットはバックグラウンドで行う。
+        broken=Trueの場合(ジャッジ中に内部エラーが起きた場合など)は再利用せずに破棄する
+        """
+        try:
+            self._executor.submit(self._recycle, sandbox_set, broken)
+        except RuntimeError:
+            # close()済みの場合
+            sandbox_set.remove()
+            with self._lock:
+                self._live -= 1
+
+    def _recycle(self, sandbox_set: SandboxSet, broken: bool) -> None:
+        reusable = not broken and sandbox_set.uses < self.max_uses
+        if reusable:
+            err = sandbox_set.reset()
+            if not err.silence():
+                judge_logger.warning(f"container pool: failed to reset sandbox set. discarding... ({err.message})")
+                reusable = False
+
+        with self._lock:
+            # 貸し出し中に、待機中のものが無くてその場で作ったことで増えすぎていれば減らす
+            if reusable and not self._closed and self._live <= self.size:
+                self._ready.append(sandbox_set)
+                return
+
+        self._discard(sandbox_set)
+
+    def _discard(self, sandbox_set: SandboxSet) -> None:
+        err = sandbox_set.remove()
+        if not err.silence():
+            judge_logger.error(f"container pool: failed to remove sandbox set: {err.message}")
+        with self._lock:
+            self._live -= 1
+        self._replenish()
+
+    def close(self) -> None:
+        """
+        新しいSandboxSetの作成をやめ、作成中・リセット中のものを待ってから、待機中のSandboxSetを全て削除する。
+        貸し出し中のものは、返却時に削除される。
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            ready = list(self._ready)
+            self._ready.clear()
+            self._live -= len(ready)
+        for sandbox_set in ready:
+            sandbox_set.remove()
+
+
+def create_container_pool() -> ContainerPool | None:
+    """
+    JUDGE_CONTAINER_POOL_SIZE=0の場合はNone(プールを使わない)
+    """
+    if JUDGE_CONTAINER_POOL_SIZE <= 0:
+        return None
+    return ContainerPool()
@@ -1,10 +1,12 @@
 # Create, Read, Update and Delete (CRUD)
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, func, case, text, Engine
 from pathlib import Path
 from pprint import pp
 from sqlalchemy import inspect
 from datetime import datetime, timedelta
+from typing import Callable
+import uuid
 
 from . import models, records
 
@@ -21,26 +23,194 @@ def define_crud_logger(logger: logging.Logger):
 # ----------------------- for judge server --------------------------------------
 
 
-# Submissionテーブルから、statusが"queued"のジャッジリクエストを数件取得し、statusを"running"
-# に変え、変更したリクエスト(複数)を返す
+# 既存のDBのSubmissionテーブルに、複数台のジャッジサーバーでclaimするための列を追加する(列名 -> MySQLでの列の定義)
+# DBを新しく作る場合は、db/init.sqlのSubmissionテーブルにも同じ列を追加しておくこと
+SUBMISSION_CLAIM_COLUMNS = {
+    "claimed_by": "VARCHAR(255) NULL DEFAULT NULL",
+    "lease_expires_at": "DATETIME NULL DEFAULT NULL",
+    "claim_token": "VARCHAR(32) NULL DEFAULT NULL",
+    # claimの仕組みが無い古いジャッジサーバーによる更新でも変わるように、DB側で更新日時を記録する。
+    # 既存の行は列を追加した日時になるので、その時点で"running"の行も、すぐには取得し直されない
+    "updated_at": "DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP",
+}
+
+
+# ジャッジサーバーの起動時に実行し、SUBMISSION_CLAIM_COLUMNSのうちまだ無い列だけをALTER TABLEで追加する。
+# 追加した列名のリストを返す。何度実行してもよく、他のジャッジサーバーが同時に追加した場合もそのまま続ける
+def add_submission_claim_columns(engine: Engine) -> list[str]:
+    def existing_columns() -> set[str]:
+        return {column["name"] for column in inspect(engine).get_columns("Submission")}
+
+    added_column_list = []
+    for name, definition in SUBMISSION_CLAIM_COLUMNS.items():
+        if name in existing_columns():
+            continue
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE Submission ADD COLUMN {name} {definition}"))
+        except Exception:
+            # 他のジャッジサーバーが先に追加した場合は、エラーになっても列はある
+            if name not in existing_columns():
+                raise
+            continue
+        CRUD_LOGGER.info(f"Submissionテーブルに{name}列を追加しました")
+        added_column_list.append(name)
+    return added_column_list
+
+
+# Submissionテーブルから、statusが"queued"のジャッジリクエスト(及びclaimの有効期限が切れた
+# "running"のジャッジリクエスト)を数件取得し、statusを"running"に変え、node_idのジャッジサーバーが
+# claimしたものとして、変更したリクエスト(複数)を返す
+#
+# rank: 候補全体をclaimしたい順に並べる関数(ジョブスケジューラー。状態を変えてはいけない)。
+#         返した順に(他のジャッジサーバーが取った行を飛ばして)n件をclaimする。
+#         返した順番がそのまま戻り値の順番になる。Noneの場合は古い順にn件。
+# charge: (候補のリスト, 実際にclaimしたもののリスト)を受け取り、スケジューラーの状態を進める関数。
+#         コミットに成功した後に呼ぶ。
+# candidate_limit: Noneの場合、候補は古い順にn件。指定した場合、候補は優先度クラス
+#         (学生の提出 / 採点用のバッチ)ごとに最大candidate_limit件で、各ユーザーの古い方から
+#         最大n件ずつを、ユーザー間で交互になるように取る。
+# leaseless_reclaim_sec: 有効期限の無い"running"のジャッジリクエストは、この秒数以上更新されていない場合だけ取得し直す。
+# order_by_deadline: Trueの場合、候補は締め切り(Lecture.end_date)が早い順に最大candidate_limit件
+#         (締め切り後の提出は最後)。
 def fetch_queued_judge_and_change_status_to_running(
-    db: Session, n: int
+    db: Session,
+    n: int,
+    node_id: str,
+    lease_sec: int,
+    leaseless_reclaim_sec: int,
+    rank: Callable[[list[records.QueuedSubmission]], list[records.QueuedSubmission]] | None = None,
+    charge: Callable[[list[records.QueuedSubmission], list[records.QueuedSubmission]], None] | None = None,
+    candidate_limit: int | None = None,
+    order_by_deadline: bool = False,
 ) -> list[records.Submission]:
     # CRUD_LOGGER.debug("fetch_queued_judgeが呼び出されました")
+    if n <= 0:
+        return []
     try:
-        # FOR UPDATE NOWAITを使用して排他的にロックを取得
-        # CRUD_LOGGER.debug("FOR UPDATE NOWAITを使用して排他的にロックを取得")
-        submission_list = (
-            db.query(models.Submission)
-            .filter(models.Submission.progress == "queued")
-            .with_for_update(nowait=False)
-            .limit(n)
-            .all()
+        now = datetime.now()
+        claimable = or_(
+            models.Submission.progress == "queued",
+            # claimしたジャッジサーバーが落ちたなどで、有効期限が切れたもの
+            # 有効期限の無いものは、claimの仕組みを持たない古いジャッジサーバーが実行している(いた)もの。
+            # ローリングアップデート中に実行中のものを奪わないように、leaseless_reclaim_sec以上更新されていない場合だけ取得し直す
+            # (古いジャッジサーバーも、テストケースを実行するたびに進捗を更新する)
+            and_(
+                models.Submission.progress == "running",
+                or_(
+                    models.Submission.lease_expires_at < now,
+                    and_(
+                        models.Submission.lease_expires_at.is_(None),
+                        models.Submission.updated_at < now - timedelta(seconds=leaseless_reclaim_sec),
+                    ),
+                ),
+            ),
+        )
+        # 締め切りまでに提出されたものは、その締め切り(Lecture.end_date)。締め切り後の提出はNULL
+        deadline = case(
+            (models.Submission.ts <= models.Lecture.end_date, models.Lecture.end_date),
+            else_=None,
         )
+        query = (
+            db.query(models.Submission, deadline.label("deadline"))
+            .outerjoin(models.Lecture, models.Lecture.id == models.Submission.lecture_id)
+        )
+        if candidate_limit is None:
+            query = query.filter(claimable).order_by(models.Submission.id).limit(n)
+        elif order_by_deadline:
+            query = (
+                query.filter(claimable)
+                .order_by(deadline.is_(None), deadline, models.Submission.id)
+                .limit(candidate_limit)
+            )
+        else:
+            # 注) scheduler.job_class_ofと同じ基準で優先度クラスを分ける
+            is_batch = or_(
+                models.Submission.eval == True,
+                models.Submission.evaluation_status_id.is_not(None),
+            )
+            # 各ユーザーの中での古い順の順位
+            user_ranked = (
+                db.query(
+                    models.Submission.id.label("id"),
+                    is_batch.label("is_batch"),
+                    func.row_number().over(
+                        partition_by=[is_batch, models.Submission.user_id],
+                        order_by=models.Submission.id,
+                    ).label("user_rank"),
+                )
+                .filter(claimable)
+                .subquery()
+            )
+            # 優先度クラスの中で、(ユーザー内の順位, ID)の順に並べた順位
+            class_ranked = (
+                db.query(
+                    user_ranked.c.id.label("id"),
+                    func.row_number().over(
+                        partition_by=user_ranked.c.is_batch,
+                        order_by=[user_ranked.c.user_rank, user_ranked.c.id],
+                    ).label("class_rank"),
+                )
+                .filter(user_ranked.c.user_rank <= n)
+                .subquery()
+            )
+            query = (
+                query.join(class_ranked, models.Submission.id == class_ranked.c.id)
+                .filter(class_ranked.c.class_rank <= candidate_limit)
+                .order_by(models.Submission.id)
+            )
+
+        # 候補はロックせずに読む(候補の範囲全体をロックすると、他のジャッジサーバーがclaimできる行まで塞いでしまう)
+        candidate_list = query.all()
+        # CRUD_LOGGER.debug(f"取得した候補の数: {len(candidate_list)}")
+
+        deadline_dict = {submission.id: deadline for submission, deadline in candidate_list}
+        # 候補全体に、claimしたい順の順位を付ける
+        queued_submission_list = []
+        for submission, deadline in candidate_list:
+            queued_submission = records.QueuedSubmission.model_validate(submission)
+            queued_submission.deadline = deadline
+            queued_submission_list.append(queued_submission)
+        if rank is None:
+            ranked_id_list = [submission.id for submission in queued_submission_list]
+        else:
+            ranked_id_list = [ranked.id for ranked in rank(queued_submission_list)]
+
+        # 上位の行だけをFOR UPDATE SKIP LOCKEDでロックする。他のジャッジサーバーがロック中の行は飛ばし、
+        # 候補を読んだ後にclaimされた行は条件を満たさないので除く(ロックを取る読み込みは最新の値を見る)。
+        # 飛ばした分は次の順位の行で埋める(同じ順位付けをする他のジャッジサーバーと、締め切りの早い行を取り合っても
+        # 空振りしない)。n件に達した後の候補はロックせず、queuedのまま残る
+        submission_list = []
+        offset = 0
+        while len(submission_list) < n and offset < len(ranked_id_list):
+            batch_id_list = ranked_id_list[offset:offset + n - len(submission_list)]
+            offset += len(batch_id_list)
+            locked_dict = {
+                submission.id: submission
+                for submission in db.query(models.Submission)
+                .filter(models.Submission.id.in_(batch_id_list), claimable)
+                .with_for_update(skip_locked=True)
+                .populate_existing()
+                .all()
+            }
+            submission_list += [locked_dict[submission_id] for submission_id in batch_id_list if submission_id in locked_dict]
         # CRUD_LOGGER.debug(f"取得したSubmissionの数: {len(submission_list)}")
 
+        reclaimed_id_list = [
+            submission.id for submission in submission_list if submission.progress == "running"
+        ]
+        if len(reclaimed_id_list) > 0:
+            CRUD_LOGGER.warning(f"claimの有効期限が切れたSubmissionを再取得します: {reclaimed_id_list}")
+            # 途中まで登録されていたJudgeResultを削除する
+            db.query(models.JudgeResult).filter(
+                models.JudgeResult.submission_id.in_(reclaimed_id_list)
+            ).delete(synchronize_session=False)
+
         for submission in submission_list:
             submission.progress = "running"
+            submission.claimed_by = node_id
+            submission.lease_expires_at = now + timedelta(seconds=lease_sec)
+            submission.claim_token = uuid.uuid4().hex
             # total_task（実行しなければならないTestCaseの数）を求める
             # CRUD_LOGGER.debug(f"total_taskを求めるためにTestCasesテーブルをクエリ")
             submission_total_task = (
@@ -59,18 +229,49 @@ def fetch_queued_judge_and_change_status_to_running(
             submission.completed_task = 0
 
         db.commit()
-        return [
+        if charge is not None:
+            # スケジューラーには、実際にclaimした分だけを反映する
+            queued_submission_dict = {submission.id: submission for submission in queued_submission_list}
+            charge(queued_submission_list, [queued_submission_dict[submission.id] for submission in submission_list])
+        submission_record_list = [
             # sqlalchemyのrelationshipのlazy loadingにより
             # uploaded_filesが埋まる
             records.Submission.model_validate(submission)
             for submission in submission_list
         ]
+        for submission_record in submission_record_list:
+            submission_record.deadline = deadline_dict[submission_record.id]
+        return submission_record_list
     except Exception as e:
         db.rollback()
         CRUD_LOGGER.error(f"fetch_queued_judgeでエラーが発生しました: {str(e)}")
         return []
 
 
+# ハートビート: node_idのジャッジサーバーがclaimしている"running"のジャッジリクエストについて、
+# claimの有効期限を延長する。延長できたリクエストのIDのリストを返す。
+# 返り値に含まれないIDは、有効期限切れにより他のジャッジサーバーに取得し直されている。
+def renew_submission_leases(
+    db: Session, node_id: str, submission_id_list: list[int], lease_sec: int
+) -> list[int]:
+    if len(submission_id_list) == 0:
+        return []
+    owned_submissions = (
+        db.query(models.Submission)
+        .filter(
+            models.Submission.id.in_(submission_id_list),
+            models.Submission.progress == "running",
+            models.Submission.claimed_by == node_id,
+        )
+        .all()
+    )
+    lease_expires_at = datetime.now() + timedelta(seconds=lease_sec)
+    for submission in owned_submissions:
+        submission.lease_expires_at = lease_expires_at
+    db.commit()
+    return [submission.id for submission in owned_submissions]
+
+
 # lecture_id, assignment_idのデータから、それに対応するProblemデータを全て取得する
 # eval=Trueの場合は、評価用のデータも取得する
 def fetch_problem(
@@ -102,71 +303,109 @@ def fetch_problem(
         return None
 
 
-def update_submission_status_and_progress(db: Session, submission_record: records.Submission) -> None:
+# testcase_id_listのテストケースについて、JudgeResultテーブルから
+# testcase_id -> (実行回数, 失敗回数, 平均実行時間[ms]) を集計する (内部エラーの結果は除く)
+def fetch_testcase_stats(
+    db: Session, testcase_id_list: list[int]
+) -> dict[int, tuple[int, int, float]]:
+    if len(testcase_id_list) == 0:
+        return {}
+    rows = (
+        db.query(
+            models.JudgeResult.testcase_id,
+            func.count(models.JudgeResult.id),
+            func.sum(case((models.JudgeResult.result != "AC", 1), else_=0)),
+            func.avg(models.JudgeResult.timeMS),
+        )
+        .filter(
+            models.JudgeResult.testcase_id.in_(testcase_id_list),
+            models.JudgeResult.result != "IE",
+        )
+        .group_by(models.JudgeResult.testcase_id)
+        .all()
+    )
+    return {
+        testcase_id: (int(runs), int(failures or 0), float(mean_time_ms or 0))
+        for testcase_id, runs, failures, mean_time_ms in rows
+    }
+
+
+def _owned_running_submission(db: Session, submission_record: records.Submission):
+    # submission_recordのclaim(claim_token)が、まだ有効な"running"のジャッジリクエスト。
+    # 有効期限切れで取得し直された後は、取得し直したのが同じジャッジサーバーであっても、元のclaimからは更新できない
+    return db.query(models.Submission).filter(
+        models.Submission.id == submission_record.id,
+        models.Submission.claim_token == submission_record.claim_token,
+        models.Submission.progress == "running",
+    )
+
+
+def update_submission_status_and_progress(db: Session, submission_record: records.Submission) -> bool:
     """
     progress, completed_task, total_task, resultのみ更新する
+    claimを失っている場合は更新せずにFalseを返す
     """
-    raw_submission_record = (
-        db.query(models.Submission)
-        .filter(models.Submission.id == submission_record.id)
-        .first()
+    updated = _owned_running_submission(db, submission_record).update(
+        {
+            models.Submission.progress: submission_record.progress.value,
+            models.Submission.completed_task: submission_record.completed_task,
+            models.Submission.total_task: submission_record.total_task,
+            models.Submission.result: submission_record.result.value,
+        },
+        synchronize_session=False,
     )
-    if raw_submission_record is None:
-        raise ValueError(f"Submission with id {submission_record.id} not found")
-    
-    raw_submission_record.progress = submission_record.progress.value
-    raw_submission_record.completed_task = submission_record.completed_task
-    raw_submission_record.total_task = submission_record.total_task
-    raw_submission_record.result = submission_record.result.value
     db.commit()
+    return updated == 1
 
 
-# 特定のSubmissionに対応するジャッジリクエストの属性値を変更する
-# 注) SubmissionRecord.idが同じレコードがテーブル内にあること
-def update_submission_record(db: Session, submission_record: records.Submission) -> None:
+# 特定のSubmissionに対応するジャッジリクエストの属性値を変更し、JudgeResultを登録する
+# claimを失っている場合(有効期限切れで他のジャッジサーバーに取得し直された場合)は、何も変更せずにFalseを返す
+def update_submission_record(db: Session, submission_record: records.Submission) -> bool:
     # CRUD_LOGGER.debug("call update_submission_status")
-    raw_submission_record = (
-        db.query(models.Submission)
-        .filter(models.Submission.id == submission_record.id)
-        .first()
-    )
-    if raw_submission_record is None:
-        raise ValueError(f"Submission with id {submission_record.id} not found")
-
-    # assert raw_submission_record.evaluation_status_id == submission_record.evaluation_status_id
-    # assert raw_submission_record.user_id == submission_record.user_id
-    # assert raw_submission_record.lecture_id == submission_record.lecture_id
-    # assert raw_submission_record.assignment_id == submission_record.assignment_id
-    # assert raw_submission_record.eval == submission_record.eval
-    raw_submission_record.progress = submission_record.progress.value
-    raw_submission_record.completed_task = submission_record.completed_task
-    raw_submission_record.total_task = submission_record.total_task
-    raw_submission_record.result = submission_record.result.value
-    raw_submission_record.message = submission_record.message
-    # detailはVARCHAR(255)なので、200文字までクリップしてそこから"..."をつける
-    raw_submission_record.detail = submission_record.detail[:200] + ("..." if len(submission_record.detail) > 200 else "")
-    raw_submission_record.score = submission_record.score
-    raw_submission_record.timeMS = submission_record.timeMS
-    raw_submission_record.memoryKB = submission_record.memoryKB
-    db.commit()
+    values = {
+        models.Submission.progress: submission_record.progress.value,
+        models.Submission.completed_task: submission_record.completed_task,
+        models.Submission.total_task: submission_record.total_task,
+        models.Submission.result: submission_record.result.value,
+        models.Submission.message: submission_record.message,
+        # detailはVARCHAR(255)なので、200文字までクリップしてそこから"..."をつける
+        models.Submission.detail: submission_record.detail[:200] + ("..." if len(submission_record.detail) > 200 else ""),
+        models.Submission.score: submission_record.score,
+        models.Submission.timeMS: submission_record.timeMS,
+        models.Submission.memoryKB: submission_record.memoryKB,
+    }
+    if submission_record.progress == records.SubmissionProgressStatus.DONE:
+        # ジャッジが完了したので、claimの有効期限は不要
+        values[models.Submission.lease_expires_at] = None
+    updated = _owned_running_submission(db, submission_record).update(values, synchronize_session=False)
+    if updated != 1:
+        db.rollback()
+        CRUD_LOGGER.warning(f"Submission {submission_record.id} のclaimを失っているため、結果を登録しません")
+        return False
 
+    # Submissionの更新とJudgeResultの登録を1つのトランザクションで行う
     for judge_result in submission_record.judge_results:
         db.add(models.JudgeResult(
             **judge_result.model_dump(exclude={"id"})
         ))
     db.commit()
+    return True
 
 
 # Undo処理: judge-serverをシャットダウンするときに実行する
-# 1. その時点でstatusが"running"になっているジャッジリクエスト(from Submissionテーブル)を
-#    全て"queued"に変更する
+# 1. その時点でnode_idのジャッジサーバーがclaimしていて、statusが"running"になっている
+#    ジャッジリクエスト(from Submissionテーブル)を全て"queued"に変更する
+#    (他のジャッジサーバーがclaimしているものには触らない)
 # 2. 変更したジャッジリクエストについて、それに紐づいたJudgeResult, EvaluationSummary, SubmissionSummaryを全て削除する
-def undo_running_submissions(db: Session) -> None:
+def undo_running_submissions(db: Session, node_id: str) -> None:
     # CRUD_LOGGER.debug("call undo_running_submissions")
-    # 1. "running"状態のSubmissionを全て取得
+    # 1. このジャッジサーバーがclaimしている"running"状態のSubmissionを全て取得
     running_submissions = (
         db.query(models.Submission)
-        .filter(models.Submission.progress == "running")
+        .filter(
+            models.Submission.progress == "running",
+            models.Submission.claimed_by == node_id,
+        )
         .all()
     )
 
@@ -176,6 +415,9 @@ def undo_running_submissions(db: Session) -> None:
     for submission in running_submissions:
         submission.progress = "queued"
         submission.completed_task = 0
+        submission.claimed_by = None
+        submission.lease_expires_at = None
+        submission.claim_token = None
 
     db.commit()
 
@@ -200,7 +200,7 @@ class Submission(Base):
     __tablename__ = "Submission"
     id: Mapped[int] = mapped_column(Integer,primary_key=True, autoincrement=True)
     ts: Mapped[datetime] = mapped_column(DateTime, server_default=text("CURRENT_TIMESTAMP"))
-    evaluation_status_id: Mapped[int] = mapped_column(Integer, ForeignKey("EvaluationStatus.id"), default=None)
+    evaluation_status_id: Mapped[int] = mapped_column(Integer, ForeignKey("EvaluationStatus.id"), nullable=True, default=None)
     user_id: Mapped[str] = mapped_column(String(255), ForeignKey("Users.user_id"), nullable=False)
     lecture_id: Mapped[int] = mapped_column(Integer, ForeignKey("Problem.lecture_id"), nullable=False)
     assignment_id: Mapped[int] = mapped_column(Integer, ForeignKey("Problem.assignment_id"), nullable=False)
@@ -215,6 +215,19 @@ class Submission(Base):
     score: Mapped[int] = mapped_column(Integer, nullable=True, default=None)
     timeMS: Mapped[int] = mapped_column(Integer, nullable=True, default=None)
     memoryKB: Mapped[int] = mapped_column(Integer, nullable=True, default=None)
+    # ジャッジリクエストを取得(claim)したジャッジサーバーのID
+    claimed_by: Mapped[str] = mapped_column(String(255), nullable=True, default=None)
+    # claimの有効期限。ジャッジサーバーはハートビートにより期限を延長し続ける。
+    # 期限切れのrunningなリクエストは、他のジャッジサーバーが取得し直してよい。
+    lease_expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, default=None)
+    # claimごとに発行するトークン。同じジャッジサーバーが取得し直した場合も変わるので、
+    # 取得し直す前のclaimのまま動いているジャッジからの書き込みを拒否できる
+    claim_token: Mapped[str] = mapped_column(String(32), nullable=True, default=None)
+    # 最後に更新された日時(MySQLではON UPDATE CURRENT_TIMESTAMP。db/migration.pyを参照)。
+    # 有効期限の無い"running"のリクエストを、取得し直してよいかの判断に使う
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime, nullable=False, default=datetime.now, onupdate=datetime.now, server_default=text("CURRENT_TIMESTAMP")
+    )
     
     # Submissionレコードと1-1関係(他方から見たら1-N関係)にあるProblemレコードへの参照
     problem: Mapped["Problem"] = relationship(
@@ -198,6 +198,12 @@ class Submission(BaseModel):
     score: int | None
     timeMS: int | None
     memoryKB: int | None
+    claimed_by: str | None = Field(default=None)
+    lease_expires_at: datetime | None = Field(default=None)
+    claim_token: str | None = Field(default=None)
+    # 提出の締め切り(Lecture.end_date)。締め切り後の提出の場合はNone
+    # Submissionテーブルの列ではなく、claim時に設定される
+    deadline: datetime | None = Field(default=None)
     
     problem: Problem
     
@@ -221,6 +227,25 @@ class Submission(BaseModel):
         return result.value if result is not None else None
 
 
+class QueuedSubmission(BaseModel):
+    """
+    ジョブスケジューラーが、claimするジャッジリクエストを選ぶときに参照する情報
+    """
+    id: int
+    ts: datetime
+    evaluation_status_id: int | None
+    user_id: str
+    lecture_id: int
+    assignment_id: int
+    eval: bool
+    # 提出の締め切り(Lecture.end_date)。締め切り後の提出の場合はNone
+    deadline: datetime | None = Field(default=None)
+
+    model_config = {
+        "from_attributes": True
+    }
+
+
 class JudgeResult(BaseModel):
     id: int = Field(default=0)
     submission_id: int
@@ -0,0 +1,127 @@
+"""
+プロセス全体で共有するDockerクライアント
+
+docker.from_env()はクライアントごとにDockerデーモンのソケットへのコネクションプールを持つので、
+ジャッジごとに作ると、コネクションが使い回されずに増え続ける。
+DockerClientManagerは1つのクライアントを全てのスレッドで共有し、
+* コネクションプールの大きさを同時実行数に合わせて制限する(JUDGE_DOCKER_MAX_POOL_SIZE)
+* check_healthでデーモンに疎通確認し、失敗した場合はクライアントを作り直す
+* デーモンへのリクエスト数と、実行中(レスポンスヘッダーを受け取るまで)のリクエスト数を統計情報に記録する
+"""
+from dotenv import load_dotenv
+from threading import Lock
+from typing import Callable
+import os
+import docker
+
+from .sandbox.my_error import Error
+from .admission import JUDGE_MAX_WORKERS, read_cpu_capacity
+from .metrics import judge_metrics
+from .log.config import judge_logger
+
+load_dotenv()
+
+# Dockerデーモンへのコネクションプールの大きさ。0の場合は同時実行数から決める
+JUDGE_DOCKER_MAX_POOL_SIZE = int(os.getenv("JUDGE_DOCKER_MAX_POOL_SIZE", "0"))
+# 同時実行数から決める場合の、コンテナプールなどのバックグラウンドのスレッドの分
+BACKGROUND_CONNECTIONS = 8
+
+
+def default_max_pool_size() -> int:
+    """
+    1つのジャッジは、execの実行中にソケットを1本専有し、タイムアウトの確認などにもう1本使うことがある
+    """
+    if JUDGE_DOCKER_MAX_POOL_SIZE > 0:
+        return JUDGE_DOCKER_MAX_POOL_SIZE
+    max_workers = JUDGE_MAX_WORKERS if JUDGE_MAX_WORKERS > 0 else read_cpu_capacity()
+    return max_workers * 2 + BACKGROUND_CONNECTIONS
+
+
+class DockerClientManager:
+    max_pool_size: int
+    from_env: Callable[..., docker.DockerClient]  # クライアントを作る関数(テストではDockerデーモンを使わないものに置き換える)
+    _client: docker.DockerClient | None
+    _in_flight: int  # 実行中のリクエストの数
+    _lock: Lock
+
+    def __init__(self, max_pool_size: int | None = None, from_env: Callable[..., docker.DockerClient] = docker.from_env):
+        self.max_pool_size = max_pool_size if max_pool_size is not None else default_max_pool_size()
+        self.from_env = from_env
+        self._client = None
+        self._in_flight = 0
+        self._lock = Lock()
+
+    def client(self) -> docker.DockerClient:
+        with self._lock:
+            if self._client is None:
+                self._client = self._create()
+            return self._client
+
+    def _create(self) -> docker.DockerClient:
+        client = self.from_env(max_pool_size=self.max_pool_size)
+        self._instrument(client)
+        return client
+
+    def _instrument(self, client: docker.DockerClient) -> None:
+        """
+        APIClient(requests.Session)のsendを置き換え、全てのリクエストを数える
+        """
+        send = client.api.send
+
+        def instrumented_send(request, **kwargs):
+            with self._lock:
+                self._in_flight += 1
+                judge_metrics.set("docker_requests_in_flight", self._in_flight)
+            judge_metrics.increment("docker_requests_total")
+            try:
+                return send(request, **kwargs)
+            except Exception:
+                judge_metrics.increment("docker_request_errors")
+                raise
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    judge_metrics.set("docker_requests_in_flight", self._in_flight)
+
+        client.api.send = instrumented_send
+
+    def check_health(self) -> Error:
+        """
+        Dockerデーモンに疎通確認し、応答が無ければクライアントを作り直す
+        """
+        try:
+            self.client().ping()
+            return Error.Nothing()
+        except Exception as e:
+            judge_logger.warning(f"docker daemon is not responding. reconnecting... ({e})")
+
+        with self._lock:
+            old_client = self._client
+            self._client = None
+        if old_client is not None:
+            # 古いクライアントで作られたコンテナなどは、使われる際に新しいコネクションを張り直す
+            old_client.close()
+        judge_metrics.increment("docker_reconnects")
+
+        try:
+            self.client().ping()
+        except Exception as e:
+            return Error(f"Failed to connect to docker daemon: {e}")
+        return Error.Nothing()
+
+    def close(self) -> None:
+        with self._lock:
+            client = self._client
+            self._client = None
+        if client is not None:
+            client.close()
+
+
+docker_clients = DockerClientManager()
+
+
+def get_docker_client() -> docker.DockerClient:
+    """
+    プロセス全体で共有するDockerクライアント
+    """
+    return docker_clients.client()
@@ -1,12 +1,24 @@
 from pathlib import Path
-from .sandbox.execute import ContainerInfo, DockerVolume, VolumeMountInfo, TaskInfo, WatchDogResult
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Callable
+from .sandbox.backend import SandboxContainer, SandboxVolume
+from .sandbox.execute import VolumeMountInfo, TaskInfo, WatchDogResult, ExecRunResult, TarEntry
 from .sandbox.my_error import Error
 from dotenv import load_dotenv
 from .db import records, crud
 from .db.database import SessionLocal
 from .checker import StandardChecker
+from .admission import RUNNER_CONTAINER_MEMORY_MARGIN_MB, JUDGE_MAX_WORKERS, max_testcase_shards, testcase_shard_count, read_cpu_capacity
+from .archive_cache import arranged_files_cache
+from .container_pool import ContainerPool, SandboxSet, create_build_container, create_runner_container
+from .resource_volume import ResourceVolumeManager, ResourceVolume, RESOURCE_MOUNT_PATH
+from .volume_pool import VolumePool, create_working_volume
+from .phase_timer import PhaseTimer
+from .metrics import judge_metrics
+from .testcase_order import judge_testcase_orderer
 from pydantic import BaseModel, ValidationError
-import tempfile
+import time
 import os
 import docker
 
@@ -23,18 +35,122 @@ CGROUP_PARENT = os.getenv("CGROUP_PARENT")
 OUTPUT_LIMIT_STDOUT_BYTES = int(os.getenv("OUTPUT_LIMIT_STDOUT_BYTES"))
 OUTPUT_LIMIT_STDERR_BYTES = int(os.getenv("OUTPUT_LIMIT_STDERR_BYTES"))
 
+# watchdogでテストケースをまとめて実行する際の、execのタイムアウトの余裕[秒]
+# (execのタイムアウトは、各タスクのtimeoutMSの合計に、タスクごとの起動・後片付けの分とwatchdog自体の分を足したもの)
+WATCHDOG_TIMEOUT_MARGIN_SEC_PER_TASK = 0.5
+WATCHDOG_TIMEOUT_MARGIN_SEC = 5
+
+# 非評価用(eval=False)の提出で、Judgeテストケースがこの数だけ失敗したら残りを実行せずに打ち切る(0の場合は全て実行する)
+JUDGE_STOP_AFTER_FAILURES = int(os.getenv("JUDGE_STOP_AFTER_FAILURES", "0"))
+# 評価用(eval=True)の提出の場合の、同様の設定
+JUDGE_STOP_AFTER_FAILURES_EVAL = int(os.getenv("JUDGE_STOP_AFTER_FAILURES_EVAL", "0"))
+
+# シャードの実行用コンテナに、ビルド結果をコピーする際のタイムアウト[秒]
+SHARD_COPY_TIMEOUT_SEC = 30
+# シャードの実行用コンテナで、(ビルド用コンテナと共有している)作業用ボリュームを読み取り専用でマウントする場所
+SHARD_SOURCE_PATH = "/home/build"
+
+_max_workers = JUDGE_MAX_WORKERS if JUDGE_MAX_WORKERS > 0 else read_cpu_capacity()
+
+# ビルドと並行して実行用コンテナを起動したり、ビルド用コンテナを削除したりするスレッド
+# (1つのジャッジにつき、実行用コンテナの数 + 1つ使う)
+sandbox_handoff_executor = ThreadPoolExecutor(
+    max_workers=(max_testcase_shards() + 1) * _max_workers,
+    thread_name_prefix="sandbox-handoff"
+)
+
+# 2つ目以降のシャードのJudgeテストケースを実行するスレッド(1つ目はジャッジのスレッドで実行する)
+testcase_shard_executor = ThreadPoolExecutor(
+    max_workers=max(1, max_testcase_shards() - 1) * _max_workers,
+    thread_name_prefix="testcase-shard"
+)
+
+# ハートビートでclaimを失った(有効期限切れで他のジャッジサーバーに取得し直された)ことが分かったジャッジリクエストのID。
+# 該当するジャッジは次の段階に進まず、結果を登録せずに後片付けだけをして終了する
+_revoked_claims: set[int] = set()
+_revoked_claims_lock = Lock()
+
+
+def revoke_claim(submission_id: int) -> None:
+    with _revoked_claims_lock:
+        _revoked_claims.add(submission_id)
+
+
+def forget_claim(submission_id: int) -> None:
+    # ジャッジが終了したら呼ぶ
+    with _revoked_claims_lock:
+        _revoked_claims.discard(submission_id)
+
+
 class JudgeInfo:
     submission_record: records.Submission # Submissionテーブル内のジャッジリクエストレコード
 
     problem_record: records.Problem # Problemテーブル内のテーブルレコード
     
-    client: docker.DockerClient
+    cpuset: list[int] | None # ビルド・実行用コンテナに専有させるCPU (Noneの場合は全てのCPUを使う)
+
+    container_pool: ContainerPool | None # 起動済みのコンテナを借りるプール (Noneの場合はジャッジごとにコンテナを作成する)
+    sandbox_set: SandboxSet | None # プールから借りているコンテナとボリューム
+
+    resource_volumes: ResourceVolumeManager | None # 問題ごとのリソースボリューム (Noneの場合はファイルをコピーする)
+    resource_volume: ResourceVolume | None # この提出の問題のリソースボリューム
+
+    volume_pool: VolumePool | None # 作成済みの作業用ボリュームを借りるプール (Noneの場合はジャッジごとに作成する)
+
+    runner_future: Future | None # ビルドと並行して起動している実行用コンテナ (戻り値は(コンテナ, エラー))
+    shard_futures: list[Future] # ビルドと並行して起動している、2つ目以降のシャードの実行用コンテナ (戻り値は(コンテナ, ボリューム, エラー))
+    teardown_futures: list[Future] # バックグラウンドで削除しているビルド用コンテナ
+
+    timer: PhaseTimer # ジャッジの各段階にかかった時間
+
+    build_cpuset: list[int] | None # ビルド用コンテナに使わせるCPU (Noneの場合はcpusetと同じ)
+    repin_runner: bool # run段階の前に、実行用コンテナをcpusetのCPUに固定し直すか
+
+    # 段階をまたいで引き継ぐ状態
+    testcase_dict: dict[int, records.TestCases] # testcase_id -> テストケース
+    runner_memory_mb: int # 実行用コンテナのメモリーリミット
+    resource_mount: VolumeMountInfo | None # リソースボリュームのマウント
+    working_volume: SandboxVolume | None # 作業用ボリューム
+    build_container: SandboxContainer | None # ビルド用コンテナ
+    runner_container: SandboxContainer | None # 実行用コンテナ
+    shard_count: int # Judgeテストケースを振り分ける実行用コンテナの数 (1つ目はrunner_container)
+    shards: list[tuple[SandboxContainer, SandboxVolume]] # 2つ目以降のシャードの実行用コンテナと、その作業用ボリューム
+    judge_result_list: list[records.JudgeResult] # 実行したテストケースの結果
+    _claim_lost: bool # DBの更新がclaimを失っていたために拒否されたか
 
     def __init__(
         self,
-        submission: records.Submission
+        submission: records.Submission,
+        cpuset: list[int] | None = None,
+        container_pool: ContainerPool | None = None,
+        resource_volumes: ResourceVolumeManager | None = None,
+        volume_pool: VolumePool | None = None,
+        build_cpuset: list[int] | None = None
     ):
         self.submission_record = submission
+        self.cpuset = cpuset
+        self.build_cpuset = build_cpuset
+        self.repin_runner = False
+        self.testcase_dict = {}
+        self.runner_memory_mb = 0
+        self.resource_mount = None
+        self.working_volume = None
+        self.build_container = None
+        self.runner_container = None
+        self.shard_count = 1
+        self.shards = []
+        self.judge_result_list = []
+        self.container_pool = container_pool
+        self.sandbox_set = None
+        self.resource_volumes = resource_volumes
+        self.resource_volume = None
+        self.volume_pool = volume_pool
+        self.runner_future = None
+        self.shard_futures = []
+        self.teardown_futures = []
+        self.timer = PhaseTimer()
+        self._progress_lock = Lock()
+        self._claim_lost = False
 
         with SessionLocal() as db:
             problem_record = crud.fetch_problem(
@@ -64,19 +180,296 @@ class JudgeInfo:
 
             judge_logger.debug(f"JudgeInfo.__init__: problem_record: {self.problem_record}")
         
-        self.client = docker.from_env()
 
 
+    def claim_lost(self) -> bool:
+        """
+        このジャッジリクエストのclaimを失っているか。失っている場合は、DBを更新しても拒否される
+        """
+        if self._claim_lost:
+            return True
+        with _revoked_claims_lock:
+            return self.submission_record.id in _revoked_claims
+
     def _update_progress_of_submission(self) -> None:
+        if self.claim_lost():
+            return
         with SessionLocal() as db:
-            crud.update_submission_status_and_progress(db=db, submission_record=self.submission_record)
+            if not crud.update_submission_status_and_progress(db=db, submission_record=self.submission_record):
+                self._claim_lost = True
+                judge_logger.warning(f"submission {self.submission_record.id}: claim lost, progress is not updated")
+
+    def _exec_watchdog(
+        self,
+        container: SandboxContainer,
+        task_info_list: list[TaskInfo],
+        copy_from: str | None = None,
+        stop_after_failures: int = 0,
+        is_failure: Callable[[int, str], bool] | None = None
+    ) -> tuple[list[str], ExecRunResult, Error]:
+        # task_info_listのタスクを、1回のwatchdogの実行でまとめて実行する
+        # 戻り値の1つ目は、各タスクの実行結果(JSON文字列)を実行順に並べたもの
+        # watchdogが途中で異常終了した場合は、異常終了したタスクの手前までの結果になる
+        # stop_after_failures > 0 の場合は、失敗したタスクがその数になった時点までの結果になる
+        # (失敗かどうかは、結果が出るたびにis_failure(タスクの番号, 実行結果)で判定する。省略した場合はTLE・MLE・OLE)
+        # claimを失った場合も、そこまでの結果で打ち切る
+        if len(task_info_list) == 0:
+            return [], ExecRunResult(exitCode=0), Error.Nothing()
+
+        if copy_from is not None:
+            # 実行の前に、copy_fromの中身を/home/guestにコピーする(所有者・パーミッションは保つ)
+            with self.timer.measure("shard_copy"):
+                copy_result, err = container.exec_run(
+                    command=["cp", "-a", f"{copy_from}/.", "/home/guest/"],
+                    user="root",
+                    workDir="/home/guest",
+                    timeoutSec=SHARD_COPY_TIMEOUT_SEC
+                )
+            if err.silence() and copy_result.exitCode != 0:
+                err = Error(f"failed to copy {copy_from}: {copy_result.stderr}")
+            if not err.silence():
+                return [], copy_result, err
+
+        watchdog_output_list: list[str] = []
+        failures = 0
+        if is_failure is None:
+            is_failure = lambda _, watchdog_output: self._limit_exceeded(watchdog_output)
+
+        def on_task_finished(watchdog_output: str) -> bool:
+            # watchdogは、タスクが1つ終わるたびに結果を1行のJSONで出力する
+            nonlocal failures
+            if is_failure(len(watchdog_output_list), watchdog_output):
+                failures += 1
+            watchdog_output_list.append(watchdog_output)
+            # 進捗状況を更新(シャードごとのスレッドから呼ばれる)
+            with self._progress_lock:
+                self.submission_record.completed_task += 1
+                self._update_progress_of_submission()
+            # Trueを返すと、残りのタスクを待たずにwatchdogのexecがkillされる
+            return (stop_after_failures > 0 and failures >= stop_after_failures) or self.claim_lost()
+
+        while True:
+            remaining_task_list = task_info_list[len(watchdog_output_list):]
+            # TaskInfoのリストをJSONにして、watchdogの標準入力に直接流し込む
+            # (ファイルとしてアップロードしないので、ユーザープログラムから読まれることもない)
+            tasks_json = "[" + ",".join(task_info.model_dump_json() for task_info in remaining_task_list) + "]"
+            if stop_after_failures > 0:
+                # watchdogが数えるのはTLE・MLE・OLEだけなので、WA・REで打ち切る場合はon_task_finishedがkillする
+                remaining_failures = stop_after_failures - failures
+                tasks_json = f'{{"tasks":{tasks_json},"stopAfterFailures":{remaining_failures}}}'
+
+            # watchdogによる実行
+            result, err = container.exec_run(
+                command=["/home/watchdog"],
+                user="root",
+                workDir="/home/guest",
+                timeoutSec=self._watchdog_timeout_sec(remaining_task_list),
+                onStdoutLine=on_task_finished,
+                stdin=tasks_json.encode()
+            )
+            if not result.timedOut or len(watchdog_output_list) == len(task_info_list):
+                return watchdog_output_list, result, err
+            if container.get_status() != "running":
+                # watchdogのプロセスだけをkillできず、コンテナごとkillされた
+                return watchdog_output_list, result, err
+
+            # watchdog自身がタスクを終わらせられなかった(ユーザープログラムの子孫が出力のパイプを開いたままにしているなど)。
+            # watchdogごとkillされたので、実行中だったタスクをTLEとし、残りのタスクを同じコンテナで続けて実行する
+            judge_metrics.increment("watchdog_exec_timeouts")
+            stuck_task = task_info_list[len(watchdog_output_list)]
+            stop = on_task_finished(WatchDogResult(
+                exit_code=128 + 9,  # SIGKILL
+                stdout="",
+                stderr=f"killed: did not exit within {stuck_task.timeoutMS} ms ({err.message})",
+                timeMS=stuck_task.timeoutMS,
+                memoryKB=0,
+                TLE=True,
+                MLE=False,
+                OLE=False
+            ).model_dump_json())
+            if stop or len(watchdog_output_list) == len(task_info_list):
+                return watchdog_output_list, ExecRunResult(exitCode=0), Error.Nothing()
+
+    @staticmethod
+    def _watchdog_timeout_sec(task_info_list: list[TaskInfo]) -> float:
+        # 全てのタスクが制限時間まで実行しても、watchdogが結果を出し終えられる時間
+        return (
+            sum(task_info.timeoutMS for task_info in task_info_list) / 1000
+            + WATCHDOG_TIMEOUT_MARGIN_SEC_PER_TASK * len(task_info_list)
+            + WATCHDOG_TIMEOUT_MARGIN_SEC
+        )
+
+    @staticmethod
+    def _limit_exceeded(watchdog_output: str) -> bool:
+        # TLE・MLE・OLEになったタスクか(watchdogが打ち切りに使うのと同じ判定)
+        try:
+            watchdog_result = WatchDogResult.model_validate_json(watchdog_output)
+        except ValidationError:
+            return False
+        return watchdog_result.TLE or watchdog_result.MLE or watchdog_result.OLE
+
+    def _stdin_of(self, testcase: records.TestCases) -> tuple[str, str]:
+        """
+        watchdogに渡す(標準入力の内容, 標準入力のファイルのコンテナ内のパス)。
+        リソースボリュームを使う場合は、ホストでファイルを読まずにパスだけを渡す。
+        """
+        if testcase.stdin_path is None:
+            return "", ""
+        if self.resource_volume is not None:
+            return "", self.resource_volume.stdin_path(testcase.stdin_path)
+        with open(RESOURCE_DIR / Path(testcase.stdin_path), mode='r', encoding='utf-8') as f:
+            return f.read(), ""
+
+    def _remove_working_volume(self, working_volume: SandboxVolume) -> Error:
+        # ボリュームをマウントしているコンテナを、先に全て削除しておく
+        self._discard_shards()
+        self._discard_runner_container()
+        self._wait_for_teardown()
+        return self._release_working_volume(working_volume)
+
+    def _release_working_volume(self, working_volume: SandboxVolume) -> Error:
+        if self.volume_pool is not None:
+            # プールに返却し、削除はバックグラウンドで行う
+            self.volume_pool.release(working_volume)
+            return Error.Nothing()
+        return working_volume.remove()
+
+    def _release_resource_volume(self) -> None:
+        if self.resource_volume is not None:
+            self.resource_volumes.release(self.resource_volume)
+            self.resource_volume = None
+
+    def _start_runner_container(
+        self,
+        working_volume: SandboxVolume,
+        memoryLimitMB: int,
+        resource_mount: VolumeMountInfo | None,
+        cpuset: list[int] | None
+    ) -> tuple[SandboxContainer | None, Error]:
+        # ビルドと並行して、sandbox_handoff_executorのスレッドで実行用コンテナを作成・起動する
+        with self.timer.measure("runner_start"):
+            try:
+                container = create_runner_container(
+                    working_volume=working_volume,
+                    memoryLimitMB=memoryLimitMB,
+                    cpuset=cpuset,
+                    resource_mount=resource_mount
+                )
+            except Exception as e:
+                return None, Error(f"Failed to create sandbox container: {e}")
+            err = container.start()
+            if not err.silence():
+                container.remove()
+                return None, err
+            return container, Error.Nothing()
+
+    def _take_runner_container(self) -> tuple[SandboxContainer | None, Error]:
+        # 起動が終わるのを待って、実行用コンテナを引き継ぐ
+        future, self.runner_future = self.runner_future, None
+        return future.result()
+
+    def _discard_runner_container(self) -> None:
+        # 引き継がずに終わった実行用コンテナを削除する
+        if self.runner_future is None:
+            return
+        container, _ = self._take_runner_container()
+        if container is not None:
+            err = container.remove()
+            if not err.silence():
+                judge_logger.error(f"failed to remove sandbox container: {container.containerID}")
+
+    def _shard_cpuset(self, index: int) -> list[int] | None:
+        # cpusetのCPUを、シャードごとに分けて専有させる
+        if self.cpuset is None or self.shard_count <= 1:
+            return self.cpuset
+        # shard_countはcpusetのCPUの数以下なので、各シャードに1つ以上のCPUを専有させられる
+        return self.cpuset[index::self.shard_count]
+
+    def _cap_shards(self) -> None:
+        # assign_cpusetで割り当てられたCPUがシャードの数より少ない場合は、余ったシャードの実行用コンテナを削除する
+        if self.cpuset is None or len(self.cpuset) >= self.shard_count:
+            return
+        self.shard_count = max(1, len(self.cpuset))
+        surplus, self.shards = self.shards[self.shard_count - 1:], self.shards[:self.shard_count - 1]
+        for container, volume in surplus:
+            self._remove_shard(container, volume)
+
+    def _start_shard_container(self, index: int) -> tuple[SandboxContainer | None, SandboxVolume | None, Error]:
+        # index番目(1以上)のシャードの実行用コンテナを、専用の作業用ボリュームで作成・起動する
+        # ビルド結果は、run段階で(SHARD_SOURCE_PATHにマウントした)ビルド用の作業用ボリュームからコピーする
+        with self.timer.measure("shard_start"):
+            if self.volume_pool is not None:
+                volume, err = self.volume_pool.acquire()
+            else:
+                volume, err = create_working_volume()
+            if not err.silence():
+                return None, None, err
+            try:
+                container = create_runner_container(
+                    working_volume=volume,
+                    memoryLimitMB=self.runner_memory_mb,
+                    cpuset=self._shard_cpuset(index),
+                    resource_mount=self.resource_mount,
+                    source_mount=VolumeMountInfo(path=SHARD_SOURCE_PATH, volume=self.working_volume, read_only=True)
+                )
+            except Exception as e:
+                self._release_working_volume(volume)
+                return None, None, Error(f"Failed to create sandbox container: {e}")
+            err = container.start()
+            if not err.silence():
+                container.remove()
+                self._release_working_volume(volume)
+                return None, None, err
+            return container, volume, Error.Nothing()
+
+    def _take_shards(self) -> Error:
+        # 起動が終わるのを待って、シャードの実行用コンテナを引き継ぐ
+        futures, self.shard_futures = self.shard_futures, []
+        first_err = Error.Nothing()
+        for future in futures:
+            container, volume, err = future.result()
+            if container is not None:
+                self.shards.append((container, volume))
+            if not err.silence() and first_err.silence():
+                first_err = err
+        return first_err
+
+    def _discard_shards(self) -> None:
+        # シャードの実行用コンテナと、その作業用ボリュームを削除する
+        self._take_shards()
+        shards, self.shards = self.shards, []
+        for container, volume in shards:
+            self._remove_shard(container, volume)
+
+    def _remove_shard(self, container: SandboxContainer, volume: SandboxVolume) -> None:
+        err = container.remove()
+        if not err.silence():
+            judge_logger.error(f"failed to remove sandbox container: {container.containerID}")
+        err = self._release_working_volume(volume)
+        if not err.silence():
+            judge_logger.error(f"failed to remove volume: {volume.name}")
+
+    def _remove_in_background(self, container: SandboxContainer) -> None:
+        def remove():
+            with self.timer.measure("build_teardown"):
+                err = container.remove()
+            if not err.silence():
+                judge_logger.error(f"failed to remove build container: {container.containerID}: {err.message}")
+        self.teardown_futures.append(sandbox_handoff_executor.submit(remove))
+
+    def _wait_for_teardown(self) -> None:
+        for future in self.teardown_futures:
+            future.result()
+        self.teardown_futures = []
 
     def _exec_built_task(
         self,
-        container: ContainerInfo,
+        container: SandboxContainer,
         testcase_list: list[records.TestCases],
     ) -> list[records.JudgeResult]:
         judge_result_list: list[records.JudgeResult] = []
+        args_list: list[str] = []
+        task_info_list: list[TaskInfo] = []
         for testcase in testcase_list:
             # 実行コマンド + 引数
             args = testcase.command
@@ -86,20 +479,23 @@ class JudgeInfo:
                 args += ' '
                 args += ' '.join(testcase.args.strip().split())
 
-            stdin = ""
-            if testcase.stdin_path is not None:
-                with open(RESOURCE_DIR / Path(testcase.stdin_path), mode='r', encoding='utf-8') as f:
-                    stdin = f.read()
+            stdin, stdin_path = self._stdin_of(testcase)
             
-            task_info = TaskInfo(
+            args_list.append(args)
+            task_info_list.append(TaskInfo(
                 command=args,
                 stdin=stdin,
+                stdinPath=stdin_path,
                 timeoutMS=2000,
                 memoryLimitMB=512,
                 uid=int(GUEST_UID),
                 gid=int(GUEST_GID)
-            )
-            
+            ))
+
+        # 全てのビルドを1回のwatchdogの実行で行う
+        watchdog_output_list, result, err = self._exec_watchdog(container=container, task_info_list=task_info_list)
+
+        for index, (testcase, args) in enumerate(zip(testcase_list, args_list)):
             judge_result = records.JudgeResult(
                 submission_id=self.submission_record.id,
                 testcase_id=testcase.id,
@@ -111,88 +507,21 @@ class JudgeInfo:
                 stdout="",
                 stderr=""
             )
-            
-            # TaskInfoの内容をJSONにして/home/guest/task.jsonに書き込む
-            # uid:gid=root:root, パーミッションは600
-            task_info_json = task_info.model_dump_json(indent=4)
-            with tempfile.TemporaryDirectory() as temp_dir:
-                with open(Path(temp_dir) / "task.json", mode='w', encoding='utf-8') as f:
-                    f.write(task_info_json)
-                
-                # コンテナ内にコピー
-                err = container.uploadFile(srcInHost=Path(temp_dir) / "task.json", dstInContainer=Path("/home/guest"))
-                if not err.silence():
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to send task information to sandbox. Please reupload or tell the administrator."
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to copy task.json to container: {err.message}")
-                    continue
-                
-                # uid:gid=root:root
-                res, err = container.exec_run(
-                    command=["chown", "root:root", "/home/guest/task.json"],
-                    user="root",
-                    workDir="/home/guest",
-                    timeoutSec=2
-                )
-                if not err.silence() or res.exitCode != 0:
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to setup sandbox(1), Please reupload or tell the administrator. (exit code: {res.exitCode})"
-                    self.submission_record.score = 0
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to chown task.json: {err.message} (exit code: {res.exitCode})")
-
-                # パーミッションを600にする
-                res, err = container.exec_run(
-                    command=["chmod", "600", "/home/guest/task.json"],
-                    user="root",
-                    workDir="/home/guest",
-                    timeoutSec=2
-                )
-                if not err.silence() or res.exitCode != 0:
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to setup sandbox(2), Please reupload or tell the administrator. (exit code: {res.exitCode})"
-                    self.submission_record.score = 0
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to chmod task.json: {err.message} (exit code: {res.exitCode})")
-
-            # watchdogによる実行
-            result, err = container.exec_run(
-                command=["/home/watchdog", "task.json"],
-                user="root",
-                workDir="/home/guest",
-                timeoutSec=8
-            )
 
-            if not err.silence():
-                # 内部エラーにより失敗
+            if index >= len(watchdog_output_list):
+                # このタスクの結果を出力する前に、watchdogが終了した
                 judge_result.result = records.SingleJudgeStatus.IE
-                judge_result.stderr = f"exec_run error: {err.message}"
-                judge_result_list.append(judge_result)
-                # 内部エラーの場合は即座に終了する
-                return judge_result_list
-
-            if result.exitCode != 0:
-                judge_result.result = records.SingleJudgeStatus.IE
-                judge_result.exit_code = result.exitCode
-                judge_result.stderr = f"watchdog error: {result.stderr}"
+                if not err.silence():
+                    # 内部エラーにより失敗
+                    judge_result.stderr = f"exec_run error: {err.message}"
+                else:
+                    judge_result.exit_code = result.exitCode
+                    judge_result.stderr = f"watchdog error: {result.stderr}"
                 judge_result_list.append(judge_result)
                 # 内部エラーの場合は即座に終了する
                 return judge_result_list
             
-            # watchdogが正常に終了すれば、result.stdoutは以下のようなJSON文字列になる
+            # watchdogの出力の各行は、以下のようなJSON文字列になる
             # {
             #     "exit_code": 0,
             #     "stdout": "...",
@@ -204,7 +533,7 @@ class JudgeInfo:
             # }
             
             try:
-                watchdog_result = WatchDogResult.model_validate_json(result.stdout)
+                watchdog_result = WatchDogResult.model_validate_json(watchdog_output_list[index])
                 
                 judge_result.exit_code = watchdog_result.exit_code
                 judge_result.stdout = watchdog_result.stdout
@@ -223,10 +552,6 @@ class JudgeInfo:
                 # 内部エラーの場合は即座に終了する
                 return judge_result_list
 
-            # 進捗状況を更新
-            self.submission_record.completed_task += 1
-            self._update_progress_of_submission()
-
             # NOTE: ビルドの際は、標準出力、標準エラー出力の確認はせず、戻り値のみの確認とする。
             # それは、Makefileによるビルドログの出力まで一致確認するのは厳格すぎるから。
             
@@ -254,10 +579,14 @@ class JudgeInfo:
 
     def _exec_judge_task(
         self,
-        container: ContainerInfo,
-        testcase_list: list[records.TestCases]
+        container: SandboxContainer,
+        testcase_list: list[records.TestCases],
+        copy_from: str | None = None
     ) -> list[records.JudgeResult]:
         judge_result_list: list[records.JudgeResult] = []
+        args_list: list[str] = []
+        expected_list: list[tuple[str | None, str | None, bool]] = []
+        task_info_list: list[TaskInfo] = []
         for testcase in testcase_list:
             # 実行コマンド + 引数
             args = testcase.command
@@ -267,15 +596,11 @@ class JudgeInfo:
                 args += ' '.join(testcase.args.strip().split())
 
             # 標準入力、想定される標準出力・標準エラー出力の取得
-            stdin = ""
+            stdin, stdin_path = self._stdin_of(testcase)
             expected_stdout = None
             expected_stderr = None
             expected_terminate_normally = True if testcase.exit_code == 0 else False
 
-            if testcase.stdin_path is not None:
-                with open(RESOURCE_DIR / Path(testcase.stdin_path), mode='r', encoding='utf-8') as f:
-                    stdin = f.read()
-
             if testcase.stdout_path is not None:
                 with open(RESOURCE_DIR / Path(testcase.stdout_path), mode='r', encoding='utf-8') as f:
                     expected_stdout = f.read()
@@ -284,119 +609,70 @@ class JudgeInfo:
                 with open(RESOURCE_DIR / Path(testcase.stderr_path), mode='r', encoding='utf-8') as f:
                     expected_stderr = f.read()
 
-            task_info = TaskInfo(
+            args_list.append(args)
+            expected_list.append((expected_stdout, expected_stderr, expected_terminate_normally))
+            task_info_list.append(TaskInfo(
                 command=args,
                 stdin=stdin,
+                stdinPath=stdin_path,
                 timeoutMS=self.problem_record.timeMS,
                 memoryLimitMB=self.problem_record.memoryMB,
                 uid=int(GUEST_UID),
                 gid=int(GUEST_GID)
-            )
-            
-            # TaskInfoの内容をJSONにして/home/guest/task.jsonに書き込む
-            # uid:gid=root:root, パーミッションは600
-            task_info_json = task_info.model_dump_json(indent=4)
-            with tempfile.TemporaryDirectory() as temp_dir:
-                with open(Path(temp_dir) / "task.json", mode='w', encoding='utf-8') as f:
-                    f.write(task_info_json)
-                
-                # コンテナ内にコピー
-                err = container.uploadFile(srcInHost=Path(temp_dir) / "task.json", dstInContainer=Path("/home/guest"))
-                if not err.silence():
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to send task information to sandbox. Please reupload or tell the administrator."
-                    self.submission_record.score = 0
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to copy task.json to container: {err.message}")
-                    continue
-                
-                # uid:gid=root:root
-                res, err = container.exec_run(
-                    command=["chown", "root:root", "/home/guest/task.json"],
-                    user="root",
-                    workDir="/home/guest",
-                    timeoutSec=2
-                )
-                if not err.silence() or res.exitCode != 0:
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to setup sandbox(1), Please reupload or tell the administrator. (exit code: {res.exitCode})"
-                    self.submission_record.score = 0
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to chown task.json: {err.message} (exit code: {res.exitCode})")
-
-                # パーミッションを600にする
-                res, err = container.exec_run(
-                    command=["chmod", "600", "/home/guest/task.json"],
-                    user="root",
-                    workDir="/home/guest",
-                    timeoutSec=2
-                )
-                if not err.silence() or res.exitCode != 0:
-                    self.submission_record.progress = records.SubmissionProgressStatus.DONE
-                    self.submission_record.result = records.SubmissionSummaryStatus.IE
-                    self.submission_record.message = f"Failed to setup sandbox(2), Please reupload or tell the administrator. (exit code: {res.exitCode})"
-                    self.submission_record.score = 0
-                    self.submission_record.timeMS = 0
-                    self.submission_record.memoryKB = 0
-                    with SessionLocal() as db:
-                        crud.update_submission_record(db=db, submission_record=self.submission_record)
-                    raise ValueError(f"Failed to chmod task.json: {err.message} (exit code: {res.exitCode})")
+            ))
 
-            # watchdogによる実行
-            result, err = container.exec_run(
-                command=["/home/watchdog", "task.json"],
-                user="root",
-                workDir="/home/guest",
-                timeoutSec=8
-            )
-            
-            judge_result = records.JudgeResult(
+        def new_judge_result(index: int) -> records.JudgeResult:
+            return records.JudgeResult(
                 submission_id=self.submission_record.id,
-                testcase_id=testcase.id,
+                testcase_id=testcase_list[index].id,
                 result=records.SingleJudgeStatus.AC,
-                command=args,
+                command=args_list[index],
                 timeMS=0,
                 memoryKB=0,
                 exit_code=0,
                 stdout="",
                 stderr=""
             )
-            
-            if not err.silence():
-                judge_result.result = records.SingleJudgeStatus.IE
-                judge_result.stderr = f"exec_run error: {err.message}"
-                judge_result_list.append(judge_result)
-                # 内部エラーの場合は即座に終了する
-                return judge_result_list
-            
-            if result.exitCode != 0:
+
+        def is_failure(index: int, watchdog_output: str) -> bool:
+            # watchdogの結果が出るたびに判定し、WA・REも打ち切る失敗の数に含める
+            try:
+                watchdog_result = WatchDogResult.model_validate_json(watchdog_output)
+            except ValidationError:
+                # 内部エラーになるので、以降の結果は使わない
+                return True
+            judge_result = new_judge_result(index)
+            self._check_watchdog_result(judge_result, watchdog_result, *expected_list[index])
+            return judge_result.result != records.SingleJudgeStatus.AC
+
+        # 全てのテストケースを1回のwatchdogの実行で行う
+        failure_limit = self._failure_limit()
+        watchdog_output_list, result, err = self._exec_watchdog(
+            container=container,
+            task_info_list=task_info_list,
+            copy_from=copy_from,
+            stop_after_failures=failure_limit,
+            is_failure=is_failure
+        )
+        failures = 0
+
+        for index in range(len(testcase_list)):
+            judge_result = new_judge_result(index)
+
+            if index >= len(watchdog_output_list):
+                # このテストケースの結果を出力する前に、watchdogが終了した
                 judge_result.result = records.SingleJudgeStatus.IE
-                judge_result.exit_code = result.exitCode
-                judge_result.stderr = f"watchdog error: {result.stderr}"
+                if not err.silence():
+                    judge_result.stderr = f"exec_run error: {err.message}"
+                else:
+                    judge_result.exit_code = result.exitCode
+                    judge_result.stderr = f"watchdog error: {result.stderr}"
                 judge_result_list.append(judge_result)
                 # 内部エラーの場合は即座に終了する
                 return judge_result_list
-            
+
             try:
-                watchdog_result = WatchDogResult.model_validate_json(result.stdout)
-                
-                judge_result.exit_code = watchdog_result.exit_code
-                judge_result.stdout = watchdog_result.stdout
-                judge_result.stderr = watchdog_result.stderr
-                judge_result.timeMS = watchdog_result.timeMS
-                judge_result.memoryKB = watchdog_result.memoryKB
-                if watchdog_result.TLE:
-                    judge_result.result = records.SingleJudgeStatus.TLE
-                if watchdog_result.MLE:
-                    judge_result.result = records.SingleJudgeStatus.MLE
+                watchdog_result = WatchDogResult.model_validate_json(watchdog_output_list[index])
             except ValidationError as e:
                 judge_result.result = records.SingleJudgeStatus.IE
                 judge_result.stderr = f"validation error: {e}\nwatchdog error: {result.stderr}"
@@ -404,88 +680,222 @@ class JudgeInfo:
                 # 内部エラーの場合は即座に終了する
                 return judge_result_list
 
-            # 進捗状況を更新
-            self.submission_record.completed_task += 1
-            self._update_progress_of_submission()
-
-            stdout_byte_size = len(judge_result.stdout.encode('utf-8'))
-            stderr_byte_size = len(judge_result.stderr.encode('utf-8'))
-            
-            # 出力オーバーフローチェック
-            if stdout_byte_size > OUTPUT_LIMIT_STDOUT_BYTES or stderr_byte_size > OUTPUT_LIMIT_STDERR_BYTES:
-                judge_result.result = records.SingleJudgeStatus.OLE
-                if stdout_byte_size > OUTPUT_LIMIT_STDOUT_BYTES:
-                    too_long_warning = f"stdout is too long: capacity ({OUTPUT_LIMIT_STDOUT_BYTES} bytes) exceeded"
-                    judge_result.stderr = judge_result.stderr[:OUTPUT_LIMIT_STDERR_BYTES - len(too_long_warning)] + too_long_warning
-                if stderr_byte_size > OUTPUT_LIMIT_STDERR_BYTES:
-                    too_long_warning = f"stderr is too long: capacity ({OUTPUT_LIMIT_STDERR_BYTES} bytes) exceeded"
-                    judge_result.stderr = judge_result.stderr[:OUTPUT_LIMIT_STDERR_BYTES - len(too_long_warning)] + too_long_warning
-
-            # TLEチェック
-            if watchdog_result.TLE:
-                judge_result.result = records.SingleJudgeStatus.TLE
-            # MLEチェック
-            elif watchdog_result.MLE:
-                judge_result.result = records.SingleJudgeStatus.MLE
-            # OLEチェック
-            elif watchdog_result.OLE:
-                judge_result.result = records.SingleJudgeStatus.OLE
-            # RE(Runtime Errorチェック)
-            elif expected_terminate_normally and judge_result.exit_code != 0:
-                # テストケースは正常終了を想定しているが、実行結果は異常終了した場合
-                judge_result.result = records.SingleJudgeStatus.RE
-            # Wrong Answerチェック
-            elif (
-                expected_stdout is not None
-                and not StandardChecker.match(expected_stdout, judge_result.stdout)
-            ) or (
-                expected_stderr is not None
-                and not StandardChecker.match(expected_stderr, judge_result.stderr)
-            ):
-                judge_result.result = records.SingleJudgeStatus.WA
-            elif not expected_terminate_normally and judge_result.exit_code == 0:
-                # テストケースは異常終了を想定しているが、実行結果は正常終了した場合
-                # そのプログラムは異常検知できていないため、WAとする。
-                judge_result.result = records.SingleJudgeStatus.WA
-            else:
-                # AC(正解)
-                judge_result.result= records.SingleJudgeStatus.AC
+            self._check_watchdog_result(judge_result, watchdog_result, *expected_list[index])
 
             # TestCaseで設定されていたジョブが正常に実行完了した
             # judge_result_listに追加
             judge_result_list.append(judge_result)
 
+            if judge_result.result != records.SingleJudgeStatus.AC:
+                failures += 1
+                if failure_limit > 0 and failures >= failure_limit:
+                    # 残りのテストケースは実行していない(watchdogのexecもこの結果の時点で打ち切っている)
+                    break
+
         return judge_result_list
 
-    def _closing_procedure(self, submission_record: records.Submission, container: ContainerInfo | None, working_volume: DockerVolume | None) -> Error:
+    @staticmethod
+    def _check_watchdog_result(
+        judge_result: records.JudgeResult,
+        watchdog_result: WatchDogResult,
+        expected_stdout: str | None,
+        expected_stderr: str | None,
+        expected_terminate_normally: bool
+    ) -> None:
+        """
+        watchdogの実行結果をjudge_resultに書き込み、想定される出力・終了コードと比べて判定する
+        """
+        judge_result.exit_code = watchdog_result.exit_code
+        judge_result.stdout = watchdog_result.stdout
+        judge_result.stderr = watchdog_result.stderr
+        judge_result.timeMS = watchdog_result.timeMS
+        judge_result.memoryKB = watchdog_result.memoryKB
+
+        stdout_byte_size = len(judge_result.stdout.encode('utf-8'))
+        stderr_byte_size = len(judge_result.stderr.encode('utf-8'))
+
+        # 出力オーバーフローチェック
+        if stdout_byte_size > OUTPUT_LIMIT_STDOUT_BYTES or stderr_byte_size > OUTPUT_LIMIT_STDERR_BYTES:
+            judge_result.result = records.SingleJudgeStatus.OLE
+            if stdout_byte_size > OUTPUT_LIMIT_STDOUT_BYTES:
+                too_long_warning = f"stdout is too long: capacity ({OUTPUT_LIMIT_STDOUT_BYTES} bytes) exceeded"
+                judge_result.stderr = judge_result.stderr[:OUTPUT_LIMIT_STDERR_BYTES - len(too_long_warning)] + too_long_warning
+            if stderr_byte_size > OUTPUT_LIMIT_STDERR_BYTES:
+                too_long_warning = f"stderr is too long: capacity ({OUTPUT_LIMIT_STDERR_BYTES} bytes) exceeded"
+                judge_result.stderr = judge_result.stderr[:OUTPUT_LIMIT_STDERR_BYTES - len(too_long_warning)] + too_long_warning
+
+        # TLEチェック
+        if watchdog_result.TLE:
+            judge_result.result = records.SingleJudgeStatus.TLE
+        # MLEチェック
+        elif watchdog_result.MLE:
+            judge_result.result = records.SingleJudgeStatus.MLE
+        # OLEチェック
+        elif watchdog_result.OLE:
+            judge_result.result = records.SingleJudgeStatus.OLE
+        # RE(Runtime Errorチェック)
+        elif expected_terminate_normally and judge_result.exit_code != 0:
+            # テストケースは正常終了を想定しているが、実行結果は異常終了した場合
+            judge_result.result = records.SingleJudgeStatus.RE
+        # Wrong Answerチェック
+        elif (
+            expected_stdout is not None
+            and not StandardChecker.match(expected_stdout, judge_result.stdout)
+        ) or (
+            expected_stderr is not None
+            and not StandardChecker.match(expected_stderr, judge_result.stderr)
+        ):
+            judge_result.result = records.SingleJudgeStatus.WA
+        elif not expected_terminate_normally and judge_result.exit_code == 0:
+            # テストケースは異常終了を想定しているが、実行結果は正常終了した場合
+            # そのプログラムは異常検知できていないため、WAとする。
+            judge_result.result = records.SingleJudgeStatus.WA
+        else:
+            # AC(正解)
+            judge_result.result= records.SingleJudgeStatus.AC
+
+    def _failure_limit(self) -> int:
+        """
+        Judgeテストケースがいくつ失敗したら打ち切るか(0の場合は打ち切らない)
+        """
+        if self.submission_record.eval:
+            return JUDGE_STOP_AFTER_FAILURES_EVAL
+        return JUDGE_STOP_AFTER_FAILURES
+
+    def _stop_after_failures(
+        self,
+        judge_result_list: list[records.JudgeResult],
+        testcase_list: list[records.TestCases]
+    ) -> tuple[list[records.JudgeResult], list[records.TestCases]]:
+        """
+        テストケースの順に見て、失敗の数が上限に達した以降の結果を捨て、(残す結果, 打ち切ったテストケース)を返す。
+        シャードごとに並列に実行した場合も、1つのコンテナで順に実行した場合と同じ結果になる
+        (各シャードは、自分のテストケースの失敗が上限に達するまでは実行しているため)。
+        """
+        failure_limit = self._failure_limit()
+        if failure_limit <= 0:
+            return judge_result_list, []
+        failures = 0
+        for index, judge_result in enumerate(judge_result_list):
+            if judge_result.result != records.SingleJudgeStatus.AC:
+                failures += 1
+            if failures >= failure_limit:
+                # judge_result_listはテストケースの順に並んでいる
+                last_index = next(i for i, testcase in enumerate(testcase_list) if testcase.id == judge_result.testcase_id)
+                return judge_result_list[:index + 1], testcase_list[last_index + 1:]
+        return judge_result_list, []
+
+    def _exec_judge_task_sharded(self, testcase_list: list[records.TestCases]) -> list[records.JudgeResult]:
+        """
+        Judgeテストケースを実行用コンテナとシャードのコンテナに振り分けて並列に実行し、結果をテストケースの順に並べて返す。
+        各コンテナの中では、これまで通りwatchdogでテストケースを1つずつ実行する。
+        """
+        if len(self.shards) == 0:
+            return self._exec_judge_task(container=self.runner_container, testcase_list=testcase_list)
+
+        containers = [self.runner_container] + [container for container, _ in self.shards]
+        # 実行時間の近いテストケースは並んでいることが多いので、1つずつ順番に振り分ける
+        shard_testcase_lists = [testcase_list[index::len(containers)] for index in range(len(containers))]
+        futures = [
+            testcase_shard_executor.submit(self._exec_judge_task, container, shard_testcase_list, SHARD_SOURCE_PATH)
+            for container, shard_testcase_list in zip(containers[1:], shard_testcase_lists[1:])
+        ]
+        try:
+            shard_result_lists = [self._exec_judge_task(container=containers[0], testcase_list=shard_testcase_lists[0])]
+        finally:
+            # 例外で抜ける場合も、他のシャードがコンテナを使い終わるまで待つ
+            wait(futures)
+        shard_result_lists += [future.result() for future in futures]
+
+        # 内部エラーで途中までしか実行していないシャードの分は、結果が抜ける
+        order = {testcase.id: index for index, testcase in enumerate(testcase_list)}
+        return sorted(
+            (judge_result for shard_result_list in shard_result_lists for judge_result in shard_result_list),
+            key=lambda judge_result: order[judge_result.testcase_id]
+        )
+
+    def _closing_procedure(self, submission_record: records.Submission, container: SandboxContainer | None, working_volume: SandboxVolume | None) -> Error:
         # SubmissionSummaryレコードを登録し、submission.progress = 'Done'にする。
-        with SessionLocal() as db:
-            submission_record.progress = records.SubmissionProgressStatus.DONE
-            crud.update_submission_record(
-                db=db,
-                submission_record=submission_record
-            )
+        # claimを失っている場合は、取得し直したジャッジサーバーの結果を上書きしないように、登録せずに後片付けだけを行う
+        submission_record.progress = records.SubmissionProgressStatus.DONE
+        if self.claim_lost():
+            judge_logger.warning(f"submission {submission_record.id}: claim lost, result is discarded")
+        else:
+            with SessionLocal() as db:
+                if not crud.update_submission_record(db=db, submission_record=submission_record):
+                    self._claim_lost = True
+        self._release_resource_volume()
+        if self.sandbox_set is not None:
+            # プールから借りたコンテナとボリュームは削除せずに返却する
+            self.container_pool.release(self.sandbox_set)
+            self.sandbox_set = None
+            return Error.Nothing()
+
+        self._discard_runner_container()
         if container is not None:
             # コンテナの削除
             err = container.remove()
             if not err.silence():
-                judge_logger.error(f"failed to remove container: {container._container.id}")
+                judge_logger.error(f"failed to remove container: {container.containerID}")
                 return err
         
         if working_volume is not None:
             # ボリュームの削除
-            err = working_volume.remove()
+            err = self._remove_working_volume(working_volume)
             if not err.silence():
                 judge_logger.error(f"failed to remove volume: {working_volume.name}")
                 return err
 
         return Error.Nothing()
 
+    def stages(self) -> list[Callable[[], Error | None]]:
+        """
+        ジャッジの各段階。順に呼び出し、Noneが返れば次の段階に進む。
+        Errorが返った場合は、その段階でジャッジが終了している(結果の登録と後片付けも済んでいる)。
+        """
+        return [self.prepare, self.build, self.run, self.persist]
+
     def judge(self) -> Error:
+        # 全ての段階を、このスレッドで順に実行する(段階ごとに別のスレッドで実行する場合はpipeline.pyを参照)
+        try:
+            for stage in self.stages():
+                err = stage()
+                if err is not None:
+                    return err
+            return Error.Nothing()
+        finally:
+            self.finish()
+
+    def finish(self) -> None:
+        # 各段階にかかった時間をログと統計情報に記録する
+        judge_logger.info(f"submission {self.submission_record.id}: {self.timer.summary()}")
+        self.timer.publish()
+
+    def assign_cpuset(self, cpuset: list[int] | None) -> None:
+        """
+        run段階の前に、実行用コンテナに専有させるCPUを決める(prepare段階ではCPUを割り当てずに作成している場合)
+        """
+        self.cpuset = cpuset
+        self.repin_runner = cpuset is not None
+
+    def _error_on_prepare(self, message: str, err: Error, working_volume: SandboxVolume | None, container: SandboxContainer | None = None) -> Error:
+        self.submission_record.result = records.SubmissionSummaryStatus.IE
+        self.submission_record.message = message
+        self.submission_record.detail = err.message
+        return self._closing_procedure(
+            submission_record=self.submission_record,
+            container=container,
+            working_volume=working_volume
+        )
+
+    def prepare(self) -> Error | None:
+        """
+        1. 準備: 作業用ボリュームとビルド用コンテナを用意し、ファイルをアップロードする。
+        実行用コンテナの作成・起動は、バックグラウンドで始めておく
+        """
         # testcase_id(key) -> TestCaseのdict
-        testcase_dict: dict[int, records.TestCases] = {}
         for testcase in self.problem_record.test_cases:
-            testcase_dict[testcase.id] = testcase
+            self.testcase_dict[testcase.id] = testcase
 
         # 仮の値を設定
         self.submission_record.result = records.SubmissionSummaryStatus.AC
@@ -495,104 +905,145 @@ class JudgeInfo:
         self.submission_record.timeMS = 0
         self.submission_record.memoryKB = 0
 
-        # 1. 準備
-        # ボリューム作成
-        working_volume, err = DockerVolume.create(client=self.client)
-        if not err.silence():
-            self.submission_record.result = records.SubmissionSummaryStatus.IE
-            self.submission_record.message = "error when creating volume"
-            self.submission_record.detail = err.message
-            return self._closing_procedure(
-                submission_record=self.submission_record,
-                container=None,
-                working_volume=None
+        # 実行用コンテナのメモリーリミット。512MBの余裕を持たせて、watchdogがメモリーリミット超過を検知し、
+        # ユーザープログラムをkillできるようにする。
+        self.runner_memory_mb = self.problem_record.memoryMB + RUNNER_CONTAINER_MEMORY_MARGIN_MB
+        build_cpuset = self.build_cpuset if self.build_cpuset is not None else self.cpuset
+
+        prepare_start = time.monotonic()
+        if self.container_pool is not None:
+            # プールから起動済みのコンテナとボリュームを借りる
+            self.sandbox_set, err = self.container_pool.acquire(runner_memory_mb=self.runner_memory_mb, cpuset=build_cpuset)
+            if not err.silence():
+                return self._error_on_prepare("error when acquiring sandbox from container pool", err, working_volume=None)
+            self.working_volume = self.sandbox_set.volume
+            self.build_container = self.sandbox_set.build_container
+            err = Error.Nothing()
+        else:
+            if self.resource_volumes is not None:
+                # 問題のリソースボリュームを読み取り専用でマウントする
+                self.resource_volume, err = self.resource_volumes.acquire(
+                    key=(self.submission_record.lecture_id, self.submission_record.assignment_id, self.submission_record.eval),
+                    arranged_files=[file.path for file in self.problem_record.arranged_files],
+                    stdin_files=[testcase.stdin_path for testcase in self.problem_record.test_cases if testcase.stdin_path is not None],
+                    uid=int(GUEST_UID),
+                    gid=int(GUEST_GID)
+                )
+                if not err.silence():
+                    return self._error_on_prepare("error when preparing resource volume", err, working_volume=None)
+                self.resource_mount = VolumeMountInfo(path=RESOURCE_MOUNT_PATH, volume=self.resource_volume.volume, read_only=True)
+
+            # 作業用ボリュームの作成(プールがある場合は、作成済みのものを借りる)
+            if self.volume_pool is not None:
+                working_volume, err = self.volume_pool.acquire()
+            else:
+                working_volume, err = create_working_volume()
+            if not err.silence():
+                return self._error_on_prepare("error when creating volume", err, working_volume=None)
+            self.working_volume = working_volume
+
+            # Judgeテストケースを複数の実行用コンテナに振り分ける場合は、その数だけ作成する
+            judge_task_count = len([task for task in self.problem_record.test_cases if task.type == records.EvaluationType.Judge])
+            self.shard_count = testcase_shard_count(judge_task_count, len(self.cpuset) if self.cpuset is not None else None)
+
+            # 実行用コンテナは、ビルドと並行して作成・起動しておく
+            self.runner_future = sandbox_handoff_executor.submit(
+                self._start_runner_container, self.working_volume, self.runner_memory_mb, self.resource_mount, self._shard_cpuset(0)
             )
-        
-        # コンパイル用のコンテナを立ち上げる
-        build_container_info = ContainerInfo(
-            client=self.client,
-            imageName="checker-lang-gcc",
-            arguments=["sleep", "3600"], # 最大1時間起動
-            interactive=False,
-            user="root",
-            groups=["root"],
-            memoryLimitMB=1024,
-            pidsLimit=100,
-            workDir="/home/guest",
-            volumeMountInfoList=[
-                VolumeMountInfo(path="/home/guest", volume=working_volume, read_only=False)
+            self.shard_futures = [
+                sandbox_handoff_executor.submit(self._start_shard_container, index)
+                for index in range(1, self.shard_count)
             ]
-        )
+            
+            # コンパイル用のコンテナを立ち上げる
+            self.build_container = create_build_container(
+                working_volume=self.working_volume,
+                cpuset=build_cpuset,
+                resource_mount=self.resource_mount
+            )
 
-        # コンテナを起動する
-        err = build_container_info.start()
+            # コンテナを起動する
+            err = self.build_container.start()
         if not err.silence():
-            self.submission_record.result = records.SubmissionSummaryStatus.IE
-            self.submission_record.message = "error when starting build container"
-            self.submission_record.detail = err.message
-            return self._closing_procedure(
-                submission_record=self.submission_record,
-                container=None,
-                working_volume=working_volume
-            )
+            return self._error_on_prepare("error when starting build container", err, working_volume=self.working_volume)
+        self.timer.record("prepare", (time.monotonic() - prepare_start) * 1000)
         
-        # コンテナにジャッジリクエストでアップロードされたファイルをコピーする
+        # コンテナにジャッジリクエストでアップロードされたファイルと、問題で用意されたファイル(arranged_files)を
+        # 1つのtarにまとめてコピーする。同名のファイルがある場合は、arranged_filesが優先される。
         abs_upload_dir = Path(UPLOAD_DIR) / str(self.submission_record.upload_dir)
-        err = build_container_info.uploadTree(srcRootInHost=abs_upload_dir, dstRootInContainer="/home/guest/", uid=int(GUEST_UID), gid=int(GUEST_GID))
+        upload_entries = TarEntry.listTree(srcRootInHost=abs_upload_dir, uid=int(GUEST_UID), gid=int(GUEST_GID))
+        if self.resource_volume is not None:
+            # arranged_filesはリソースボリュームにあるので、シンボリックリンクだけを置く
+            arranged_archive = self.resource_volume.links
+        else:
+            arranged_entries = [
+                TarEntry(srcInHost=RESOURCE_DIR / file.path, arcname=Path(file.path).name, uid=int(GUEST_UID), gid=int(GUEST_GID))
+                for file in self.problem_record.arranged_files
+            ]
+            # arranged_filesのtarは問題ごとにキャッシュしたものを使う
+            arranged_archive = arranged_files_cache.get(
+                key=(self.submission_record.lecture_id, self.submission_record.assignment_id, self.submission_record.eval),
+                entries=arranged_entries
+            )
+            if arranged_archive is None:
+                upload_entries += arranged_entries
+        with self.timer.measure("upload"):
+            err = self.build_container.uploadArchive(
+                entries=upload_entries,
+                dstInContainer="/home/guest/",
+                prebuiltMembers=[arranged_archive] if arranged_archive is not None else None
+            )
         if not err.silence():
-            self.submission_record.result = records.SubmissionSummaryStatus.IE
-            self.submission_record.message = "error when copying files to build container"
-            self.submission_record.detail = err.message
+            return self._error_on_prepare(
+                "error when copying files to build container", err,
+                working_volume=self.working_volume, container=self.build_container
+            )
+        return None
+
+    def build(self) -> Error | None:
+        """
+        2. Builtテストケース(コンパイル)を実行し、ビルド用コンテナから実行用コンテナに引き継ぐ
+        """
+        if self.claim_lost():
             return self._closing_procedure(
                 submission_record=self.submission_record,
-                container=build_container_info,
-                working_volume=working_volume
+                container=self.build_container,
+                working_volume=self.working_volume
             )
-        
-        abs_arranged_filepaths = [RESOURCE_DIR / file.path for file in self.problem_record.arranged_files]
-        
-        for filepath in abs_arranged_filepaths:
-            err = build_container_info.uploadFile(srcInHost=filepath, dstInContainer="/home/guest/", uid=int(GUEST_UID), gid=int(GUEST_GID))
-            if not err.silence():
-                self.submission_record.result = records.SubmissionSummaryStatus.IE
-                self.submission_record.message = "error when copying files to build container"
-                self.submission_record.detail = err.message
-                return self._closing_procedure(
-                    submission_record=self.submission_record,
-                    container=build_container_info,
-                    working_volume=working_volume
-                )
-
-        judge_result_list = []
-
-        # 2. Builtテストケース(コンパイル)を実行する
         try:
             built_task_list = [task for task in self.problem_record.test_cases if task.type == records.EvaluationType.Built]
-            build_exec_result_list = self._exec_built_task(
-                container=build_container_info,
-                testcase_list=built_task_list,
-            )
-            judge_result_list += build_exec_result_list
+            with self.timer.measure("build"):
+                build_exec_result_list = self._exec_built_task(
+                    container=self.build_container,
+                    testcase_list=built_task_list,
+                )
+            self.judge_result_list += build_exec_result_list
             
             # ジャッジ結果の集約
             for exec_result in build_exec_result_list:
                 self.submission_record.timeMS = max(self.submission_record.timeMS, exec_result.timeMS)
                 self.submission_record.memoryKB = max(self.submission_record.memoryKB, exec_result.memoryKB)
-                self.submission_record.score += testcase_dict[exec_result.testcase_id].score if exec_result.result == records.SingleJudgeStatus.AC else 0
+                self.submission_record.score += self.testcase_dict[exec_result.testcase_id].score if exec_result.result == records.SingleJudgeStatus.AC else 0
                 self.submission_record.result = max(self.submission_record.result, records.SubmissionSummaryStatus[exec_result.result.value])
             
                 if exec_result.result != records.SingleJudgeStatus.AC:
-                    corresponding_testcase = testcase_dict[exec_result.testcase_id]
+                    corresponding_testcase = self.testcase_dict[exec_result.testcase_id]
                     self.submission_record.detail += f"{corresponding_testcase.message_on_fail}: {exec_result.result.value} (-{corresponding_testcase.score})\n"
         except Exception as e:
             # ジャッジ処理の際に、内部エラーが発生した場合
-            # コンテナの削除
             error_message = f"error when executing built test cases: {e}"
-            err = build_container_info.remove()
+            self._release_resource_volume()
+            if self.sandbox_set is not None:
+                # コンテナの状態が分からないので、再利用せずに破棄する
+                self.container_pool.release(self.sandbox_set, broken=True)
+                self.sandbox_set = None
+                raise ValueError(error_message)
+            # コンテナの削除
+            err = self.build_container.remove()
             if not err.silence():
                 error_message += f"\nfailed to remove build container: {err.message}"
             # ボリュームの削除
-            err = working_volume.remove()
+            err = self._remove_working_volume(self.working_volume)
             if not err.silence():
                 error_message += f"\nfailed to remove volume: {err.message}"
             raise ValueError(error_message)
@@ -601,91 +1052,130 @@ class JudgeInfo:
         #       ビルドに失敗した場合でもジャッジを行うようにした。
         # if self.submission_record.result != records.SubmissionSummaryStatus.AC:
         #     self.submission_record.message += "ビルドに失敗しました\n"
-        #     self.submission_record.judge_results = judge_result_list
+        #     self.submission_record.judge_results = self.judge_result_list
         #     return self._closing_procedure(
         #         submission_record=self.submission_record,
-        #         container=build_container_info,
-        #         working_volume=working_volume
+        #         container=self.build_container,
+        #         working_volume=self.working_volume
         #     )
         
-        # ビルドコンテナを削除
-        err = build_container_info.remove()
+        if self.sandbox_set is not None:
+            # プールから借りた実行用コンテナは起動済み
+            self.runner_container = self.sandbox_set.runner_container
+            err = Error.Nothing()
+        else:
+            # ビルド用コンテナの削除はバックグラウンドで行い、ビルド中に起動しておいた実行用コンテナに引き継ぐ
+            self._remove_in_background(self.build_container)
+            with self.timer.measure("runner_wait"):
+                self.runner_container, err = self._take_runner_container()
+                shard_err = self._take_shards()
+            if err.silence():
+                err = shard_err
         if not err.silence():
-            judge_logger.error(f"failed to remove build container: {build_container_info._container.id}")
-            return self._closing_procedure(
-                submission_record=self.submission_record,
-                container=None,
-                working_volume=working_volume
-            )
-        
-        # 実行用のコンテナを立ち上げる
-        sandbox_container_info = ContainerInfo(
-            client=self.client,
-            imageName="binary-runner",
-            arguments=["sleep", "3600"], # 最大1時間起動
-            interactive=False,
-            user="root",
-            groups=["root"],
-            # メモリーリミットに512MBの余裕を持たせて、watchdogがメモリーリミット超過を検知し、
-            # ユーザープログラムをkillできるようにする。
-            memoryLimitMB=self.problem_record.memoryMB + 512,
-            pidsLimit=100,
-            workDir="/home/guest",
-            volumeMountInfoList=[
-                VolumeMountInfo(path="/home/guest", volume=working_volume, read_only=False)
-            ]
-        )
-        
-        # コンテナを起動する
-        err = sandbox_container_info.start()
-        if not err.silence():
-            judge_logger.error(f"failed to start sandbox container: {sandbox_container_info._container.id}")
+            judge_logger.error(f"failed to start sandbox container: {err.message}")
             self.submission_record.result = records.SubmissionSummaryStatus.IE
             self.submission_record.message += "error when starting sandbox container\n"
             self.submission_record.detail += f"{err.message}\n"
-            self.submission_record.judge_results = judge_result_list
+            self.submission_record.judge_results = self.judge_result_list
             return self._closing_procedure(
                 submission_record=self.submission_record,
                 container=None,
-                working_volume=working_volume
+                working_volume=self.working_volume
             )
+        return None
+
+    def run(self) -> Error | None:
+        """
+        3. Judgeテストケース(実行・チェック)を実行する
+        """
+        if self.claim_lost():
+            return self._closing_procedure(
+                submission_record=self.submission_record,
+                container=self.runner_container,
+                working_volume=self.working_volume
+            )
+        if self.repin_runner:
+            # assign_cpusetで割り当てられたCPUに、実行用コンテナを固定し直す
+            self.repin_runner = False
+            self._cap_shards()
+            containers = [self.runner_container] + [container for container, _ in self.shards]
+            for index, container in enumerate(containers):
+                err = container.update_limits(cpuset=self._shard_cpuset(index))
+                if not err.silence():
+                    break
+            if not err.silence():
+                self.submission_record.result = records.SubmissionSummaryStatus.IE
+                self.submission_record.message += "error when pinning sandbox container\n"
+                self.submission_record.detail += f"{err.message}\n"
+                self.submission_record.judge_results = self.judge_result_list
+                return self._closing_procedure(
+                    submission_record=self.submission_record,
+                    container=self.runner_container,
+                    working_volume=self.working_volume
+                )
 
         try:
-            # Judgeテストケース(実行・チェック)を実行する
             judge_task_list = [task for task in self.problem_record.test_cases if task.type == records.EvaluationType.Judge]
-            judge_exec_result_list = self._exec_judge_task(
-                container=sandbox_container_info,
-                testcase_list=judge_task_list
+            # 過去の結果から、失敗しやすく実行時間の短いテストケースを先に実行する(JUDGE_TESTCASE_ORDERING=trueの場合)
+            judge_task_list = judge_testcase_orderer.order(
+                key=(self.submission_record.lecture_id, self.submission_record.assignment_id, self.submission_record.eval),
+                testcase_list=judge_task_list,
+                time_ms=self.problem_record.timeMS,
+                memory_mb=self.problem_record.memoryMB
             )
-            judge_result_list += judge_exec_result_list
+            with self.timer.measure("judge"):
+                judge_exec_result_list = self._exec_judge_task_sharded(testcase_list=judge_task_list)
+            judge_exec_result_list, skipped_testcase_list = self._stop_after_failures(judge_exec_result_list, judge_task_list)
+            self.judge_result_list += judge_exec_result_list
 
             for exec_result in judge_exec_result_list:
                 self.submission_record.timeMS = max(self.submission_record.timeMS, exec_result.timeMS)
                 self.submission_record.memoryKB = max(self.submission_record.memoryKB, exec_result.memoryKB)
-                self.submission_record.score += testcase_dict[exec_result.testcase_id].score if exec_result.result == records.SingleJudgeStatus.AC else 0
+                self.submission_record.score += self.testcase_dict[exec_result.testcase_id].score if exec_result.result == records.SingleJudgeStatus.AC else 0
                 self.submission_record.result = max(self.submission_record.result, records.SubmissionSummaryStatus[exec_result.result.value])
-                
-            if exec_result.result != records.SingleJudgeStatus.AC:
-                corresponding_testcase = testcase_dict[exec_result.testcase_id]
-                self.submission_record.detail += f"{corresponding_testcase.message_on_fail}: {exec_result.result.value} (-{corresponding_testcase.score})\n"
+
+                if exec_result.result != records.SingleJudgeStatus.AC:
+                    corresponding_testcase = self.testcase_dict[exec_result.testcase_id]
+                    self.submission_record.detail += f"{corresponding_testcase.message_on_fail}: {exec_result.result.value} (-{corresponding_testcase.score})\n"
+
+            if len(skipped_testcase_list) > 0:
+                # 打ち切ったテストケースは失敗扱い(得点なし)とし、JudgeResultは記録しない。
+                # completed_taskは、結果を記録したテストケースの数にする(シャードが上限に達するまでに実行し、
+                # 捨てた結果は数えない)。total_taskとの差が、打ち切ったテストケースの数になる
+                self.submission_record.message += f"stopped after {self._failure_limit()} failed test case(s): {len(skipped_testcase_list)} test case(s) skipped\n"
+                for skipped_testcase in skipped_testcase_list:
+                    self.submission_record.detail += f"{skipped_testcase.message_on_fail}: skipped (-{skipped_testcase.score})\n"
+                with self._progress_lock:
+                    self.submission_record.completed_task = self.submission_record.total_task - len(skipped_testcase_list)
+                    self._update_progress_of_submission()
         except Exception as e:
             # ジャッジ処理の際に、内部エラーが発生した場合
-            # コンテナの削除
             error_message = f"error when executing judge test cases: {e}"
-            err = sandbox_container_info.remove()
+            self._release_resource_volume()
+            if self.sandbox_set is not None:
+                # コンテナの状態が分からないので、再利用せずに破棄する
+                self.container_pool.release(self.sandbox_set, broken=True)
+                self.sandbox_set = None
+                raise ValueError(error_message)
+            # コンテナの削除
+            err = self.runner_container.remove()
             if not err.silence():
                 error_message += f"\nfailed to remove sandbox container: {err.message}"
             # ボリュームの削除
-            err = working_volume.remove()
+            err = self._remove_working_volume(self.working_volume)
             if not err.silence():
                 error_message += f"\nfailed to remove volume: {err.message}"
             raise ValueError(error_message)
+        return None
 
-        self.submission_record.judge_results = judge_result_list
-
-        # 全体の結果を登録
-        return self._closing_procedure(
-            submission_record=self.submission_record,
-            container=sandbox_container_info,
-            working_volume=working_volume
-        )
+    def persist(self) -> Error:
+        """
+        4. 全体の結果をDBに登録し、コンテナとボリュームを片付ける
+        """
+        self.submission_record.judge_results = self.judge_result_list
+        with self.timer.measure("persist"):
+            return self._closing_procedure(
+                submission_record=self.submission_record,
+                container=self.runner_container,
+                working_volume=self.working_volume
+            )
@@ -0,0 +1,28 @@
+"""
+ジャッジサーバーの統計情報(カウンタ・ゲージ)を保持する。GET /metrics で参照できる。
+"""
+from threading import Lock
+
+
+class JudgeMetrics:
+    _values: dict[str, float]
+    _lock: Lock
+
+    def __init__(self):
+        self._values = {}
+        self._lock = Lock()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: float) -> None:
+        with self._lock:
+            self._values[name] = value
+
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+
+judge_metrics = JudgeMetrics()
@@ -0,0 +1,54 @@
+"""
+1つのジャッジの各段階(準備・アップロード・ビルド・実行用コンテナの起動待ちなど)にかかった時間を計測する。
+ジャッジの終了時にログに出力し、/metricsには段階ごとの合計時間[ms]と回数を記録する。
+"""
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+from .metrics import judge_metrics
+
+
+class PhaseTimer:
+    _elapsed_ms: dict[str, float]  # 段階の名前 -> かかった時間[ms] (計測した順)
+    _start: float
+    _lock: Lock  # バックグラウンドのスレッドからも記録する
+
+    def __init__(self):
+        self._elapsed_ms = {}
+        self._start = time.monotonic()
+        self._lock = Lock()
+
+    @contextmanager
+    def measure(self, phase: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, (time.monotonic() - start) * 1000)
+
+    def record(self, phase: str, elapsed_ms: float) -> None:
+        # 同じ段階を複数回計測した場合は合計する
+        with self._lock:
+            self._elapsed_ms[phase] = self._elapsed_ms.get(phase, 0) + elapsed_ms
+
+    def elapsed_ms(self) -> dict[str, float]:
+        with self._lock:
+            return dict(self._elapsed_ms)
+
+    def total_ms(self) -> float:
+        return (time.monotonic() - self._start) * 1000
+
+    def summary(self) -> str:
+        phases = " ".join(f"{phase}={elapsed:.0f}ms" for phase, elapsed in self.elapsed_ms().items())
+        return f"{phases} total={self.total_ms():.0f}ms"
+
+    def publish(self) -> None:
+        """
+        /metricsに、段階ごとの合計時間と回数を加算する
+        """
+        for phase, elapsed in self.elapsed_ms().items():
+            judge_metrics.increment(f"phase_{phase}_ms_total", elapsed)
+            judge_metrics.increment(f"phase_{phase}_count")
+        judge_metrics.increment("phase_total_ms_total", self.total_ms())
+        judge_metrics.increment("phase_total_count")
@@ -0,0 +1,303 @@
+"""
+ジャッジを4つの段階に分け、段階ごとに別のキューとスレッドで処理するパイプライン(JUDGE_STAGED_PIPELINE=true)
+
+    prepare -> build -> run -> persist
+
+* prepare: 作業用ボリューム・ビルド用コンテナの用意と、ファイルのアップロード (同時にJUDGE_PREPARE_WORKERS個)
+* build: Builtテストケース(コンパイル)。ビルド用コンテナはJUDGE_BUILD_CPUSETのCPUで動かし、
+  実行用の専有CPUは使わない (同時にJUDGE_BUILD_WORKERS個)
+* run: Judgeテストケース。WorkerPoolと同じく、ジャッジごとに専有CPUを割り当てて実行する
+  (同時実行数はAdmissionControllerとCpuAllocatorが決める)
+* persist: 結果のDBへの登録と後片付け (同時にJUDGE_PERSIST_WORKERS個)
+
+WorkerPoolでは1つのスレッドが1つのジャッジを最初から最後まで受け持つので、コンパイルに時間のかかる提出が
+実行の枠を塞いでしまう。パイプラインでは、実行の枠(専有CPU)はrun段階の間だけ使う。
+段階の間のキューはJUDGE_STAGE_QUEUE_SIZEまでで、次の段階のキューが一杯の場合は前の段階が待つ(バックプレッシャー)。
+メモリは、ジャッジリクエストを受け付けてからpersist段階が終わるまで予約する。
+
+/metricsに記録する統計情報(<段階>はprepare, build, run, persist)
+* stage_<段階>_queue_depth: キューで待っているジャッジの数
+* stage_<段階>_busy: 処理中のジャッジの数
+* stage_<段階>_completed: 処理を終えたジャッジの数。単位時間あたりの増分が、その段階のスループットになる
+* stage_<段階>_busy_ms_total: 処理にかかった時間の合計[ms] (completedで割ると1件あたりの処理時間)
+* stage_<段階>_wait_ms_total: キューで待った時間の合計[ms] (completedで割ると1件あたりの待ち時間)
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from typing import Callable
+import asyncio
+import os
+import time
+import traceback
+
+from .db import records
+from .sandbox.my_error import Error
+from .sandbox.cpuset import CpuAllocator, parse_cpu_list
+from .admission import AdmissionController, JUDGE_BUILD_CPUSET
+from .judge import JudgeInfo
+from .container_pool import ContainerPool
+from .resource_volume import ResourceVolumeManager
+from .volume_pool import VolumePool
+from .metrics import judge_metrics
+from .log.config import judge_logger
+
+load_dotenv()
+
+# ジャッジを段階ごとに別のスレッドで処理するか(falseの場合は、WorkerPoolで1つのスレッドが最後まで処理する)
+JUDGE_STAGED_PIPELINE = os.getenv("JUDGE_STAGED_PIPELINE", "false").lower() == "true"
+# prepare, build, persist段階の同時実行数。JUDGE_BUILD_WORKERS=0の場合はJUDGE_BUILD_CPUSETのCPU数(未指定なら2)
+JUDGE_PREPARE_WORKERS = int(os.getenv("JUDGE_PREPARE_WORKERS", "2"))
+JUDGE_BUILD_WORKERS = int(os.getenv("JUDGE_BUILD_WORKERS", "0"))
+JUDGE_PERSIST_WORKERS = int(os.getenv("JUDGE_PERSIST_WORKERS", "2"))
+# 各段階のキューに溜められるジャッジの数
+JUDGE_STAGE_QUEUE_SIZE = int(os.getenv("JUDGE_STAGE_QUEUE_SIZE", "2"))
+
+# run段階のスレッド数の上限。実際の同時実行数はAdmissionControllerとCpuAllocatorが決める
+RUN_THREAD_LIMIT = 64
+
+STAGE_NAMES = ["prepare", "build", "run", "persist"]
+
+
+def default_build_workers() -> int:
+    if JUDGE_BUILD_WORKERS > 0:
+        return JUDGE_BUILD_WORKERS
+    build_cpus = parse_cpu_list(JUDGE_BUILD_CPUSET)
+    return len(build_cpus) if len(build_cpus) > 0 else 2
+
+
+class StagedJob:
+    job: str
+    submission: records.Submission
+    memory_mb: int  # 予約しているメモリ量[MB]
+    on_done: Callable | None
+    judge_info: JudgeInfo | None  # prepare段階で作成する
+    started_at: datetime
+    enqueued_at: float  # 今の段階のキューに入った時刻
+
+    def __init__(self, job: str, submission: records.Submission, memory_mb: int, on_done: Callable | None):
+        self.job = job
+        self.submission = submission
+        self.memory_mb = memory_mb
+        self.on_done = on_done
+        self.judge_info = None
+        self.started_at = datetime.now()
+        self.enqueued_at = time.monotonic()
+
+
+class Stage:
+    name: str
+    index: int  # JudgeInfo.stages()の何番目の段階か
+    limit: Callable[[], int]  # 同時に処理するジャッジの数の上限
+    queue: asyncio.Queue[StagedJob]
+    executor: ThreadPoolExecutor
+    busy: int  # 処理中のジャッジの数
+
+    def __init__(self, name: str, limit: Callable[[], int], queue_size: int, max_threads: int):
+        self.name = name
+        self.index = STAGE_NAMES.index(name)
+        self.limit = limit
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix=f"stage-{name}")
+        self.busy = 0
+
+
+class StagedPipeline:
+    """
+    JobManagerからは、WorkerPoolと同じように使う(ジョブの割り当てはsubmit_judgeで行う)
+    """
+    admission: AdmissionController
+    cpu_allocator: CpuAllocator | None
+    stages: list[Stage]
+    jobs: dict[str, StagedJob]  # 受け付けてから、persist段階が終わるまでのジャッジ
+    _changed: asyncio.Event
+    _tasks: set[asyncio.Task]
+
+    def __init__(
+        self,
+        admission: AdmissionController,
+        cpu_allocator: CpuAllocator | None = None,
+        container_pool: ContainerPool | None = None,
+        resource_volumes: ResourceVolumeManager | None = None,
+        volume_pool: VolumePool | None = None,
+        prepare_workers: int = JUDGE_PREPARE_WORKERS,
+        build_workers: int | None = None,
+        persist_workers: int = JUDGE_PERSIST_WORKERS,
+        queue_size: int = JUDGE_STAGE_QUEUE_SIZE,
+    ):
+        self.admission = admission
+        self.cpu_allocator = cpu_allocator
+        self.container_pool = container_pool
+        self.resource_volumes = resource_volumes
+        self.volume_pool = volume_pool
+        self.build_cpuset = parse_cpu_list(JUDGE_BUILD_CPUSET) or None
+        self.queue_size = queue_size
+        build_workers = build_workers if build_workers is not None else default_build_workers()
+        self.stages = [
+            Stage("prepare", lambda: prepare_workers, queue_size=0, max_threads=prepare_workers),
+            Stage("build", lambda: build_workers, queue_size=queue_size, max_threads=build_workers),
+            Stage("run", lambda: self.run_workers, queue_size=queue_size, max_threads=RUN_THREAD_LIMIT),
+            Stage("persist", lambda: persist_workers, queue_size=queue_size, max_threads=persist_workers),
+        ]
+        self.jobs = {}
+        self._changed = asyncio.Event()
+        self._tasks = set()
+        self._update_metrics()
+
+    @property
+    def run_workers(self) -> int:
+        """
+        run段階の同時実行数(WorkerPool.max_workersと同じ)
+        """
+        run_workers = min(self.admission.max_workers, RUN_THREAD_LIMIT)
+        if self.cpu_allocator is not None:
+            run_workers = min(run_workers, self.cpu_allocator.slots())
+        return run_workers
+
+    @property
+    def max_workers(self) -> int:
+        """
+        同時に受け付けるジャッジの数(全ての段階の処理中の数 + キューに溜められる数)
+        prepare段階の前のキューも、他の段階と同じ長さまでとする
+        """
+        return sum(stage.limit() for stage in self.stages) + self.queue_size * len(self.stages)
+
+    def available_workers(self) -> int:
+        return self.max_workers - len(self.jobs)
+
+    def capacity_changed(self) -> None:
+        self._update_metrics()
+        self._changed.set()
+
+    def _update_metrics(self) -> None:
+        judge_metrics.set("workers_max", self.max_workers)
+        judge_metrics.set("workers_active", len(self.jobs))
+        judge_metrics.set("memory_budget_mb", self.admission.memory_budget_mb)
+        judge_metrics.set("memory_reserved_mb", self.admission.reserved_memory_mb())
+        if self.cpu_allocator is not None:
+            judge_metrics.set("cpus_pinnable", len(self.cpu_allocator.cpus))
+            judge_metrics.set("cpus_free", len(self.cpu_allocator.free_cpus()))
+        for stage in self.stages:
+            judge_metrics.set(f"stage_{stage.name}_queue_depth", stage.queue.qsize())
+            judge_metrics.set(f"stage_{stage.name}_busy", stage.busy)
+
+    async def _wait_until(self, predicate) -> None:
+        # イベントループ上でのみ状態が変化するので、確認からwaitまでの間に通知を取りこぼすことはない
+        while not predicate():
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def wait_for_available_worker(self) -> None:
+        await self._wait_until(lambda: self.available_workers() > 0)
+
+    async def wait_for_admission(self, memory_mb: int) -> None:
+        await self._wait_until(lambda: self.available_workers() > 0 and self.admission.fits_memory(memory_mb))
+
+    def _can_start(self, stage: Stage) -> bool:
+        if stage.busy >= stage.limit():
+            return False
+        if stage.name == "run" and self.cpu_allocator is not None:
+            return len(self.cpu_allocator.free_cpus()) >= self.cpu_allocator.cpus_per_job
+        return True
+
+    def start(self) -> None:
+        """
+        イベントループ上で呼び出すこと
+        """
+        for index, stage in enumerate(self.stages):
+            next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            self._spawn(self._dispatch(stage, next_stage))
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def submit_judge(self, job: str, submission: records.Submission, memory_mb: int = 0, on_done=None) -> bool:
+        """
+        memory_mb[MB]のメモリを予約して、ジャッジをprepare段階のキューに入れる。persist段階が終わる(か途中で
+        ジャッジが終了する)と、イベントループ上でon_done(結果)が呼ばれ、メモリが解放される。
+        """
+        if self.available_workers() <= 0:
+            return False
+        staged_job = StagedJob(job, submission, memory_mb, on_done)
+        self.jobs[job] = staged_job
+        self.admission.admit(job, memory_mb)
+        self.stages[0].queue.put_nowait(staged_job)
+        self._update_metrics()
+        return True
+
+    async def _dispatch(self, stage: Stage, next_stage: Stage | None) -> None:
+        while True:
+            job = await stage.queue.get()
+            await self._wait_until(lambda: self._can_start(stage))
+            stage.busy += 1
+            self._spawn(self._process(stage, next_stage, job))
+
+    async def _process(self, stage: Stage, next_stage: Stage | None, job: StagedJob) -> None:
+        judge_metrics.increment(f"stage_{stage.name}_wait_ms_total", (time.monotonic() - job.enqueued_at) * 1000)
+        cpuset = None
+        if stage.name == "run" and self.cpu_allocator is not None:
+            cpuset = self.cpu_allocator.allocate(job.job)
+        self._update_metrics()
+
+        start = time.monotonic()
+        result: Error | Exception | None
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                stage.executor, self._run_stage, stage, job, cpuset
+            )
+        except Exception as e:
+            judge_logger.error(f"Error judging submission in {stage.name} stage: {e}")
+            judge_logger.error(f"スタックトレース:\n{''.join(traceback.format_exception(e))}")
+            result = e
+        finally:
+            # 専有CPUは、次の段階のキューが空くのを待たずに解放する
+            if cpuset is not None:
+                self.cpu_allocator.release(job.job)
+            judge_metrics.increment(f"stage_{stage.name}_busy_ms_total", (time.monotonic() - start) * 1000)
+            judge_metrics.increment(f"stage_{stage.name}_completed")
+            self._changed.set()
+
+        if result is None and next_stage is not None:
+            job.enqueued_at = time.monotonic()
+            self._update_metrics()
+            # 次の段階のキューが一杯の場合は、この段階の枠を使ったまま空くのを待つ(バックプレッシャー)
+            await next_stage.queue.put(job)
+        else:
+            self._finish(job, result)
+        stage.busy -= 1
+        self._update_metrics()
+        self._changed.set()
+
+    def _run_stage(self, stage: Stage, job: StagedJob, cpuset: list[int] | None) -> Error | None:
+        # stage.executorのスレッドで実行される
+        if job.judge_info is None:
+            job.judge_info = JudgeInfo(
+                job.submission,
+                container_pool=self.container_pool,
+                resource_volumes=self.resource_volumes,
+                volume_pool=self.volume_pool,
+                build_cpuset=self.build_cpuset
+            )
+        if stage.name == "run":
+            job.judge_info.assign_cpuset(cpuset)
+        return job.judge_info.stages()[stage.index]()
+
+    def _finish(self, job: StagedJob, result: Error | Exception | None) -> None:
+        if job.judge_info is not None:
+            job.judge_info.finish()
+        self.jobs.pop(job.job, None)
+        self.admission.release(job.job)
+        judge_logger.info(f"job: \"{job.job}\", date: {job.started_at}, result: {result}")
+        if job.on_done is not None:
+            job.on_done(result)
+
+    async def join(self) -> None:
+        await self._wait_until(lambda: len(self.jobs) == 0)
+
+    def shutdown(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        for stage in self.stages:
+            stage.executor.shutdown(wait=True, cancel_futures=True)
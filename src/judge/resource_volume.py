@@ -0,0 +1,249 @@
+"""
+問題ごとの読み取り専用リソースボリューム
+
+arranged_files(問題で用意されたファイル)とテストケースの標準入力のファイルは、同じ問題の全ての提出で同じである。
+ResourceVolumeManagerは、これらを問題(のバージョン)ごとに1つのDockerボリュームにまとめておき、
+ジャッジ用のコンテナにRESOURCE_MOUNT_PATHとして読み取り専用でマウントさせる。
+* 作業用ボリューム(/home/guest)には、arranged_filesへのシンボリックリンクだけをアップロードする
+* 標準入力は、watchdogがボリューム内のファイルを直接開く(TaskInfo.stdinPath)。
+  標準入力のファイルはrootしか読めないようにしておくので、ユーザープログラムから他のテストケースの入力は読めない
+* 各ファイルのパス・サイズ・更新時刻が変わった場合(問題が更新された場合)は新しいボリュームを作り、
+  古いボリュームは、使っているジャッジが無くなった時点で削除する
+* ジャッジサーバーの異常終了などで残ったボリュームは、起動時にremove_orphansで削除する
+"""
+from dotenv import load_dotenv
+from pathlib import Path
+from threading import Lock
+import tarfile
+import os
+import docker
+
+from .sandbox.execute import ContainerInfo, DockerVolume, VolumeMountInfo, TarEntry
+from .sandbox.my_error import Error
+from .archive_cache import fingerprint_of
+from .container_pool import BUILD_IMAGE
+from .docker_client import get_docker_client
+from .sandbox_backend import get_sandbox_backend
+from .log.config import judge_logger
+
+load_dotenv()
+
+RESOURCE_DIR = Path(os.getenv("RESOURCE_PATH"))
+# trueの場合は、問題ごとのリソースボリュームを使う(コンテナプールを使う場合は使われない)
+JUDGE_RESOURCE_VOLUMES = os.getenv("JUDGE_RESOURCE_VOLUMES", "false").lower() == "true"
+
+# コンテナ内でリソースボリュームをマウントするパス
+RESOURCE_MOUNT_PATH = "/home/resource"
+# リソースボリュームに付けるラベル(残ったボリュームの削除に使う)
+RESOURCE_VOLUME_LABEL = "dsa-judge.resource"
+# ボリューム内のarranged_filesと標準入力のファイルの置き場所
+ARRANGED_DIR = "arranged"
+STDIN_DIR = "stdin"
+
+
+class ResourceVolume:
+    volume: DockerVolume
+    fingerprint: tuple  # 作成時の各ファイルのstatの結果
+    links: bytes  # 作業用ボリュームに置く、arranged_filesへのシンボリックリンクのtarのメンバー
+    refcount: int  # このボリュームを使っているジャッジの数
+    stale: bool  # 問題が更新され、新しいボリュームに置き換えられたか
+
+    def __init__(self, volume: DockerVolume, fingerprint: tuple, links: bytes):
+        self.volume = volume
+        self.fingerprint = fingerprint
+        self.links = links
+        self.refcount = 0
+        self.stale = False
+
+    def stdin_path(self, testcase_stdin_path: str) -> str:
+        """
+        テストケースの標準入力のファイルの、コンテナ内でのパス
+        """
+        return f"{RESOURCE_MOUNT_PATH}/{STDIN_DIR}/{testcase_stdin_path}"
+
+
+def symlink_members(links: list[tuple[str, str]], uid: int, gid: int) -> bytes:
+    """
+    (arcname, リンク先)のシンボリックリンクのtarのメンバー
+    """
+    members = b""
+    for arcname, target in links:
+        tarinfo = tarfile.TarInfo(name=arcname)
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = target
+        tarinfo.mode = 0o777
+        tarinfo.uid = uid
+        tarinfo.gid = gid
+        members += tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+    return members
+
+
+class ResourceVolumeManager:
+    _volumes: dict  # キー -> 最新のResourceVolume
+    _lock: Lock
+    _build_locks: dict  # キー -> 同じ問題のボリュームを同時に複数作らないためのロック
+
+    def __init__(self):
+        self._volumes = {}
+        self._lock = Lock()
+        self._build_locks = {}
+
+    @property
+    def client(self) -> docker.DockerClient:
+        return get_docker_client()
+
+    def acquire(
+        self,
+        key,
+        arranged_files: list[str],
+        stdin_files: list[str],
+        uid: int,
+        gid: int,
+    ) -> tuple[ResourceVolume | None, Error]:
+        """
+        keyの問題のリソースボリュームを返す(参照カウントを1増やす)。使い終わったらreleaseすること。
+        arranged_files, stdin_filesはRESOURCE_DIRからの相対パス。
+        arranged_filesへのシンボリックリンクは、uid:gidの所有にする。
+        """
+        arranged_entries = [
+            TarEntry(srcInHost=RESOURCE_DIR / path, arcname=f"{ARRANGED_DIR}/{Path(path).name}", mode=0o444)
+            for path in arranged_files
+        ]
+        stdin_entries = [
+            TarEntry(srcInHost=RESOURCE_DIR / path, arcname=f"{STDIN_DIR}/{path}", mode=0o400)
+            for path in sorted(set(stdin_files))
+        ]
+        entries = arranged_entries + stdin_entries
+        try:
+            fingerprint = fingerprint_of(entries)
+        except OSError as e:
+            return None, Error(f"Failed to stat resource files: {e}")
+
+        resource_volume = self._lookup(key, fingerprint)
+        if resource_volume is not None:
+            return resource_volume, Error.Nothing()
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, Lock())
+        with build_lock:
+            # 待っている間に他のスレッドが作成していれば、それを使う
+            resource_volume = self._lookup(key, fingerprint)
+            if resource_volume is not None:
+                return resource_volume, Error.Nothing()
+
+            links = symlink_members(
+                [(Path(path).name, f"{RESOURCE_MOUNT_PATH}/{ARRANGED_DIR}/{Path(path).name}") for path in arranged_files],
+                uid=uid,
+                gid=gid,
+            )
+            resource_volume, err = self._create(entries, fingerprint, links)
+            if not err.silence():
+                return None, err
+
+            with self._lock:
+                old = self._volumes.get(key)
+                self._volumes[key] = resource_volume
+                resource_volume.refcount += 1
+                remove_old = False
+                if old is not None:
+                    old.stale = True
+                    remove_old = old.refcount == 0
+            if remove_old:
+                self._remove(old)
+            return resource_volume, Error.Nothing()
+
+    def release(self, resource_volume: ResourceVolume) -> None:
+        with self._lock:
+            resource_volume.refcount -= 1
+            remove = resource_volume.stale and resource_volume.refcount == 0
+        if remove:
+            self._remove(resource_volume)
+
+    def _lookup(self, key, fingerprint: tuple) -> ResourceVolume | None:
+        with self._lock:
+            resource_volume = self._volumes.get(key)
+            if resource_volume is None or resource_volume.fingerprint != fingerprint:
+                return None
+            resource_volume.refcount += 1
+            return resource_volume
+
+    def _create(self, entries: list[TarEntry], fingerprint: tuple, links: bytes) -> tuple[ResourceVolume | None, Error]:
+        volume, err = DockerVolume.create(client=self.client, prefix="resource-", labels={RESOURCE_VOLUME_LABEL: "true"})
+        if not err.silence():
+            return None, err
+
+        # ボリュームへの書き込みのために、起動しないコンテナを作ってput_archiveする
+        container = None
+        try:
+            container = ContainerInfo(
+                client=self.client,
+                imageName=BUILD_IMAGE,
+                arguments=["true"],
+                user="root",
+                groups=["root"],
+                workDir=RESOURCE_MOUNT_PATH,
+                volumeMountInfoList=[
+                    VolumeMountInfo(path=RESOURCE_MOUNT_PATH, volume=volume, read_only=False)
+                ]
+            )
+            err = container.uploadArchive(entries=entries, dstInContainer=RESOURCE_MOUNT_PATH)
+        except Exception as e:
+            err = Error(f"Failed to create container for resource volume: {e}")
+        if container is not None:
+            container.remove()
+        if not err.silence():
+            volume.remove()
+            return None, err
+
+        judge_logger.info(f"created resource volume: {volume.name} ({len(entries)} files)")
+        return ResourceVolume(volume, fingerprint, links), Error.Nothing()
+
+    def _remove(self, resource_volume: ResourceVolume) -> None:
+        err = resource_volume.volume.remove()
+        if not err.silence():
+            judge_logger.error(f"failed to remove resource volume: {err.message}")
+
+    def remove_orphans(self) -> None:
+        """
+        以前の起動時に作られ、削除されずに残ったリソースボリュームを削除する
+        """
+        with self._lock:
+            in_use = {resource_volume.volume.name for resource_volume in self._volumes.values()}
+        try:
+            volumes = self.client.volumes.list(filters={"label": RESOURCE_VOLUME_LABEL})
+        except Exception as e:
+            judge_logger.error(f"failed to list resource volumes: {e}")
+            return
+        for volume in volumes:
+            if volume.name in in_use:
+                continue
+            err = DockerVolume(volume.name, volume).remove()
+            if not err.silence():
+                judge_logger.warning(f"failed to remove orphan resource volume: {err.message}")
+
+    def close(self) -> None:
+        """
+        使われていないボリュームを削除する。使用中のものは、releaseされた時点で削除される。
+        """
+        with self._lock:
+            unused = []
+            for resource_volume in self._volumes.values():
+                resource_volume.stale = True
+                if resource_volume.refcount == 0:
+                    unused.append(resource_volume)
+            self._volumes.clear()
+        for resource_volume in unused:
+            self._remove(resource_volume)
+
+
+def create_resource_volume_manager() -> ResourceVolumeManager | None:
+    """
+    JUDGE_RESOURCE_VOLUMES=falseの場合はNone(ジャッジごとにファイルをコピーする)
+    """
+    if not JUDGE_RESOURCE_VOLUMES:
+        return None
+    if get_sandbox_backend().name != "docker":
+        # リソースボリュームはDockerのボリュームとして作るので、他のバックエンドでは使えない
+        judge_logger.warning("JUDGE_RESOURCE_VOLUMES=true requires JUDGE_SANDBOX_BACKEND=docker")
+        return None
+    return ResourceVolumeManager()
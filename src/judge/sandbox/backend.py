@@ -0,0 +1,113 @@
+"""
+サンドボックスのバックエンドの共通インターフェース
+
+ジャッジ処理は、以下の操作だけを使ってサンドボックスを扱う。
+* SandboxBackend: 作業用ボリュームとコンテナの作成
+* SandboxVolume: ボリュームの削除
+* SandboxContainer: コンテナの起動・ファイルのアップロード・コマンドの実行・リミットの変更・削除
+
+実装は以下の2つ(抽象メソッドを全て実装していないバックエンドは、インスタンス化する時にTypeErrorになる)
+* DockerBackend (execute.py): Dockerデーモン経由でコンテナを作る
+* NativeBackend (native.py): Dockerデーモンを経由せず、crunで直接コンテナを作る
+"""
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, TYPE_CHECKING
+
+from .my_error import Error
+
+if TYPE_CHECKING:
+    from .execute import ExecRunResult, TarEntry, VolumeMountInfo
+
+
+class SandboxVolume(ABC):
+    name: str  # ボリューム名
+
+    @abstractmethod
+    def remove(self) -> Error:
+        raise NotImplementedError
+
+
+class SandboxContainer(ABC):
+    containerID: str  # コンテナID
+
+    @abstractmethod
+    def start(self) -> Error:
+        raise NotImplementedError
+
+    @abstractmethod
+    def uploadArchive(self, entries: list["TarEntry"], dstInContainer: Path, prebuiltMembers: list[bytes] | None = None) -> Error:
+        raise NotImplementedError
+
+    @abstractmethod
+    def downloadFile(self, absPathInContainer: Path, dstInHost: Path) -> Error:
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_limits(self, memoryLimitMB: int = -1, cpuset: list[int] | None = None) -> Error:
+        raise NotImplementedError
+
+    @abstractmethod
+    def exec_run(
+        self,
+        command: list[str],
+        user: str = "",
+        workDir: str = "/home/guest",
+        timeoutSec: float = 10.0,
+        onStdoutLine: Callable[[str], bool | None] | None = None,
+        stdin: bytes | None = None,
+    ) -> tuple["ExecRunResult", Error]:
+        '''
+        コマンドを実行する。timeoutSecを過ぎても終了しない場合は、このexecのプロセス(と子孫)だけをkillし、
+        ExecRunResult.timedOut=Trueとエラーを返す(コンテナはそのまま次のexecに使える)。
+        それでも終了しない場合はコンテナをkillする(killされたコンテナのget_status()は"running"以外になる)
+        onStdoutLineを指定した場合は、標準出力を1行受け取るたびに呼び出す。Trueを返した場合は、タイムアウトと同様に
+        このexecのプロセスだけをkillし、ExecRunResult.stopped=Trueを返す(以降の行は通知しない)
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_status(self) -> str:
+        '''
+        戻り値: "created", "running", "exited"など
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self) -> Error:
+        raise NotImplementedError
+
+
+class SandboxBackend(ABC):
+    name: str  # JUDGE_SANDBOX_BACKENDで指定する名前
+
+    @abstractmethod
+    def create_volume(self, prefix: str = "volume-", tmpfsSizeMB: int = -1) -> tuple[SandboxVolume, Error]:
+        '''
+        tmpfsSizeMB > 0 の場合は、サイズ上限付きのtmpfs上にボリュームを作る
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_container(
+        self,
+        imageName: str,
+        arguments: list[str],
+        cgroupParent: str | None = None,
+        user: str | None = None,
+        groups: list[str] | None = None,
+        cpuset: list[int] | None = None,
+        memoryLimitMB: int = -1,
+        stackLimitKB: int = -1,
+        pidsLimit: int = -1,
+        workDir: str = "/home/guest",
+        volumeMountInfoList: list["VolumeMountInfo"] | None = None,
+        readOnlyRootfs: bool = False,
+        tmpfsMounts: dict[str, str] | None = None,
+    ) -> SandboxContainer:
+        '''
+        コンテナを作成する(起動はしない)。作成に失敗した場合は例外を送出する
+        readOnlyRootfs=Trueの場合は、ルートファイルシステムを読み取り専用にする
+        tmpfsMountsには、tmpfsをマウントするパス -> マウントオプション("rw,mode=1777,size=64m"など)を指定できる
+        '''
+        raise NotImplementedError
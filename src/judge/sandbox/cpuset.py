@@ -0,0 +1,144 @@
+"""
+サンドボックスコンテナに割り当てるCPUの管理
+
+* CpuAllocator: ジャッジ(ワーカー)ごとに専有CPUを割り当て、ジャッジ終了時に解放する。
+  同時に動くサンドボックスが同じCPUを取り合わないので、timeMSのぶれや負荷時の誤TLEが減る。
+* setup_isolated_partition: cgroup v2のCGROUP_PARENT(judge.slice)をcpuset.cpus.partition=isolated
+  にし、指定したCPUをサンドボックス専用にする(カーネルのスケジューラが他のプロセスを載せなくなる)。
+"""
+from pathlib import Path
+import os
+import logging
+
+from .my_error import Error
+
+CPUSET_LOGGER = logging.getLogger("sandbox")
+
+
+def define_cpuset_logger(logger: logging.Logger):
+    global CPUSET_LOGGER
+    CPUSET_LOGGER = logger
+
+
+def parse_cpu_list(cpu_list: str) -> list[int]:
+    """
+    "0-3,6" -> [0, 1, 2, 3, 6]
+    """
+    cpus: list[int] = []
+    for part in cpu_list.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += list(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpu_list(cpus: list[int]) -> str:
+    """
+    [0, 1, 2, 3, 6] -> "0-3,6"
+    """
+    ranges: list[str] = []
+    sorted_cpus = sorted(set(cpus))
+    i = 0
+    while i < len(sorted_cpus):
+        j = i
+        while j + 1 < len(sorted_cpus) and sorted_cpus[j + 1] == sorted_cpus[j] + 1:
+            j += 1
+        ranges.append(str(sorted_cpus[i]) if i == j else f"{sorted_cpus[i]}-{sorted_cpus[j]}")
+        i = j + 1
+    return ",".join(ranges)
+
+
+def read_cpu_list(cgroup_root: Path, cgroup_parent: str | None) -> list[int]:
+    """
+    サンドボックスが使えるCPUのリスト。CGROUP_PARENTのcpuset.cpus.effectiveがあればそれを、
+    無ければこのプロセスのCPUアフィニティを返す。
+    """
+    if cgroup_parent:
+        try:
+            effective = (cgroup_root / cgroup_parent.strip("/") / "cpuset.cpus.effective").read_text().strip()
+            if effective:
+                return parse_cpu_list(effective)
+        except OSError:
+            pass
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CpuAllocator:
+    cpus: list[int]  # 割り当てに使うCPU
+    cpus_per_job: int  # 1つのジャッジに割り当てるCPUの数
+    allocated: dict[str, list[int]]  # ジョブ -> 割り当てたCPU
+
+    def __init__(self, cpus: list[int], cpus_per_job: int = 1):
+        if cpus_per_job <= 0:
+            raise ValueError("cpus_per_job must be positive")
+        self.cpus = sorted(set(cpus))
+        self.cpus_per_job = cpus_per_job
+        self.allocated = {}
+
+    def update(self, cpus: list[int]) -> bool:
+        """
+        割り当てに使うCPUを変更する。実行中のジョブに割り当て済みのCPUは、解放されるまでそのまま使わせる。
+        変わった場合はTrueを返す
+        """
+        cpus = sorted(set(cpus))
+        if cpus == self.cpus:
+            return False
+        self.cpus = cpus
+        return True
+
+    def free_cpus(self) -> list[int]:
+        used = {cpu for cpus in self.allocated.values() for cpu in cpus}
+        return [cpu for cpu in self.cpus if cpu not in used]
+
+    def slots(self) -> int:
+        """
+        同時に割り当てられるジョブの数
+        """
+        return len(self.cpus) // self.cpus_per_job
+
+    def allocate(self, job: str) -> list[int] | None:
+        free = self.free_cpus()
+        if len(free) < self.cpus_per_job:
+            return None
+        cpus = free[:self.cpus_per_job]
+        self.allocated[job] = cpus
+        return cpus
+
+    def release(self, job: str) -> None:
+        self.allocated.pop(job, None)
+
+
+def setup_isolated_partition(cgroup_root: Path, cgroup_parent: str, cpus: list[int]) -> Error:
+    """
+    cgroup_root/cgroup_parentのcpuset.cpusをcpusにし、cpuset.cpus.partition=isolatedにする。
+    prepare-sandbox.shでコメントアウトしている処理
+        systemctl set-property judge.slice AllowedCPUs=...
+        echo 'isolated' > /sys/fs/cgroup/judge.slice/cpuset.cpus.partition
+    と同等。cgroup v2がrwでマウントされ、root権限で動いている必要がある。
+    """
+    cgroup = cgroup_root / cgroup_parent.strip("/")
+    try:
+        cgroup.mkdir(parents=True, exist_ok=True)
+        # 親cgroupでcpusetコントローラを有効にする
+        current = cgroup_root
+        for part in Path(cgroup_parent.strip("/")).parts:
+            (current / "cgroup.subtree_control").write_text("+cpuset")
+            current = current / part
+        (cgroup / "cpuset.cpus").write_text(format_cpu_list(cpus))
+        (cgroup / "cpuset.cpus.partition").write_text("isolated")
+        # 設定できなかった場合は"isolated invalid (...)"のようになる
+        partition = (cgroup / "cpuset.cpus.partition").read_text().strip()
+    except OSError as e:
+        return Error(f"Failed to setup isolated cpuset partition: {e}")
+
+    if partition != "isolated":
+        return Error(f"Failed to setup isolated cpuset partition: {partition}")
+
+    CPUSET_LOGGER.info(f"isolated cpuset partition: {cgroup} cpus={format_cpu_list(cpus)}")
+    return Error.Nothing()
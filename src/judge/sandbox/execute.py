@@ -2,6 +2,7 @@
 このプログラムでは、以下のような機能を実装する。
 * Dockerボリュームの作成と削除を行うボリューム管理クラスVolume
 * Dockerコンテナの作成と削除を行うコンテナ管理クラスContainerInfo
+* 上の2つを使うサンドボックスのバックエンドDockerBackend
 * タスクの実行を行うタスク管理クラスTaskInfo
 * タスクの実行結果を格納するクラスTaskResult
 """
@@ -14,12 +15,14 @@ from pydantic import BaseModel, Field
 from dataclasses import dataclass, field
 import time  # 実行時間の計測に使用
 from pathlib import Path
+from typing import Callable, Iterator
 import logging
 import docker
 from docker.models.containers import Container
 from docker.models import volumes
 from docker.errors import APIError, ImageNotFound
 from docker.types import Ulimit, LogConfig
+from docker.utils.socket import frames_iter, demux_adaptor
 import requests
 import tempfile
 import tarfile
@@ -36,6 +39,7 @@ CGROUP_PARENT = os.getenv("CGROUP_PARENT")
 
 # 内部定義モジュールのインポート
 from .my_error import Error
+from .backend import SandboxBackend, SandboxContainer, SandboxVolume
 
 SANDBOX_LOGGER = logging.getLogger("sandbox")
 
@@ -43,8 +47,17 @@ def define_sandbox_logger(logger: logging.Logger):
     global SANDBOX_LOGGER
     SANDBOX_LOGGER = logger
 
+# タイムアウトしたexecのプロセスを、コンテナ内のrootのexecでkillするコマンド
+# 1つのコンテナでは同時に1つのexecしか実行しない(ContainerInfo._exec_lock)ので、PID 1(sleep)とこのシェル以外の
+# プロセスは全て、タイムアウトしたexecのプロセスとその子孫(と、それまでのexecが残したプロセス)になる。
+# 環境変数や親子関係・プロセスグループと異なり、ユーザープログラムがこの対象から外れることはできない。
+# kill -9 -1 はシグナルを送っている間のforkを失敗させるので、killしている間にforkしたプロセスも残らない
+KILL_EXEC_COMMAND = ["sh", "-c", "kill -9 -1 2>/dev/null; exit 0"]
+# タイムアウトしたexecのプロセスをkillしてから、execが終わるのを待つ時間[秒]。終わらない場合はコンテナをkillする
+EXEC_KILL_GRACE_SEC = 2.0
+
 # Dockerボリュームの管理クラス
-class DockerVolume:
+class DockerVolume(SandboxVolume):
     name: str  # ボリューム名
     _volume: volumes.Volume | None
     
@@ -53,10 +66,22 @@ class DockerVolume:
         self._volume = volume
 
     @classmethod
-    def create(cls, client: docker.DockerClient) -> tuple["DockerVolume", Error]:
-        volumeName = "volume-" + str(uuid.uuid4())
+    def create(
+        cls,
+        client: docker.DockerClient,
+        prefix: str = "volume-",
+        labels: dict[str, str] | None = None,
+        tmpfsSizeMB: int = -1,
+    ) -> tuple["DockerVolume", Error]:
+        '''
+        tmpfsSizeMB > 0 の場合は、ディスクではなくサイズ上限付きのtmpfs上にボリュームを作る
+        '''
+        volumeName = prefix + str(uuid.uuid4())
+        driver_opts = None
+        if tmpfsSizeMB > 0:
+            driver_opts = {"type": "tmpfs", "device": "tmpfs", "o": f"size={tmpfsSizeMB}m"}
         try:
-            volume = client.volumes.create(name=volumeName)
+            volume = client.volumes.create(name=volumeName, driver="local", driver_opts=driver_opts, labels=labels)
         except APIError as e:
             return DockerVolume("", None), Error(f"Failed to create volume: {e}")
 
@@ -76,20 +101,21 @@ class DockerVolume:
 
 class VolumeMountInfo:
     path: str # コンテナ内のマウント先のパス
-    volume: DockerVolume  # マウントするボリュームの情報
+    volume: SandboxVolume  # マウントするボリュームの情報
     read_only: bool = False
     
-    def __init__(self, path: str, volume: DockerVolume, read_only: bool = False):
+    def __init__(self, path: str, volume: SandboxVolume, read_only: bool = False):
         self.path = path
         self.volume = volume
         self.read_only = read_only
 
 
 # Dockerコンテナの管理クラス
-class ContainerInfo:
+class ContainerInfo(SandboxContainer):
     containerID: str  # コンテナID
     _container: Container | None
     cgroup_parent: str
+    _exec_lock: threading.Lock  # execを1つずつ実行するためのロック(KILL_EXEC_COMMANDを参照)
     
     def __init__(
         self,
@@ -108,6 +134,8 @@ class ContainerInfo:
         enableLoggingDriver: bool = True,
         workDir: str = "/home/guest",
         volumeMountInfoList: list[VolumeMountInfo] | None = None,
+        readOnlyRootfs: bool = False,
+        tmpfsMounts: dict[str, str] | None = None,
     ):
         ulimit_list: list[Ulimit] = []
         
@@ -139,11 +167,14 @@ class ContainerInfo:
                 } for volume_mount_info in volumeMountInfoList
             } if volumeMountInfoList is not None else None,
             stdin_open=interactive,
+            read_only=readOnlyRootfs,
+            tmpfs=tmpfsMounts,
         )
         
         self._container = container
         self.containerID = container.id
         self.cgroup_parent = cgroupParent if cgroupParent is not None else "system.slice"
+        self._exec_lock = threading.Lock()
         
         SANDBOX_LOGGER.debug(f'containerID: {self.containerID}, err: ""')
 
@@ -160,30 +191,19 @@ class ContainerInfo:
         return Error("")
 
     # ファイルのコピー
-    def uploadFile(self, srcInHost: Path, dstInContainer: Path, uid: int = 0, gid: int = 0) -> Error:
+    def uploadFile(self, srcInHost: Path, dstInContainer: Path, uid: int = 0, gid: int = 0, mode: int | None = None) -> Error:
         '''
         srcInHost=".../sample.txt"
         dstInContainer="/home/guest/"
         の場合、コンテナ内に"/home/guest/sample.txt"としてコピーされる
+        modeを指定した場合は、コピーしたファイルのパーミッションをmodeにする(chmodのexecが不要になる)
         '''
-        try:
-            with tempfile.TemporaryFile(suffix=".tar") as tmp:
-                tar = tarfile.open(fileobj=tmp, mode="w")
-                # uidとgidを指定してファイルを追加
-                tarinfo = tar.gettarinfo(str(srcInHost), arcname=srcInHost.name)
-                tarinfo.uid = uid
-                tarinfo.gid = gid
-                with open(srcInHost, "rb") as f:
-                    tar.addfile(tarinfo=tarinfo, fileobj=f)
-                tar.close()
-                
-                tmp.seek(0)
-                if not self._container.put_archive(path=str(dstInContainer), data=tmp.read()):
-                    return Error("Failed to put archive")
-        except APIError as e:
-            return Error(f"Failed to copy file: {e}")
-        except Exception as e:
-            return Error(f"Failed to copy file: {e}")
+        err = self.uploadArchive(
+            entries=[TarEntry(srcInHost=srcInHost, arcname=srcInHost.name, uid=uid, gid=gid, mode=mode)],
+            dstInContainer=dstInContainer
+        )
+        if not err.silence():
+            return err
 
         SANDBOX_LOGGER.debug(f"copy file: {srcInHost} -> {dstInContainer}")
 
@@ -197,27 +217,29 @@ class ContainerInfo:
         dstRootInContainer="/home/guest"
         の場合、コンテナ内に"/home/guest/file1.txt", "/home/guest/file2.txt", "/home/guest/subdir/file3.txt"としてコピーされる
         '''
+        return self.uploadArchive(
+            entries=TarEntry.listTree(srcRootInHost=srcRootInHost, uid=uid, gid=gid),
+            dstInContainer=dstRootInContainer
+        )
+
+    # 複数のファイルを1つのtarにまとめて、1回のput_archiveでアップロード
+    def uploadArchive(self, entries: list["TarEntry"], dstInContainer: Path, prebuiltMembers: list[bytes] | None = None) -> Error:
+        '''
+        entriesの各ファイルを、コンテナ内のdstInContainer/arcnameにコピーする。
+        同じarcnameのファイルが複数ある場合は、後のものが優先される。
+        tarはディスクにもメモリにも全体を作らず、ファイルを読みながら少しずつDockerデーモンに送る。
+        prebuiltMembersには、iter_tar_membersで作成済みのtarのメンバーを渡せる(entriesの後に追加される)。
+        '''
         try:
-            with tempfile.TemporaryFile(suffix=".tar") as tmp:
-                tar = tarfile.open(fileobj=tmp, mode="w")
-                for file_path in srcRootInHost.glob("**/*"):
-                    if file_path.is_file():
-                        arcname = file_path.relative_to(srcRootInHost)
-                        tarinfo = tar.gettarinfo(str(file_path), arcname=arcname)
-                        tarinfo.uid = uid
-                        tarinfo.gid = gid
-                        with open(file_path, "rb") as f:
-                            tar.addfile(tarinfo=tarinfo, fileobj=f)
-                tar.close()
-                
-                tmp.seek(0)
-                if not self._container.put_archive(path=str(dstRootInContainer), data=tmp.read()):
-                    return Error("Failed to put archive")
+            if not self._container.put_archive(path=str(dstInContainer), data=iter_tar(entries, prebuiltMembers)):
+                return Error("Failed to put archive")
         except APIError as e:
             return Error(f"Failed to copy file: {e}")
         except Exception as e:
             return Error(f"Failed to copy file: {e}")
-        
+
+        SANDBOX_LOGGER.debug(f"copy {len(entries)} files -> {dstInContainer}")
+
         return Error("")
     
     def downloadFile(self, absPathInContainer: Path, dstInHost: Path) -> Error:
@@ -249,6 +271,31 @@ class ContainerInfo:
 
         return Error("")
     
+    def update_limits(self, memoryLimitMB: int = -1, cpuset: list[int] | None = None) -> Error:
+        '''
+        起動済みのコンテナのメモリーリミットと使用するCPUを変更する
+        memoryLimitMB <= 0, cpuset=Noneの場合は、その設定を変更しない
+        '''
+        kwargs = {}
+        if memoryLimitMB > 0:
+            kwargs["mem_limit"] = f"{memoryLimitMB}m"
+            kwargs["memswap_limit"] = f"{memoryLimitMB}m"
+        if cpuset is not None:
+            kwargs["cpuset_cpus"] = ",".join([str(cpu) for cpu in cpuset])
+        if len(kwargs) == 0:
+            return Error("")
+
+        try:
+            self._container.update(**kwargs)
+        except APIError as e:
+            return Error(f"Failed to update container: {e}")
+        except Exception as e:
+            return Error(f"Failed to update container: {e}")
+
+        SANDBOX_LOGGER.debug(f"update container: {self.containerID}, {kwargs}")
+
+        return Error("")
+
     def restart(self) -> Error:
         try:
             self._container.restart()
@@ -265,27 +312,59 @@ class ContainerInfo:
         user: str = "",
         workDir: str = "/home/guest",
         timeoutSec: float = 10.0,
+        onStdoutLine: Callable[[str], bool | None] | None = None,
+        stdin: bytes | None = None,
     ) -> tuple["ExecRunResult", Error]:
         # container.exec_run(...)でコマンドを実行する
-        # タイムアウト時刻を過ぎても終了しない場合はコンテナをkillする
+        # タイムアウト時刻を過ぎても終了しない場合は、このexecのプロセスだけをkillする(コンテナはそのまま使える)
+        # それでも終わらない場合はコンテナをkillする
+        # onStdoutLineを指定した場合は、標準出力を1行受け取るたびに(コマンドの終了を待たずに)呼び出す
+        # onStdoutLineがTrueを返した場合は、このexecのプロセスをkillして打ち切る
+        # stdinを指定した場合は、コマンドの標準入力に流し込む(ファイルをアップロードせずにデータを渡せる)
+        # 同じコンテナへのexecは、前のexecが終わるまで待たせる(タイムアウト時に、このexecのプロセスだけをkillできるように)
+        with self._exec_lock:
+            return self._exec_run_locked(command, user, workDir, timeoutSec, onStdoutLine, stdin)
+
+    def _exec_run_locked(
+        self,
+        command: list[str],
+        user: str,
+        workDir: str,
+        timeoutSec: float,
+        onStdoutLine: Callable[[str], bool | None] | None,
+        stdin: bytes | None,
+    ) -> tuple["ExecRunResult", Error]:
         try:
             result = ExecRunResult()
             error = Error("")
             execution_completed = threading.Event()
             exception_queue = queue.Queue()
-            
+
+            def on_stdout_line(line: str):
+                if result.stopped:
+                    return
+                if onStdoutLine(line):
+                    result.stopped = True
+                    self._kill_exec()
+
             def run_command(thread_queue: queue.Queue):
                 try:
                     start_time = time.monotonic()
-                    exec_result = self._container.exec_run(
-                        cmd=command,
-                        user=user,
-                        demux=True
-                    )
+                    if onStdoutLine is None and stdin is None:
+                        exec_result = self._container.exec_run(
+                            cmd=command,
+                            user=user,
+                            demux=True
+                        )
+                        exit_code = exec_result.exit_code
+                        stdout_data, stderr_data = exec_result.output
+                    else:
+                        exit_code, stdout_data, stderr_data = self._exec_stream(
+                            command, user, workDir, on_stdout_line if onStdoutLine is not None else None, stdin
+                        )
                     end_time = time.monotonic()
                     result.timeMS = int((end_time - start_time) * 1000)
-                    result.exitCode = exec_result.exit_code
-                    stdout_data, stderr_data = exec_result.output
+                    result.exitCode = exit_code
                     result.stdout = stdout_data.decode() if stdout_data else ""
                     result.stderr = stderr_data.decode() if stderr_data else ""
                 except Exception as e:
@@ -293,15 +372,22 @@ class ContainerInfo:
                 execution_completed.set()
                 
             # コマンド実行用スレッドを開始
-            thread = threading.Thread(target=run_command, args=(exception_queue,))
+            # (コンテナをkillしても終わらない場合に、プロセスの終了を妨げないようにdaemonにする)
+            thread = threading.Thread(target=run_command, args=(exception_queue,), daemon=True)
             thread.start()
             
             # タイムアウトまで待機、完了したら即座に終了
             if not execution_completed.wait(timeout=timeoutSec):
-                SANDBOX_LOGGER.info(f"container killing... for command: {' '.join(command)}")
-                self._container.kill()
-                error = Error(f"Command timed out after {timeoutSec} seconds. Container killed.")
-                thread.join()
+                result.timedOut = True
+                SANDBOX_LOGGER.info(f"exec killing... for command: {' '.join(command)}")
+                self._kill_exec()
+                error = Error(f"Command timed out after {timeoutSec} seconds. Process killed.")
+                if not execution_completed.wait(timeout=EXEC_KILL_GRACE_SEC):
+                    SANDBOX_LOGGER.info(f"container killing... for command: {' '.join(command)}")
+                    self._container.kill()
+                    error = Error(f"Command timed out after {timeoutSec} seconds. Container killed.")
+                    if not execution_completed.wait(timeout=EXEC_KILL_GRACE_SEC):
+                        return result, Error(f"{error.message} exec did not finish")
             
             SANDBOX_LOGGER.debug(f"exec_run: {' '.join(command)}, err: {error}") 
             
@@ -314,6 +400,72 @@ class ContainerInfo:
         except Exception as e:
             return ExecRunResult(), Error(f"Failed to exec_run: {e}")
     
+    def _kill_exec(self) -> None:
+        # 実行中のexecのプロセス(と子孫)を、コンテナ内のrootのexecでkillする(PID 1はkillしないので、コンテナはそのまま使える)
+        try:
+            exec_result = self._container.exec_run(cmd=KILL_EXEC_COMMAND, user="root")
+            if exec_result.exit_code != 0:
+                SANDBOX_LOGGER.warning(f"failed to kill exec in container {self.containerID}: exit code {exec_result.exit_code}")
+        except Exception as e:
+            SANDBOX_LOGGER.warning(f"failed to kill exec in container {self.containerID}: {e}")
+
+    def _exec_stream(
+        self,
+        command: list[str],
+        user: str,
+        workDir: str,
+        onStdoutLine: Callable[[str], bool | None] | None,
+        stdin: bytes | None,
+    ) -> tuple[int, bytes, bytes]:
+        # ストリーミングで受け取る場合や標準入力を渡す場合は、exec_runでは終了コードが得られない・
+        # 標準入力を渡せないので、低レベルAPIを使う
+        api = self._container.client.api
+        exec_id = api.exec_create(
+            self._container.id, cmd=command, user=user, workdir=workDir, stdin=stdin is not None
+        )["Id"]
+
+        if stdin is None:
+            chunks = api.exec_start(exec_id, stream=True, demux=True)
+            exec_socket = None
+        else:
+            # execにattachしたソケットに標準入力を書き込む
+            exec_socket = api.exec_start(exec_id, socket=True)
+            raw_socket = getattr(exec_socket, "_sock", exec_socket)
+
+            def write_stdin():
+                # コマンドが標準入力を読み切らずに出力を続けてもデッドロックしないように、別スレッドで書き込む
+                try:
+                    raw_socket.sendall(stdin)
+                    # EOFを送信
+                    raw_socket.shutdown(socket.SHUT_WR)
+                except OSError as e:
+                    SANDBOX_LOGGER.debug(f"failed to write stdin: {e}")
+
+            threading.Thread(target=write_stdin, daemon=True).start()
+            chunks = (demux_adaptor(*frame) for frame in frames_iter(exec_socket, tty=False))
+
+        stdout_data = b""
+        stderr_data = b""
+        line_start = 0
+        try:
+            for stdout_chunk, stderr_chunk in chunks:
+                if stderr_chunk:
+                    stderr_data += stderr_chunk
+                if stdout_chunk:
+                    stdout_data += stdout_chunk
+                    if onStdoutLine is None:
+                        continue
+                    # 受け取り済みの完全な行を通知する
+                    line_end = stdout_data.find(b"\n", line_start)
+                    while line_end != -1:
+                        onStdoutLine(stdout_data[line_start:line_end].decode())
+                        line_start = line_end + 1
+                        line_end = stdout_data.find(b"\n", line_start)
+        finally:
+            if exec_socket is not None:
+                exec_socket.close()
+        return api.exec_inspect(exec_id)["ExitCode"], stdout_data, stderr_data
+
     def get_status(self) -> str:
         '''
         戻り値: "created", "restarting", "running", "removing", "exited", "dead"
@@ -322,17 +474,136 @@ class ContainerInfo:
         return self._container.status
         
 
+# tarのブロックサイズと、ファイルを読み込む単位
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+TAR_CHUNK_SIZE = 64 * 1024
+
+
+# コンテナにアップロードするファイル
+class TarEntry:
+    srcInHost: Path  # ホスト上のファイルのパス
+    arcname: str  # アップロード先のディレクトリからの相対パス
+    uid: int
+    gid: int
+    mode: int | None = None  # Noneの場合はホスト上のファイルのパーミッションをそのまま使う
+
+    def __init__(self, srcInHost: Path, arcname: str, uid: int = 0, gid: int = 0, mode: int | None = None):
+        self.srcInHost = srcInHost
+        self.arcname = arcname
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+
+    @staticmethod
+    def listTree(srcRootInHost: Path, uid: int = 0, gid: int = 0) -> list["TarEntry"]:
+        '''
+        srcRootInHost以下の全てのファイル(arcnameはsrcRootInHostからの相対パス)
+        '''
+        return [
+            TarEntry(srcInHost=file_path, arcname=str(file_path.relative_to(srcRootInHost)), uid=uid, gid=gid)
+            for file_path in sorted(srcRootInHost.glob("**/*")) if file_path.is_file()
+        ]
+
+
+def iter_tar_members(entries: list[TarEntry]) -> Iterator[bytes]:
+    '''
+    entriesのファイルをtarのメンバー(ヘッダー + 内容)にしたものを、少しずつ返す。終端ブロックは含まない。
+    '''
+    for entry in entries:
+        stat = entry.srcInHost.stat()
+        tarinfo = tarfile.TarInfo(name=entry.arcname)
+        tarinfo.size = stat.st_size
+        tarinfo.mtime = int(stat.st_mtime)
+        tarinfo.mode = entry.mode if entry.mode is not None else stat.st_mode & 0o7777
+        tarinfo.uid = entry.uid
+        tarinfo.gid = entry.gid
+        yield tarinfo.tobuf(format=tarfile.PAX_FORMAT)
+
+        remaining = tarinfo.size
+        with open(entry.srcInHost, "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(TAR_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        # 読み込み中にファイルが短くなった場合も、ヘッダーのサイズに合わせる
+        if remaining > 0:
+            yield b"\0" * remaining
+        padding = (TAR_BLOCK_SIZE - tarinfo.size % TAR_BLOCK_SIZE) % TAR_BLOCK_SIZE
+        if padding > 0:
+            yield b"\0" * padding
+
+
+def iter_tar(entries: list[TarEntry], prebuiltMembers: list[bytes] | None = None) -> Iterator[bytes]:
+    '''
+    entriesのファイルと、作成済みのtarのメンバー(prebuiltMembers)をまとめたtarを、少しずつ返す
+    '''
+    yield from iter_tar_members(entries)
+    for members in prebuiltMembers or []:
+        yield members
+    # tarの終端(空のブロック2つ)
+    yield b"\0" * (TAR_BLOCK_SIZE * 2)
+
+
+class DockerBackend(SandboxBackend):
+    name = "docker"
+    _get_client: Callable[[], docker.DockerClient]
+
+    def __init__(self, get_client: Callable[[], docker.DockerClient] = docker.from_env):
+        self._get_client = get_client
+
+    def create_volume(self, prefix: str = "volume-", tmpfsSizeMB: int = -1) -> tuple[DockerVolume, Error]:
+        return DockerVolume.create(client=self._get_client(), prefix=prefix, tmpfsSizeMB=tmpfsSizeMB)
+
+    def create_container(
+        self,
+        imageName: str,
+        arguments: list[str],
+        cgroupParent: str | None = None,
+        user: str | None = f"{GUEST_UID}",
+        groups: list[str] | None = [f"{GUEST_GID}"],
+        cpuset: list[int] | None = None,
+        memoryLimitMB: int = -1,
+        stackLimitKB: int = -1,
+        pidsLimit: int = -1,
+        workDir: str = "/home/guest",
+        volumeMountInfoList: list[VolumeMountInfo] | None = None,
+        readOnlyRootfs: bool = False,
+        tmpfsMounts: dict[str, str] | None = None,
+    ) -> ContainerInfo:
+        return ContainerInfo(
+            client=self._get_client(),
+            imageName=imageName,
+            arguments=arguments,
+            cgroupParent=cgroupParent,
+            user=user,
+            groups=groups,
+            cpuset=cpuset,
+            memoryLimitMB=memoryLimitMB,
+            stackLimitKB=stackLimitKB,
+            pidsLimit=pidsLimit,
+            workDir=workDir,
+            volumeMountInfoList=volumeMountInfoList,
+            readOnlyRootfs=readOnlyRootfs,
+            tmpfsMounts=tmpfsMounts,
+        )
+
+
 class ExecRunResult(BaseModel):
     exitCode: int = Field(default=-1)
     stdout: str = Field(default="")
     stderr: str = Field(default="")
     timeMS: int = Field(default=-1)
+    timedOut: bool = Field(default=False)  # タイムアウトしてkillされたか
+    stopped: bool = Field(default=False)  # onStdoutLineがTrueを返したのでkillされたか
 
 
 # watchdogに渡す設定
 class TaskInfo(BaseModel):
     command: str
     stdin: str
+    stdinPath: str = ""  # 空でない場合は、stdinの代わりにコンテナ内のこのファイルを標準入力にする
     timeoutMS: int
     memoryLimitMB: int
     uid: int
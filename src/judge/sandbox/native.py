@@ -0,0 +1,524 @@
+"""
+Dockerデーモンを経由しないサンドボックスのバックエンド
+
+DockerBackendでは、コンテナの作成・起動・削除のたびにdockerdとのやり取りが発生し、
+実行時間の短いテストケースでは、それがジャッジの処理時間の大半を占める。
+NativeBackendは、Dockerが内部で使っているcrunをジャッジサーバーから直接呼び出す。
+* イメージ: prepare-native-sandbox.shでdocker exportしたルートファイルシステム
+  (JUDGE_NATIVE_SANDBOX_ROOT/images/<イメージ名>/rootfs)を、読み取り専用で全てのコンテナが共有する
+* ボリューム: JUDGE_NATIVE_SANDBOX_ROOT/volumes以下のホストのディレクトリ(tmpfsSizeMB > 0の場合はtmpfsをマウントする)を
+  バインドマウントする。アップロード・ダウンロードは、ホスト上のファイル操作だけで済む
+* コンテナ: CGROUP_PARENT以下のcgroup v2のリーフ(メモリー・プロセス数・CPUのリミットを設定する)。
+  start()では何も起動せず、exec_runのたびに、新しい名前空間(pid, mount, network, ipc, uts, cgroup)で
+  コマンドを実行するコンテナをcrun runで作る。execが終わると、その名前空間に残ったプロセスは全て終了する
+* DockerBackendと同じく、Dockerのデフォルトのseccompのプロファイル(seccomp.py)を適用する
+* コンテナ内の/sys/fs/cgroupは読み取り専用。watchdogには、execごとのcgroupだけを
+  rootしか辿れないDELEGATED_CGROUP_MOUNTに書き込み可能でマウントして渡す
+root権限と、ホストでcgroup v2がrwでマウントされていることが必要。
+"""
+from pathlib import Path
+from typing import Callable
+import subprocess
+import threading
+import tarfile
+import shutil
+import json
+import time
+import uuid
+import os
+
+from .my_error import Error
+from .backend import SandboxBackend, SandboxContainer, SandboxVolume
+from .seccomp import default_seccomp_profile
+from .execute import ExecRunResult, TarEntry, VolumeMountInfo, iter_tar, SANDBOX_LOGGER, GUEST_UID, GUEST_GID, EXEC_KILL_GRACE_SEC
+
+# crunの実行ファイル(docker-daemon.jsonで指定しているものと同じ)
+CRUN_PATH = os.getenv("CRUN_PATH", "/usr/local/bin/crun")
+CGROUP_ROOT = Path(os.getenv("CGROUP_ROOT", "/sys/fs/cgroup"))
+# cgroupParentを指定しなかった場合の親cgroup
+DEFAULT_CGROUP_PARENT = "judge.slice"
+# watchdogに書き込み可能なexecごとのcgroupを渡す、コンテナ内のパス(langs/watchdog.cppのDELEGATED_CGROUP_ROOTと同じ)
+# DELEGATED_CGROUP_DIRはprepare-native-sandbox.shで、ルートファイルシステムに作っておく
+DELEGATED_CGROUP_DIR = "/run/judge"
+DELEGATED_CGROUP_MOUNT = f"{DELEGATED_CGROUP_DIR}/cgroup"
+
+# Dockerのデフォルトと同じケーパビリティ。root以外のユーザーで実行したコマンドは、execve時に全て失う
+DEFAULT_CAPABILITIES = [
+    "CAP_CHOWN", "CAP_DAC_OVERRIDE", "CAP_FSETID", "CAP_FOWNER", "CAP_MKNOD", "CAP_NET_RAW",
+    "CAP_SETGID", "CAP_SETUID", "CAP_SETFCAP", "CAP_SETPCAP", "CAP_NET_BIND_SERVICE",
+    "CAP_SYS_CHROOT", "CAP_KILL", "CAP_AUDIT_WRITE",
+]
+# Dockerのデフォルトと同じく、コンテナから見えないようにするパスと、読み取り専用にするパス
+MASKED_PATHS = [
+    "/proc/asound", "/proc/acpi", "/proc/kcore", "/proc/keys", "/proc/latency_stats", "/proc/timer_list",
+    "/proc/timer_stats", "/proc/sched_debug", "/proc/scsi", "/sys/firmware",
+]
+READONLY_PATHS = ["/proc/bus", "/proc/fs", "/proc/irq", "/proc/sys", "/proc/sysrq-trigger"]
+# Dockerのデフォルトと同じseccompのプロファイル
+SECCOMP_PROFILE = default_seccomp_profile()
+DEFAULT_ENV = [
+    "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+    "HOME=/home/guest",
+]
+
+
+def _parse_id(value: str) -> int:
+    return 0 if value in ("", "root") else int(value)
+
+
+class NativeVolume(SandboxVolume):
+    path: Path  # ホスト上のディレクトリ
+    tmpfs: bool
+
+    def __init__(self, name: str, path: Path, tmpfs: bool = False):
+        self.name = name
+        self.path = path
+        self.tmpfs = tmpfs
+
+    @classmethod
+    def create(cls, root: Path, prefix: str = "volume-", tmpfsSizeMB: int = -1) -> tuple["NativeVolume | None", Error]:
+        name = prefix + str(uuid.uuid4())
+        path = root / "volumes" / name
+        try:
+            path.mkdir(parents=True)
+            if tmpfsSizeMB > 0:
+                subprocess.run(
+                    ["mount", "-t", "tmpfs", "-o", f"size={tmpfsSizeMB}m", "tmpfs", str(path)],
+                    check=True, capture_output=True
+                )
+        except (OSError, subprocess.CalledProcessError) as e:
+            shutil.rmtree(path, ignore_errors=True)
+            return None, Error(f"Failed to create volume: {e}")
+
+        SANDBOX_LOGGER.debug(f"volumeName: {name}")
+        return NativeVolume(name, path, tmpfs=tmpfsSizeMB > 0), Error("")
+
+    def is_empty(self) -> bool:
+        return not any(self.path.iterdir())
+
+    def remove(self) -> Error:
+        try:
+            if self.tmpfs:
+                subprocess.run(["umount", str(self.path)], check=True, capture_output=True)
+            shutil.rmtree(self.path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            return Error(f"Failed to remove volume: {e}")
+        return Error("")
+
+
+class NativeContainer(SandboxContainer):
+    rootfs: Path  # イメージのルートファイルシステム
+    bundle_dir: Path  # execごとのOCIバンドル(config.json)を置くディレクトリ
+    cgroup: Path  # このコンテナのcgroup
+    cgroup_path: str  # CGROUP_ROOTからのcgroupのパス(crunに渡す)
+    user: str
+    groups: list[str]
+    stackLimitKB: int
+    volumeMountInfoList: list[VolumeMountInfo]
+    tmpfsMounts: dict[str, str]  # execごとにtmpfsをマウントするパス -> マウントオプション
+    _status: str
+    _execs: dict[str, subprocess.Popen]  # 実行中のexec
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        root: Path,
+        imageName: str,
+        cgroupParent: str | None = None,
+        user: str | None = f"{GUEST_UID}",
+        groups: list[str] | None = [f"{GUEST_GID}"],
+        cpuset: list[int] | None = None,
+        memoryLimitMB: int = -1,
+        stackLimitKB: int = -1,
+        pidsLimit: int = -1,
+        volumeMountInfoList: list[VolumeMountInfo] | None = None,
+        tmpfsMounts: dict[str, str] | None = None,
+    ):
+        self.rootfs = root / "images" / imageName / "rootfs"
+        if not self.rootfs.is_dir():
+            raise FileNotFoundError(f"rootfs of image {imageName} not found: {self.rootfs} (run prepare-native-sandbox.sh)")
+
+        self.containerID = "native-" + uuid.uuid4().hex
+        self.bundle_dir = root / "containers" / self.containerID
+        self.cgroup_path = f"/{(cgroupParent or DEFAULT_CGROUP_PARENT).strip('/')}/{self.containerID}"
+        self.cgroup = CGROUP_ROOT / self.cgroup_path.strip("/")
+        self.user = user if user is not None else ""
+        self.groups = groups if groups is not None else []
+        self.stackLimitKB = stackLimitKB
+        self.volumeMountInfoList = volumeMountInfoList if volumeMountInfoList is not None else []
+        self.tmpfsMounts = tmpfsMounts if tmpfsMounts is not None else {}
+        self._status = "created"
+        self._execs = {}
+        self._lock = threading.Lock()
+
+        self.bundle_dir.mkdir(parents=True)
+        try:
+            # 親cgroupでコントローラを有効にしてから、このコンテナのcgroupを作る
+            (self.cgroup.parent / "cgroup.subtree_control").write_text("+memory +pids +cpuset")
+            self.cgroup.mkdir()
+            # execごとのリーフでもmemory.currentなどが読めるようにする(watchdogが使い、タスクごとのcgroupも作る)
+            (self.cgroup / "cgroup.subtree_control").write_text("+memory +pids")
+            if pidsLimit > 0:
+                (self.cgroup / "pids.max").write_text(str(pidsLimit))
+            err = self.update_limits(memoryLimitMB=memoryLimitMB, cpuset=cpuset)
+            if not err.silence():
+                raise OSError(err.message)
+            # Dockerと同じく、空のボリュームにはイメージ内の同じパスの内容をコピーする
+            for volume_mount_info in self.volumeMountInfoList:
+                self._populate_volume(volume_mount_info)
+        except Exception:
+            self.remove()
+            raise
+
+        SANDBOX_LOGGER.debug(f"create container: {self.containerID}")
+
+    def _populate_volume(self, volume_mount_info: VolumeMountInfo) -> None:
+        volume: NativeVolume = volume_mount_info.volume
+        src = self.rootfs / volume_mount_info.path.strip("/")
+        if volume_mount_info.read_only or not src.is_dir() or not volume.is_empty():
+            return
+        shutil.copytree(src, volume.path, symlinks=True, dirs_exist_ok=True)
+        for dirpath, dirnames, filenames in os.walk(src):
+            for name in [""] + dirnames + filenames:
+                src_path = Path(dirpath) / name
+                stat = src_path.lstat()
+                os.lchown(volume.path / src_path.relative_to(src), stat.st_uid, stat.st_gid)
+        stat = src.stat()
+        os.chmod(volume.path, stat.st_mode & 0o7777)
+
+    def _host_path(self, pathInContainer: Path) -> Path | None:
+        '''
+        コンテナ内のパスに対応するホスト上のパス。書き込み可能なボリューム内のパスでなければNone
+        '''
+        path = Path("/") / Path(pathInContainer)
+        for volume_mount_info in sorted(self.volumeMountInfoList, key=lambda info: len(info.path), reverse=True):
+            mount_point = Path(volume_mount_info.path)
+            if path == mount_point or mount_point in path.parents:
+                if volume_mount_info.read_only:
+                    return None
+                return volume_mount_info.volume.path / path.relative_to(mount_point)
+        return None
+
+    def start(self) -> Error:
+        self._status = "running"
+        SANDBOX_LOGGER.debug(f"start container: {self.containerID}")
+        return Error("")
+
+    def uploadArchive(self, entries: list[TarEntry], dstInContainer: Path, prebuiltMembers: list[bytes] | None = None) -> Error:
+        '''
+        ContainerInfo.uploadArchiveと同じ。ボリュームのディレクトリに直接展開する
+        '''
+        dst = self._host_path(dstInContainer)
+        if dst is None:
+            return Error(f"Failed to copy file: {dstInContainer} is not in a writable volume")
+        try:
+            with tarfile.open(fileobj=_IteratorReader(iter_tar(entries, prebuiltMembers)), mode="r|") as tar:
+                # 自分で作ったtarなので、arranged_filesへの絶対パスのシンボリックリンクもそのまま展開する
+                tar.extractall(path=dst, numeric_owner=True, filter="fully_trusted")
+        except Exception as e:
+            return Error(f"Failed to copy file: {e}")
+
+        SANDBOX_LOGGER.debug(f"copy {len(entries)} files -> {dstInContainer}")
+        return Error("")
+
+    def downloadFile(self, absPathInContainer: Path, dstInHost: Path) -> Error:
+        src = self._host_path(absPathInContainer)
+        if src is None:
+            return Error(f"Failed to download file: {absPathInContainer} is not in a writable volume")
+        try:
+            if src.is_dir():
+                shutil.copytree(src, Path(dstInHost) / src.name, symlinks=True, dirs_exist_ok=True)
+            else:
+                shutil.copy2(src, dstInHost)
+        except Exception as e:
+            return Error(f"Failed to download file: {e}")
+        return Error("")
+
+    def update_limits(self, memoryLimitMB: int = -1, cpuset: list[int] | None = None) -> Error:
+        try:
+            if memoryLimitMB > 0:
+                (self.cgroup / "memory.max").write_text(str(memoryLimitMB * 1024 * 1024))
+                # Dockerと同じく、メモリの内容はswapに退避させない
+                (self.cgroup / "memory.swap.max").write_text("0")
+            if cpuset is not None:
+                (self.cgroup / "cpuset.cpus").write_text(",".join([str(cpu) for cpu in cpuset]))
+        except OSError as e:
+            return Error(f"Failed to update container: {e}")
+        return Error("")
+
+    def _oci_config(self, command: list[str], user: str, workDir: str, exec_cgroup_path: str) -> dict:
+        user = user if user != "" else self.user
+        uid, _, gid = user.partition(":")
+        mounts = [
+            {"destination": "/proc", "type": "proc", "source": "proc"},
+            {"destination": "/dev", "type": "tmpfs", "source": "tmpfs", "options": ["nosuid", "strictatime", "mode=755", "size=65536k"]},
+            {"destination": "/dev/pts", "type": "devpts", "source": "devpts",
+             "options": ["nosuid", "noexec", "newinstance", "ptmxmode=0666", "mode=0620"]},
+            {"destination": "/dev/shm", "type": "tmpfs", "source": "shm", "options": ["nosuid", "noexec", "nodev", "mode=1777", "size=65536k"]},
+            {"destination": "/dev/mqueue", "type": "mqueue", "source": "mqueue", "options": ["nosuid", "noexec", "nodev"]},
+            {"destination": "/sys", "type": "sysfs", "source": "sysfs", "options": ["nosuid", "noexec", "nodev", "ro"]},
+            # ユーザープログラムがmemory.maxなどのリミットを書き換えられないように、読み取り専用にする
+            # (cgroup名前空間のルートはexecごとのcgroupなので、コンテナやホストの他のcgroupは見えない)
+            {"destination": "/sys/fs/cgroup", "type": "cgroup", "source": "cgroup", "options": ["nosuid", "noexec", "nodev", "relatime", "ro"]},
+            # watchdogがタスクごとのcgroupを作れるように、execごとのcgroupだけを、rootしか辿れないディレクトリの下に書き込み可能でマウントする
+            # (cgroupのファイルはホストのrootの所有なので、権限を落としたユーザープログラムからは書き換えられない)
+            {"destination": DELEGATED_CGROUP_DIR, "type": "tmpfs", "source": "tmpfs",
+             "options": ["nosuid", "nodev", "noexec", "mode=700", "size=64k"]},
+            {"destination": DELEGATED_CGROUP_MOUNT, "type": "bind", "source": str(CGROUP_ROOT / exec_cgroup_path.strip("/")),
+             "options": ["rbind", "nosuid", "nodev", "noexec", "rw"]},
+        ]
+        # ルートファイルシステムは読み取り専用なので、/tmpなどはexecごとのtmpfsにする
+        tmpfs_mounts = {"/tmp": "nosuid,nodev,mode=1777"} | self.tmpfsMounts
+        for path, options in tmpfs_mounts.items():
+            mounts.append({"destination": path, "type": "tmpfs", "source": "tmpfs", "options": options.split(",")})
+        for volume_mount_info in self.volumeMountInfoList:
+            mounts.append({
+                "destination": volume_mount_info.path,
+                "type": "bind",
+                "source": str(volume_mount_info.volume.path),
+                "options": ["rbind", "nosuid", "nodev", "ro" if volume_mount_info.read_only else "rw"],
+            })
+
+        process = {
+            "terminal": False,
+            "user": {
+                "uid": _parse_id(uid),
+                "gid": _parse_id(gid) if gid != "" else _parse_id(uid),
+                "additionalGids": [_parse_id(group) for group in self.groups],
+            },
+            "args": command,
+            "env": DEFAULT_ENV,
+            "cwd": workDir,
+            "capabilities": {name: DEFAULT_CAPABILITIES for name in ("bounding", "effective", "permitted")},
+            "noNewPrivileges": True,
+        }
+        if self.stackLimitKB > 0:
+            process["rlimits"] = [{"type": "RLIMIT_STACK", "hard": self.stackLimitKB * 1024, "soft": self.stackLimitKB * 1024}]
+
+        return {
+            "ociVersion": "1.0.2",
+            "process": process,
+            "root": {"path": str(self.rootfs), "readonly": True},
+            "hostname": "sandbox",
+            "mounts": mounts,
+            "linux": {
+                # networkの名前空間にはloしか無いので、ネットワークは使えない
+                "namespaces": [{"type": ns} for ns in ("pid", "network", "ipc", "uts", "mount", "cgroup")],
+                "cgroupsPath": exec_cgroup_path,
+                "maskedPaths": MASKED_PATHS,
+                "readonlyPaths": READONLY_PATHS,
+                "seccomp": SECCOMP_PROFILE,
+            },
+        }
+
+    def exec_run(
+        self,
+        command: list[str],
+        user: str = "",
+        workDir: str = "/home/guest",
+        timeoutSec: float = 10.0,
+        onStdoutLine: Callable[[str], bool | None] | None = None,
+        stdin: bytes | None = None,
+    ) -> tuple[ExecRunResult, Error]:
+        # ContainerInfo.exec_runと同じ。タイムアウト時刻を過ぎても終了しない場合は、execごとのcgroupのプロセスだけをkillし、
+        # それでも終わらない場合はコンテナの全てのプロセスをkillする
+        if self._status != "running":
+            return ExecRunResult(), Error(f"Failed to exec_run: container {self.containerID} is not running")
+
+        exec_id = f"{self.containerID}-{uuid.uuid4().hex[:12]}"
+        bundle = self.bundle_dir / exec_id
+        result = ExecRunResult()
+        error = Error("")
+        try:
+            bundle.mkdir()
+            # コンテナ内にバインドマウントするので、crunに作らせずに先に作っておく
+            (self.cgroup / exec_id).mkdir()
+            config = self._oci_config(command, user, workDir, f"{self.cgroup_path}/{exec_id}")
+            (bundle / "config.json").write_text(json.dumps(config))
+
+            start_time = time.monotonic()
+            process = subprocess.Popen(
+                [CRUN_PATH, "--cgroup-manager=cgroupfs", "run", "--bundle", str(bundle), exec_id],
+                stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            with self._lock:
+                self._execs[exec_id] = process
+
+            stdout_chunks: list[bytes] = []
+            stderr_chunks: list[bytes] = []
+
+            def read_stdout():
+                for line in process.stdout:
+                    stdout_chunks.append(line)
+                    if onStdoutLine is None or result.stopped or not line.endswith(b"\n"):
+                        continue
+                    if onStdoutLine(line[:-1].decode()):
+                        # 呼び出し元の要求で打ち切る(以降の行は通知しない)
+                        result.stopped = True
+                        self._kill_exec(exec_id)
+
+            def read_stderr():
+                stderr_chunks.append(process.stderr.read())
+
+            def write_stdin():
+                # コマンドが標準入力を読み切らずに出力を続けてもデッドロックしないように、別スレッドで書き込む
+                try:
+                    process.stdin.write(stdin)
+                    process.stdin.close()
+                except OSError as e:
+                    SANDBOX_LOGGER.debug(f"failed to write stdin: {e}")
+
+            threads = [threading.Thread(target=read_stdout), threading.Thread(target=read_stderr)]
+            if stdin is not None:
+                threads.append(threading.Thread(target=write_stdin, daemon=True))
+            for thread in threads:
+                thread.start()
+
+            try:
+                exit_code = process.wait(timeout=timeoutSec)
+            except subprocess.TimeoutExpired:
+                result.timedOut = True
+                SANDBOX_LOGGER.info(f"exec killing... for command: {' '.join(command)}")
+                self._kill_exec(exec_id)
+                error = Error(f"Command timed out after {timeoutSec} seconds. Process killed.")
+                try:
+                    exit_code = process.wait(timeout=EXEC_KILL_GRACE_SEC)
+                except subprocess.TimeoutExpired:
+                    SANDBOX_LOGGER.info(f"container killing... for command: {' '.join(command)}")
+                    self._kill()
+                    exit_code = process.wait()
+                    error = Error(f"Command timed out after {timeoutSec} seconds. Container killed.")
+            for thread in threads[:2]:
+                thread.join()
+            end_time = time.monotonic()
+
+            result.timeMS = int((end_time - start_time) * 1000)
+            result.exitCode = exit_code
+            result.stdout = b"".join(stdout_chunks).decode()
+            result.stderr = b"".join(stderr_chunks).decode()
+        except Exception as e:
+            return ExecRunResult(), Error(f"Failed to exec_run: {e}")
+        finally:
+            with self._lock:
+                self._execs.pop(exec_id, None)
+            shutil.rmtree(bundle, ignore_errors=True)
+
+        SANDBOX_LOGGER.debug(f"exec_run: {' '.join(command)}, err: {error}")
+        return result, error
+
+    def _kill_exec(self, exec_id: str) -> None:
+        '''
+        execごとのcgroup以下のプロセスだけをkillする(コンテナの他のプロセスはそのまま)
+        '''
+        try:
+            (self.cgroup / exec_id / "cgroup.kill").write_text("1")
+        except OSError as e:
+            SANDBOX_LOGGER.warning(f"failed to kill exec {exec_id}: {e}")
+
+    def _kill(self) -> None:
+        '''
+        このコンテナのcgroup以下の全てのプロセスをkillし、以降のexecを受け付けない
+        '''
+        self._status = "exited"
+        try:
+            (self.cgroup / "cgroup.kill").write_text("1")
+        except OSError as e:
+            SANDBOX_LOGGER.warning(f"failed to kill container {self.containerID}: {e}")
+        with self._lock:
+            execs = list(self._execs.values())
+        for process in execs:
+            process.kill()
+
+    def get_status(self) -> str:
+        return self._status
+
+    def remove(self) -> Error:
+        err = Error("")
+        self._kill()
+        self._status = "removed"
+        # プロセスが全て終了するとcgroupを削除できる
+        # (execごとのcgroupの下には、watchdogが作ったタスクごとのcgroupが残っていることがあるので、深い方から削除する)
+        for _ in range(100):
+            try:
+                for child in sorted(self.cgroup.rglob("*"), key=lambda path: len(path.parts), reverse=True):
+                    if child.is_dir():
+                        child.rmdir()
+                self.cgroup.rmdir()
+                break
+            except FileNotFoundError:
+                break
+            except OSError as e:
+                err = Error(f"Failed to remove container: {e}")
+                time.sleep(0.01)
+        else:
+            return err
+        shutil.rmtree(self.bundle_dir, ignore_errors=True)
+
+        SANDBOX_LOGGER.debug(f"remove container: {self.containerID}")
+        return Error("")
+
+
+class _IteratorReader:
+    '''
+    iter_tarの出力を、tarfileから読めるファイルオブジェクトにする
+    '''
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class NativeBackend(SandboxBackend):
+    name = "native"
+    root: Path  # ルートファイルシステム・ボリューム・バンドルを置くディレクトリ
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def create_volume(self, prefix: str = "volume-", tmpfsSizeMB: int = -1) -> tuple[NativeVolume | None, Error]:
+        return NativeVolume.create(root=self.root, prefix=prefix, tmpfsSizeMB=tmpfsSizeMB)
+
+    def create_container(
+        self,
+        imageName: str,
+        arguments: list[str],
+        cgroupParent: str | None = None,
+        user: str | None = f"{GUEST_UID}",
+        groups: list[str] | None = [f"{GUEST_GID}"],
+        cpuset: list[int] | None = None,
+        memoryLimitMB: int = -1,
+        stackLimitKB: int = -1,
+        pidsLimit: int = -1,
+        workDir: str = "/home/guest",
+        volumeMountInfoList: list[VolumeMountInfo] | None = None,
+        readOnlyRootfs: bool = False,
+        tmpfsMounts: dict[str, str] | None = None,
+    ) -> NativeContainer:
+        # argumentsで指定するメインプロセス(sleepなど)は起動しない。workDirはexec_runで指定する
+        # ルートファイルシステムは常に読み取り専用で、tmpfsはexecごとに作り直すので、execをまたいでファイルは残らない
+        return NativeContainer(
+            root=self.root,
+            imageName=imageName,
+            cgroupParent=cgroupParent,
+            user=user,
+            groups=groups,
+            cpuset=cpuset,
+            memoryLimitMB=memoryLimitMB,
+            stackLimitKB=stackLimitKB,
+            pidsLimit=pidsLimit,
+            volumeMountInfoList=volumeMountInfoList,
+            tmpfsMounts=tmpfsMounts,
+        )
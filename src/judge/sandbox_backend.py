@@ -0,0 +1,47 @@
+"""
+ジャッジで使うサンドボックスのバックエンドの選択
+
+JUDGE_SANDBOX_BACKEND
+* docker: Dockerデーモン経由でコンテナを作る(デフォルト)
+* native: crunを直接呼び出してコンテナを作る(sandbox/native.py)。
+  事前にprepare-native-sandbox.shで、イメージのルートファイルシステムをJUDGE_NATIVE_SANDBOX_ROOTに用意しておくこと
+"""
+from dotenv import load_dotenv
+from pathlib import Path
+from threading import Lock
+import os
+
+from .sandbox.backend import SandboxBackend
+from .sandbox.execute import DockerBackend
+from .sandbox.native import NativeBackend
+from .docker_client import get_docker_client
+
+load_dotenv()
+
+JUDGE_SANDBOX_BACKEND = os.getenv("JUDGE_SANDBOX_BACKEND", "docker")
+# nativeバックエンドが、イメージのルートファイルシステムやボリュームを置くディレクトリ
+JUDGE_NATIVE_SANDBOX_ROOT = Path(os.getenv("JUDGE_NATIVE_SANDBOX_ROOT", "/var/lib/dsa-judge/sandbox"))
+
+
+def create_sandbox_backend(name: str = JUDGE_SANDBOX_BACKEND) -> SandboxBackend:
+    if name == "docker":
+        # プロセス全体で共有するDockerクライアントを使う
+        return DockerBackend(get_client=get_docker_client)
+    if name == "native":
+        return NativeBackend(root=JUDGE_NATIVE_SANDBOX_ROOT)
+    raise ValueError(f"unknown sandbox backend: {name}")
+
+
+_sandbox_backend: SandboxBackend | None = None
+_lock = Lock()
+
+
+def get_sandbox_backend() -> SandboxBackend:
+    """
+    JUDGE_SANDBOX_BACKENDで指定したバックエンド
+    """
+    global _sandbox_backend
+    with _lock:
+        if _sandbox_backend is None:
+            _sandbox_backend = create_sandbox_backend()
+        return _sandbox_backend
@@ -0,0 +1,238 @@
+"""
+ジャッジリクエストのスケジューラー
+
+JobManagerは空いているワーカーの数(n)だけジャッジリクエストをclaimする。その際、DBから
+候補となるqueuedなジャッジリクエストを取得し、スケジューラーが候補全体にclaimしたい順の順位を付ける(rank)。
+上位から順にロックできたn件だけがclaimされ、スケジューラーの状態は実際にclaimされたものの分だけ進める(charge)。
+claimされなかった候補はqueuedのまま残る。
+
+* FIFOScheduler: 古い順に選ぶ
+* FairShareScheduler: 優先度クラス(学生の提出 / 採点用のバッチ)ごと、さらにユーザーごとに
+  重み付き公平キューイング(WFQ)を行う。一人の学生の連続提出や、大量の採点バッチが
+  他のジャッジリクエストを待たせ続けることを防ぐ。
+* EDFScheduler: 締め切り(Lecture.end_date)が早い順に選ぶ(Earliest Deadline First)。
+  締め切り直前に、締め切りの迫った課題の提出が他の提出の後ろで待たされることを防ぐ。
+"""
+from enum import Enum
+from datetime import datetime
+from dotenv import load_dotenv
+import os
+
+from .db import records
+
+load_dotenv()
+
+# スケジューリングポリシー: "fifo" | "fair" | "edf"。デフォルトは従来どおりの"fifo"(他はデプロイごとに明示的に選ぶ)
+JOB_SCHEDULER_POLICY = os.getenv("JOB_SCHEDULER_POLICY", "fifo")
+# 優先度クラスの重み。interactive:batch = 8:1 なら、両方のクラスにジョブが溜まっているとき、
+# batchのジョブは9回に1回の割合でclaimされる
+JOB_SCHEDULER_INTERACTIVE_WEIGHT = float(os.getenv("JOB_SCHEDULER_INTERACTIVE_WEIGHT", "8"))
+JOB_SCHEDULER_BATCH_WEIGHT = float(os.getenv("JOB_SCHEDULER_BATCH_WEIGHT", "1"))
+# 優先度クラスごとに、DBから取得する候補の最大数
+JOB_SCHEDULER_CANDIDATE_LIMIT = int(os.getenv("JOB_SCHEDULER_CANDIDATE_LIMIT", "64"))
+
+
+class JobClass(Enum):
+    INTERACTIVE = "interactive"  # 学生のフォーマットチェック提出
+    BATCH = "batch"  # 採点用のバッチ提出(BatchSubmission/EvaluationStatus)
+
+
+def job_class_of(submission: records.QueuedSubmission) -> JobClass:
+    # 注) crud.fetch_queued_judge_and_change_status_to_runningの候補取得SQLでも、同じ基準で
+    #     クラス分けしている
+    if submission.eval or submission.evaluation_status_id is not None:
+        return JobClass.BATCH
+    return JobClass.INTERACTIVE
+
+
+class JobScheduler:
+    # 優先度クラスごとに取得する候補の最大数。Noneの場合は、古い順にn件だけ取得する
+    candidate_limit: int | None = None
+    # Trueの場合、候補は優先度クラスに関係なく、締め切りが早い順に最大candidate_limit件取得する
+    order_by_deadline: bool = False
+
+    def rank(self, candidates: list[records.QueuedSubmission]) -> list[records.QueuedSubmission]:
+        """
+        候補全体を、claimしたい順(ディスパッチする順)に並べて返す。スケジューラーの状態は変えない
+        """
+        raise NotImplementedError
+
+    def charge(
+        self, candidates: list[records.QueuedSubmission], claimed: list[records.QueuedSubmission]
+    ) -> None:
+        """
+        rankした候補のうち、実際にclaimされたものの分だけスケジューラーの状態を進める
+        """
+        pass
+
+    def select(
+        self, candidates: list[records.QueuedSubmission], n: int
+    ) -> list[records.QueuedSubmission]:
+        """
+        候補からclaimするジャッジリクエストを最大n件選び、ディスパッチする順に並べて返す(選んだものは全てclaimされたものとする)
+        """
+        selected = self.rank(candidates)[:n]
+        self.charge(candidates, selected)
+        return selected
+
+
+class FIFOScheduler(JobScheduler):
+    def rank(self, candidates: list[records.QueuedSubmission]) -> list[records.QueuedSubmission]:
+        return sorted(candidates, key=lambda candidate: candidate.id)
+
+
+class _WeightedFairQueue:
+    """
+    フローごとの仮想開始時刻を管理する、重み付き公平キューイング
+    ジョブの実行時間は事前に分からないので、1ジョブのコストを1として扱う
+    """
+    virtual_time: float
+    start_time: dict
+
+    def __init__(self):
+        self.virtual_time = 0.0
+        self.start_time = {}
+
+    def copy(self) -> "_WeightedFairQueue":
+        queue = _WeightedFairQueue()
+        queue.virtual_time = self.virtual_time
+        queue.start_time = dict(self.start_time)
+        return queue
+
+    def sync(self, flows) -> None:
+        # 候補に現れなくなったフローは待っていないので忘れる。
+        # 新しく現れたフローは現在の仮想時刻から始める(待っていなかった間の分を貯め込ませない)
+        self.start_time = {flow: self.start_time.get(flow, self.virtual_time) for flow in flows}
+
+    def next_finish(self, flow, weight: float) -> float:
+        return self.start_time[flow] + 1.0 / weight
+
+    def charge(self, flow, weight: float) -> None:
+        self.virtual_time = self.start_time[flow]
+        self.start_time[flow] += 1.0 / weight
+
+
+class FairShareScheduler(JobScheduler):
+    """
+    1. 優先度クラス間で重み付き公平キューイングを行い、次に実行するクラスを決める
+    2. そのクラス内で、ユーザー間で公平キューイングを行い、次に実行するユーザーを決める
+    3. そのユーザーの最も古いジャッジリクエストを選ぶ
+    """
+    class_weight: dict[JobClass, float]
+    _class_queue: _WeightedFairQueue
+    _user_queue: dict[JobClass, _WeightedFairQueue]
+
+    def __init__(
+        self,
+        interactive_weight: float = JOB_SCHEDULER_INTERACTIVE_WEIGHT,
+        batch_weight: float = JOB_SCHEDULER_BATCH_WEIGHT,
+        candidate_limit: int = JOB_SCHEDULER_CANDIDATE_LIMIT,
+    ):
+        if interactive_weight <= 0 or batch_weight <= 0:
+            raise ValueError("scheduler weights must be positive")
+        self.class_weight = {
+            JobClass.INTERACTIVE: interactive_weight,
+            JobClass.BATCH: batch_weight,
+        }
+        self.candidate_limit = candidate_limit
+        self._class_queue = _WeightedFairQueue()
+        self._user_queue = {job_class: _WeightedFairQueue() for job_class in JobClass}
+
+    @staticmethod
+    def _sync(
+        class_queue: _WeightedFairQueue,
+        user_queue_dict: dict[JobClass, _WeightedFairQueue],
+        candidates: list[records.QueuedSubmission],
+    ) -> None:
+        # 候補に現れたクラスとユーザーだけを、待っているフローとして扱う
+        class_queue.sync({job_class_of(candidate) for candidate in candidates})
+        for job_class in JobClass:
+            user_queue_dict[job_class].sync(
+                {candidate.user_id for candidate in candidates if job_class_of(candidate) == job_class}
+            )
+
+    def rank(self, candidates: list[records.QueuedSubmission]) -> list[records.QueuedSubmission]:
+        # 全ての候補が順にclaimされたと仮定したときの順番。状態のコピーの上で計算するので、
+        # ロックできずにclaimされなかった候補の分まで仮想時刻が進むことは無い
+        class_queue = self._class_queue.copy()
+        user_queue_dict = {job_class: queue.copy() for job_class, queue in self._user_queue.items()}
+        self._sync(class_queue, user_queue_dict, candidates)
+
+        # クラス -> ユーザー -> 古い順のジャッジリクエスト
+        pending: dict[JobClass, dict[str, list[records.QueuedSubmission]]] = {}
+        for candidate in sorted(candidates, key=lambda candidate: candidate.id):
+            pending.setdefault(job_class_of(candidate), {}).setdefault(candidate.user_id, []).append(candidate)
+
+        ranked: list[records.QueuedSubmission] = []
+        while len(pending) > 0:
+            job_class = min(
+                pending.keys(),
+                key=lambda c: (class_queue.next_finish(c, self.class_weight[c]), -self.class_weight[c]),
+            )
+            users = pending[job_class]
+            user_queue = user_queue_dict[job_class]
+            # 仮想終了時刻が同じなら、最も古いジャッジリクエストを持つユーザーを優先する
+            user_id = min(
+                users.keys(),
+                key=lambda u: (user_queue.next_finish(u, 1.0), users[u][0].id),
+            )
+
+            ranked.append(users[user_id].pop(0))
+            class_queue.charge(job_class, self.class_weight[job_class])
+            user_queue.charge(user_id, 1.0)
+
+            if len(users[user_id]) == 0:
+                del users[user_id]
+            if len(users) == 0:
+                del pending[job_class]
+
+        return ranked
+
+    def charge(
+        self, candidates: list[records.QueuedSubmission], claimed: list[records.QueuedSubmission]
+    ) -> None:
+        self._sync(self._class_queue, self._user_queue, candidates)
+        for submission in claimed:
+            job_class = job_class_of(submission)
+            self._class_queue.charge(job_class, self.class_weight[job_class])
+            self._user_queue[job_class].charge(submission.user_id, 1.0)
+
+
+class EDFScheduler(JobScheduler):
+    """
+    締め切りが早い順に選ぶ。締め切り後の提出(採点用のバッチを含む)は最後に回す。
+    締め切りが同じ提出の間では、ユーザー間で交互になるように選ぶ。
+    """
+    order_by_deadline = True
+
+    def __init__(self, candidate_limit: int = JOB_SCHEDULER_CANDIDATE_LIMIT):
+        self.candidate_limit = candidate_limit
+
+    def rank(self, candidates: list[records.QueuedSubmission]) -> list[records.QueuedSubmission]:
+        # 締め切りごとに、各ユーザーの何番目の提出か
+        user_rank: dict[int, int] = {}
+        count: dict[tuple, int] = {}
+        for candidate in sorted(candidates, key=lambda candidate: candidate.id):
+            key = (candidate.deadline, candidate.user_id)
+            user_rank[candidate.id] = count.get(key, 0)
+            count[key] = user_rank[candidate.id] + 1
+
+        return sorted(
+            candidates,
+            key=lambda candidate: (
+                candidate.deadline is None,
+                candidate.deadline or datetime.max,
+                user_rank[candidate.id],
+                candidate.id,
+            ),
+        )
+
+
+def create_scheduler(policy: str = JOB_SCHEDULER_POLICY) -> JobScheduler:
+    if policy == "fifo":
+        return FIFOScheduler()
+    if policy == "fair":
+        return FairShareScheduler()
+    if policy == "edf":
+        return EDFScheduler()
+    raise ValueError(f"unknown scheduler policy: {policy}")
@@ -0,0 +1,67 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_archive_cache.py
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import os
+import io
+import tarfile
+
+from .archive_cache import ArchiveCache
+from .sandbox.execute import TarEntry, iter_tar
+
+
+def write_file(path: Path, content: bytes):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+# 同じファイルに対しては、キャッシュしたtarが使い回されるか確かめるテスト
+def test_CacheHit():
+    cache = ArchiveCache(budget_mb=1)
+    with TemporaryDirectory() as tmpdir:
+        write_file(Path(tmpdir) / "main.h", b"int f(void);\n")
+        entries = [TarEntry(srcInHost=Path(tmpdir) / "main.h", arcname="main.h")]
+
+        archive = cache.get(key=(1, 1, False), entries=entries)
+        assert archive is not None
+        assert cache.get(key=(1, 1, False), entries=entries) is archive
+
+        # 作成済みのメンバーを流し込んだtarが読めるか
+        data = b"".join(iter_tar([], prebuiltMembers=[archive]))
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r") as tar:
+            assert tar.extractfile("main.h").read() == b"int f(void);\n"
+
+
+# ファイルが更新されたら、tarが作り直されるか確かめるテスト
+def test_CacheInvalidation():
+    cache = ArchiveCache(budget_mb=1)
+    with TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "main.h"
+        write_file(path, b"old\n")
+        entries = [TarEntry(srcInHost=path, arcname="main.h")]
+        old_archive = cache.get(key=(1, 1, False), entries=entries)
+
+        write_file(path, b"new content\n")
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000_000))
+        new_archive = cache.get(key=(1, 1, False), entries=entries)
+        assert new_archive is not old_archive
+        assert b"new content" in new_archive
+
+
+# 上限を超えたら、最も長く使われていない問題のtarが捨てられるか確かめるテスト
+def test_CacheEviction():
+    cache = ArchiveCache(budget_mb=1)
+    with TemporaryDirectory() as tmpdir:
+        entries_list = []
+        for i in range(3):
+            write_file(Path(tmpdir) / f"data{i}.bin", os.urandom(400 * 1024))
+            entries_list.append([TarEntry(srcInHost=Path(tmpdir) / f"data{i}.bin", arcname=f"data{i}.bin")])
+
+        archive0 = cache.get(key=0, entries=entries_list[0])
+        cache.get(key=1, entries=entries_list[1])
+        # 0を使ったので、2を追加すると1が捨てられる
+        assert cache.get(key=0, entries=entries_list[0]) is archive0
+        cache.get(key=2, entries=entries_list[2])
+        assert list(cache._archives.keys()) == [0, 2]
+        assert cache._size <= cache.budget_bytes
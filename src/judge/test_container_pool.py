@@ -0,0 +1,135 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_container_pool.py
+import logging
+import time
+from dotenv import load_dotenv
+import os
+
+from .container_pool import ContainerPool
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger(__name__)
+
+load_dotenv()
+GUEST_UID = os.getenv("GUEST_UID")
+GUEST_GID = os.getenv("GUEST_GID")
+
+
+def wait_until_ready(pool: ContainerPool, count: int, timeoutSec: float = 30.0):
+    deadline = time.monotonic() + timeoutSec
+    while len(pool._ready) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+# 返却したサンドボックスが初期状態に戻されて、再利用されるか確かめるテスト
+def test_ReuseSandboxSet():
+    pool = ContainerPool(size=1, max_uses=10)
+    pool.start()
+    wait_until_ready(pool, 1)
+
+    sandbox_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+
+    # 作業用ボリュームにファイルを作り、実行用コンテナにプロセスを残す
+    result, err = sandbox_set.build_container.exec_run(
+        command=["sh", "-c", "echo garbage > /home/guest/garbage.txt"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        timeoutSec=5.0
+    )
+    assert err.message == "" and result.exitCode == 0
+    result, err = sandbox_set.runner_container.exec_run(
+        command=["sh", "-c", "sleep 1000 > /dev/null 2>&1 &"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        timeoutSec=5.0
+    )
+    assert err.message == ""
+
+    pool.release(sandbox_set)
+    wait_until_ready(pool, 1)
+
+    reused_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+    assert reused_set is sandbox_set
+    assert reused_set.uses == 2
+
+    result, err = reused_set.runner_container.exec_run(
+        command=["sh", "-c", "ls /home/guest; cat /proc/[0-9]*/comm | grep -c '^sleep$'"],
+        user="root",
+        timeoutSec=5.0
+    )
+    test_logger.info(result)
+    assert err.message == ""
+    assert "garbage.txt" not in result.stdout
+    # PID 1のsleepだけが残っている
+    assert result.stdout.strip().endswith("1")
+
+    pool.release(reused_set)
+    pool.close()
+
+
+# execがタイムアウトしても(execのプロセスだけがkillされるので)、コンテナが再利用されるか確かめるテスト
+def test_ReuseSandboxSetAfterTimeout():
+    pool = ContainerPool(size=1, max_uses=10)
+    pool.start()
+    wait_until_ready(pool, 1)
+
+    sandbox_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+
+    result, err = sandbox_set.runner_container.exec_run(
+        command=["sleep", "10"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        timeoutSec=1.0
+    )
+    assert err.message != ""
+
+    pool.release(sandbox_set)
+    wait_until_ready(pool, 1)
+
+    new_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+    assert new_set is sandbox_set
+
+    pool.release(new_set)
+    pool.close()
+
+
+# 前の提出が書き込んだファイルやIPCオブジェクトが、次の提出から見えないか確かめるテスト
+def test_NoLeakBetweenSubmissions():
+    pool = ContainerPool(size=1, max_uses=10)
+    pool.start()
+    wait_until_ready(pool, 1)
+
+    sandbox_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+    result, err = sandbox_set.runner_container.exec_run(
+        command=["sh", "-c", "echo leak > /var/tmp/leak; echo leak > /run/lock/leak; echo leak > /dev/shm/leak; "
+                             "ipcmk -M 4096; echo leak > /var/leak; echo leak > /home/leak; exit 0"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        timeoutSec=5.0
+    )
+    assert err.message == ""
+    # ルートファイルシステムには書き込めない
+    assert "Read-only file system" in result.stderr
+
+    pool.release(sandbox_set)
+    wait_until_ready(pool, 1)
+
+    reused_set, err = pool.acquire(runner_memory_mb=256)
+    assert err.message == ""
+    assert reused_set is sandbox_set
+    result, err = reused_set.runner_container.exec_run(
+        command=["sh", "-c", "cat /var/tmp/leak /run/lock/leak /dev/shm/leak /var/leak /home/leak 2>/dev/null; ipcs -m | grep -c 4096"],
+        user="root",
+        timeoutSec=5.0
+    )
+    test_logger.info(result)
+    assert err.message == ""
+    assert "leak" not in result.stdout
+    assert result.stdout.strip() == "0"
+
+    pool.release(reused_set)
+    pool.close()
@@ -0,0 +1,48 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_cpuset.py
+from .sandbox.cpuset import CpuAllocator, parse_cpu_list, format_cpu_list
+from . import admission
+
+
+def test_CpuList():
+    assert parse_cpu_list("0-3,6\n") == [0, 1, 2, 3, 6]
+    assert format_cpu_list([6, 0, 2, 1, 3]) == "0-3,6"
+
+
+# 同時に実行するジャッジに、同じCPUが割り当てられないか確かめるテスト
+def test_CpuAllocator():
+    allocator = CpuAllocator([0, 1, 2, 3, 4], cpus_per_job=2)
+    assert allocator.slots() == 2
+    assert allocator.allocate("a") == [0, 1]
+    assert allocator.allocate("b") == [2, 3]
+    # 残り1つでは足りない
+    assert allocator.allocate("c") is None
+    allocator.release("a")
+    assert allocator.allocate("c") == [0, 1]
+
+
+# 割り当て対象のCPUが減っても、実行中のジョブのCPUは解放されるまで他に割り当てないか確かめるテスト
+def test_CpuAllocatorUpdate():
+    allocator = CpuAllocator([0, 1, 2, 3])
+    assert allocator.allocate("a") == [0]
+    assert allocator.update([0, 1]) is True
+    assert allocator.update([1, 0]) is False
+    assert allocator.free_cpus() == [1]
+    assert allocator.allocate("b") == [1]
+    assert allocator.allocate("c") is None
+
+
+# シャードの数がテストケース数・専有CPUの数を超えず、メモリは実際のシャードの数だけ予約するか確かめるテスト
+def test_TestcaseShardCount(monkeypatch):
+    monkeypatch.setattr(admission, "JUDGE_TESTCASE_SHARDS", 4)
+    monkeypatch.setattr(admission, "JUDGE_PIN_CPUS", False)
+    assert admission.testcase_shard_count(10) == 4
+    assert admission.testcase_shard_count(2) == 2
+    assert admission.testcase_shard_count(0) == 1
+    # 割り当てられたCPUがシャードの数より少ない場合
+    assert admission.testcase_shard_count(10, cpu_count=3) == 3
+
+    runner_memory_mb = 1024 + admission.RUNNER_CONTAINER_MEMORY_MARGIN_MB
+    assert admission.job_memory_mb(1024) == runner_memory_mb
+    assert admission.job_memory_mb(1024, admission.testcase_shard_count(2)) == 2 * runner_memory_mb
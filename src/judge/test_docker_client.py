@@ -0,0 +1,129 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_docker_client.py
+# (docker.from_envの代わりにFakeClientを作るので、Dockerデーモンは不要)
+from threading import Barrier, Thread
+import pytest
+
+from . import docker_client
+from .docker_client import DockerClientManager, get_docker_client
+from .metrics import judge_metrics
+
+
+class FakeAPIClient:
+    def __init__(self, client: "FakeClient"):
+        self.client = client
+
+    def send(self, request, **kwargs):
+        # リクエストの送信中は、実行中のリクエストとして数えられている
+        self.client.in_flight_during_send.append(judge_metrics.snapshot()["docker_requests_in_flight"])
+        if request == "broken":
+            raise ConnectionError("connection reset by peer")
+        return "response"
+
+
+class FakeClient:
+    """
+    docker.DockerClientのうち、DockerClientManagerが使う部分だけを持つ
+    """
+    def __init__(self, max_pool_size: int, responding: bool = True):
+        self.max_pool_size = max_pool_size
+        self.responding = responding
+        self.closed = False
+        self.in_flight_during_send: list[float] = []
+        self.api = FakeAPIClient(self)
+
+    def ping(self) -> bool:
+        # 実際のクライアントと同じく、疎通確認もAPIClient.sendを通る
+        self.api.send("ping")
+        if not self.responding:
+            raise ConnectionError("docker daemon is not responding")
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeFromEnv:
+    """
+    作ったクライアントを記録するdocker.from_envの代わり。respondingがFalseの間は、応答しないクライアントを作る
+    """
+    def __init__(self):
+        self.clients: list[FakeClient] = []
+        self.responding = True
+
+    def __call__(self, max_pool_size: int) -> FakeClient:
+        client = FakeClient(max_pool_size, self.responding)
+        self.clients.append(client)
+        return client
+
+
+# 全てのジャッジで同じクライアントが共有され、コネクションプールの大きさが指定した値になるか確かめるテスト
+def test_SharedClient(monkeypatch):
+    from_env = FakeFromEnv()
+    monkeypatch.setattr(docker_client, "docker_clients", DockerClientManager(max_pool_size=4, from_env=from_env))
+
+    # 複数のスレッドから同時に取得しても、クライアントは1つだけ作られる
+    barrier = Barrier(8)
+    clients = []
+
+    def get():
+        barrier.wait()
+        clients.append(get_docker_client())
+
+    threads = [Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(from_env.clients) == 1
+    assert all(client is from_env.clients[0] for client in clients)
+    assert get_docker_client() is get_docker_client()
+    assert from_env.clients[0].max_pool_size == 4
+
+
+# 全てのリクエストと、失敗したリクエストの数が記録されるか確かめるテスト
+def test_InstrumentRequests():
+    manager = DockerClientManager(max_pool_size=2, from_env=FakeFromEnv())
+    client = manager.client()
+    before = judge_metrics.snapshot()
+
+    assert client.api.send("request") == "response"
+    with pytest.raises(ConnectionError):
+        client.api.send("broken")
+
+    after = judge_metrics.snapshot()
+    assert after["docker_requests_total"] == before.get("docker_requests_total", 0) + 2
+    assert after.get("docker_request_errors", 0) == before.get("docker_request_errors", 0) + 1
+    assert client.in_flight_during_send == [1, 1]
+    assert after["docker_requests_in_flight"] == 0
+    manager.close()
+    assert client.closed
+
+
+# 疎通確認に失敗した場合はクライアントが作り直され、作り直しても応答が無ければエラーを返すか確かめるテスト
+def test_HealthCheckAndReconnect():
+    from_env = FakeFromEnv()
+    manager = DockerClientManager(max_pool_size=2, from_env=from_env)
+    before = judge_metrics.snapshot().get("docker_reconnects", 0)
+    assert manager.check_health().message == ""
+    assert len(from_env.clients) == 1
+
+    # デーモンが応答しなくなった状態にして、疎通確認で作り直させる
+    client = manager.client()
+    client.responding = False
+    err = manager.check_health()
+    assert err.message == ""
+    assert client.closed
+    assert manager.client() is not client
+    assert manager.client() is from_env.clients[1]
+    assert judge_metrics.snapshot()["docker_reconnects"] == before + 1
+
+    # 作り直したクライアントも応答しない場合
+    manager.client().responding = False
+    from_env.responding = False
+    err = manager.check_health()
+    assert "Failed to connect to docker daemon" in err.message
+    assert judge_metrics.snapshot()["docker_reconnects"] == before + 2
+    manager.close()
@@ -6,12 +6,15 @@ from .sandbox.execute import ContainerInfo
 from .sandbox.execute import DockerVolume
 from .sandbox.execute import VolumeMountInfo
 from .sandbox.execute import TaskInfo, WatchDogResult
+from .sandbox.execute import TarEntry, iter_tar
 import logging
 from datetime import timedelta
 from tempfile import TemporaryDirectory
 from pathlib import Path
 import time
 import docker
+import io
+import tarfile
 from dotenv import load_dotenv
 import os
 
@@ -243,6 +246,72 @@ def test_FileCopy():
     err = container.remove()
     assert err.message == ""
 
+
+# 少しずつ作るtarが、tarfileで正しく読めるか確かめるテスト
+def test_IterTar():
+    with TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / "subdir").mkdir()
+        with open(Path(tmpdir) / "main.c", "w") as f:
+            f.write("int main() { return 0; }\n")
+        with open(Path(tmpdir) / "subdir" / "large.bin", "wb") as f:
+            f.write(os.urandom(100000))
+
+        entries = TarEntry.listTree(srcRootInHost=Path(tmpdir), uid=1002, gid=1002)
+        entries += [TarEntry(srcInHost=Path(tmpdir) / "main.c", arcname="main.c", mode=0o600)]
+        data = b"".join(iter_tar(entries))
+
+        assert len(data) % 512 == 0
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r") as tar:
+            members = tar.getmembers()
+            assert [member.name for member in members] == ["main.c", "subdir/large.bin", "main.c"]
+            assert members[0].uid == 1002 and members[0].gid == 1002
+            assert members[2].uid == 0 and members[2].mode == 0o600
+            with open(Path(tmpdir) / "subdir" / "large.bin", "rb") as f:
+                assert tar.extractfile("subdir/large.bin").read() == f.read()
+
+
+# ファイルツリーを1回のput_archiveでコピーできているか確かめるテスト
+def test_UploadArchive():
+    client = docker.client.from_env()
+    container = ContainerInfo(
+        client=client,
+        imageName="binary-runner",
+        arguments=["sleep", "3600"],
+        interactive=False,
+        user=GUEST_UID,
+        groups=[GUEST_GID],
+        workDir="/home/guest",
+        memoryLimitMB=256,
+    )
+    err = container.start()
+    assert err.message == ""
+
+    with TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / "subdir").mkdir()
+        with open(Path(tmpdir) / "a.txt", "w") as f:
+            f.write("a\n")
+        with open(Path(tmpdir) / "subdir" / "b.txt", "w") as f:
+            f.write("b\n")
+
+        err = container.uploadArchive(
+            entries=TarEntry.listTree(srcRootInHost=Path(tmpdir), uid=int(GUEST_UID), gid=int(GUEST_GID)),
+            dstInContainer=Path("/home/guest")
+        )
+        assert err.message == ""
+
+    res, err = container.exec_run(
+        command=["cat", "/home/guest/a.txt", "/home/guest/subdir/b.txt"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        workDir="/home/guest",
+        timeoutSec=5.0
+    )
+    assert err.message == ""
+    assert res.exitCode == 0
+    assert res.stdout == "a\nb\n"
+
+    err = container.remove()
+    assert err.message == ""
+
 # タイムアウトをきちんと検出できているか確かめるテスト
 def test_Timeout():
     client = docker.client.from_env()
@@ -272,9 +341,27 @@ def test_Timeout():
     assert err.message != ""
     assert result.timeMS >= 2000 and result.timeMS <= 5000
     
-    # コンテナがkillされたので、コンテナを再起動
-    err = container.start()
+    assert result.timedOut
+    # execのプロセスだけがkillされ、コンテナはそのまま使える
+    assert container.get_status() == "running"
+
+    # 環境変数を消して、別のセッションで動かし続ける子孫もkillされる
+    result, err = container.exec_run(
+        command=["sh", "-c", "env -i setsid sleep 100 & exec env -i sleep 100"],
+        user=f"{GUEST_UID}:{GUEST_GID}",
+        workDir="/home/guest",
+        timeoutSec=2.0
+    )
+    assert result.timedOut
+    result, err = container.exec_run(
+        command=["sh", "-c", "cat /proc/[0-9]*/comm | grep -c '^sleep$'"],
+        user="root",
+        workDir="/home/guest",
+        timeoutSec=2.0
+    )
     assert err.message == ""
+    # PID 1のsleepだけが残っている
+    assert result.stdout.strip() == "1"
     
     # WatchDogを用いて、タイムアウトを検出できるか確かめる
     task_info = TaskInfo(
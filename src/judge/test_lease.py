@@ -0,0 +1,157 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest judge/test_lease.py
+# (MySQLの代わりに一時ファイルのSQLiteを使うので、DBサーバーは不要)
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from .db import models, records, crud
+from .scheduler import FairShareScheduler
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # 2つのセッションから同じDBを見るテストがあるので、ファイルのSQLiteを使う
+    engine = create_engine(f"sqlite:///{tmp_path / 'judge.db'}")
+    models.Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(models.Lecture(id=1, title="lecture", start_date=datetime(2000, 1, 1), end_date=datetime(2100, 1, 1)))
+        session.add(models.Problem(lecture_id=1, assignment_id=1, title="problem", description_path="", timeMS=1000, memoryMB=256))
+        session.commit()
+    return engine
+
+
+@pytest.fixture
+def db(engine):
+    with Session(engine) as session:
+        yield session
+
+
+def add_submission(db: Session, user_id: str = "user", eval: bool = False, **kwargs) -> int:
+    submission = models.Submission(
+        user_id=user_id, lecture_id=1, assignment_id=1, eval=eval, upload_dir="", **kwargs
+    )
+    db.add(submission)
+    db.commit()
+    return submission.id
+
+
+def claim(db: Session, node_id: str) -> list[records.Submission]:
+    return crud.fetch_queued_judge_and_change_status_to_running(db, 10, node_id=node_id, lease_sec=60, leaseless_reclaim_sec=600)
+
+
+def judge_result(submission_id: int) -> records.JudgeResult:
+    return records.JudgeResult(
+        submission_id=submission_id, testcase_id=1, result=records.SingleJudgeStatus.AC,
+        command="", timeMS=0, memoryKB=0, exit_code=0, stdout="", stderr=""
+    )
+
+
+# 有効期限の無い"running"のリクエスト(claimの仕組みが無い古いジャッジサーバーが実行中のもの)は、
+# 一定時間更新されていない場合だけ取得し直すか確かめるテスト
+def test_ReclaimRunningWithoutLease(db):
+    running_id = add_submission(db, progress="running", lease_expires_at=None, updated_at=datetime.now() - timedelta(seconds=60))
+    abandoned_id = add_submission(db, progress="running", lease_expires_at=None, updated_at=datetime.now() - timedelta(seconds=601))
+    assert [submission.id for submission in claim(db, "node-b")] == [abandoned_id]
+    db.expire_all()
+    assert db.get(models.Submission, running_id).claimed_by is None
+
+
+# claimを失ったジャッジサーバーからは、進捗も結果も書き込めないことを確かめるテスト
+def test_FencedWritesAfterReclaim(db):
+    submission_id = add_submission(db, progress="running", claimed_by="node-a", lease_expires_at=datetime.now() - timedelta(seconds=1))
+    stale = records.Submission.model_validate(db.get(models.Submission, submission_id))
+
+    # node-bが有効期限切れのリクエストを取得し直す
+    [reclaimed] = claim(db, "node-b")
+    assert reclaimed.claimed_by == "node-b"
+
+    stale.completed_task = 5
+    stale.result = records.SubmissionSummaryStatus.WA
+    assert not crud.update_submission_status_and_progress(db, stale)
+    stale.progress = records.SubmissionProgressStatus.DONE
+    stale.message = ""
+    stale.detail = ""
+    stale.judge_results = [judge_result(submission_id)]
+    assert not crud.update_submission_record(db, stale)
+    assert db.query(models.JudgeResult).count() == 0
+    db.expire_all()
+    assert db.get(models.Submission, submission_id).progress == "running"
+    assert db.get(models.Submission, submission_id).completed_task == 0
+
+    # 取得し直したnode-bは結果を登録できる
+    reclaimed.progress = records.SubmissionProgressStatus.DONE
+    reclaimed.result = records.SubmissionSummaryStatus.AC
+    reclaimed.message = ""
+    reclaimed.detail = ""
+    reclaimed.judge_results = [judge_result(submission_id)]
+    assert crud.update_submission_record(db, reclaimed)
+    assert db.query(models.JudgeResult).count() == 1
+    db.expire_all()
+    assert db.get(models.Submission, submission_id).progress == "done"
+
+
+# 同じジャッジサーバーが有効期限切れのリクエストを取得し直した場合も、取得し直す前のclaimからは書き込めないことを確かめるテスト
+def test_FencedWritesAfterReclaimBySameNode(db):
+    add_submission(db, progress="queued")
+    [stale] = claim(db, "node-a")
+    # ハートビートが途切れて、有効期限が切れる
+    db.query(models.Submission).update({models.Submission.lease_expires_at: datetime.now() - timedelta(seconds=1)})
+    db.commit()
+
+    [reclaimed] = claim(db, "node-a")
+    assert reclaimed.id == stale.id
+    assert reclaimed.claim_token != stale.claim_token
+
+    stale.completed_task = 1
+    stale.result = records.SubmissionSummaryStatus.WA
+    assert not crud.update_submission_status_and_progress(db, stale)
+    reclaimed.completed_task = 1
+    reclaimed.result = records.SubmissionSummaryStatus.AC
+    assert crud.update_submission_status_and_progress(db, reclaimed)
+
+
+# 候補を(ロックせずに)読んだ後に他のジャッジサーバーがclaimした行は飛ばし、次の順位の行をclaimすることを確かめるテスト
+# (公平なスケジューラーの候補と、締め切り順の候補の両方で確かめる)
+@pytest.mark.parametrize("order_by_deadline", [False, True])
+def test_SkipRowsClaimedAfterCandidateRead(engine, db, order_by_deadline):
+    # 公平なスケジューラーの候補は各ユーザーにつき最大n件なので、ユーザーを分ける
+    first_id = add_submission(db, user_id="user-a", progress="queued")
+    second_id = add_submission(db, user_id="user-b", progress="queued")
+    third_id = add_submission(db, user_id="user-c", progress="queued")
+
+    def rank(candidate_list: list[records.QueuedSubmission]) -> list[records.QueuedSubmission]:
+        # スケジューラーが候補を順位付けしている間に、node-aがfirst_idをclaimする
+        with Session(engine) as other:
+            [claimed] = crud.fetch_queued_judge_and_change_status_to_running(other, 1, node_id="node-a", lease_sec=60, leaseless_reclaim_sec=600)
+            assert claimed.id == first_id
+        return candidate_list
+
+    claimed_list = crud.fetch_queued_judge_and_change_status_to_running(
+        db, 2, node_id="node-b", lease_sec=60, leaseless_reclaim_sec=600, rank=rank, candidate_limit=10, order_by_deadline=order_by_deadline
+    )
+    assert [submission.id for submission in claimed_list] == [second_id, third_id]
+    db.expire_all()
+    assert db.get(models.Submission, first_id).claimed_by == "node-a"
+    assert db.get(models.Submission, second_id).claimed_by == "node-b"
+    assert db.get(models.Submission, third_id).claimed_by == "node-b"
+
+
+# ワーカーが1つずつ空くたびにclaimを繰り返しても、優先度クラスの重みの比率でclaimされるか確かめるテスト
+# (候補の順位付けでは、claimしなかった候補の分までスケジューラーの仮想時刻を進めない)
+def test_FairShareRatioOverManyClaims(db):
+    for i in range(100):
+        add_submission(db, user_id=f"student{i % 10}", progress="queued")
+        add_submission(db, user_id=f"grader{i % 20}", progress="queued", eval=True)
+    scheduler = FairShareScheduler(interactive_weight=8, batch_weight=1, candidate_limit=64)
+
+    claimed_list = []
+    for _ in range(90):
+        claimed_list += crud.fetch_queued_judge_and_change_status_to_running(
+            db, 1, node_id="node-a", lease_sec=60, leaseless_reclaim_sec=600,
+            rank=scheduler.rank, charge=scheduler.charge, candidate_limit=scheduler.candidate_limit,
+        )
+    assert len(claimed_list) == 90
+    assert len([submission for submission in claimed_list if submission.eval]) == 10
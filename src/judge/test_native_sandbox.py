@@ -0,0 +1,96 @@
+# テストプログラム実行方法 (root権限・crun・prepare-native-sandbox.shで用意したrootfsが必要)
+# $ cd src
+# $ sudo pytest --log-cli-level=INFO test_native_sandbox.py
+import logging
+import json
+from pathlib import Path
+import pytest
+
+from .sandbox.native import CRUN_PATH
+from .sandbox.execute import VolumeMountInfo, TarEntry, GUEST_UID, GUEST_GID
+from .sandbox_backend import create_sandbox_backend
+from .container_pool import BUILD_IMAGE, JUDGE_CONTAINER_ARGUMENTS, CGROUP_PARENT
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger(__name__)
+
+pytestmark = pytest.mark.skipif(
+    not Path(CRUN_PATH).exists(), reason="crunがインストールされていない"
+)
+
+
+@pytest.fixture
+def sandbox():
+    backend = create_sandbox_backend("native")
+    volume, err = backend.create_volume()
+    assert err.message == ""
+    container = backend.create_container(
+        imageName=BUILD_IMAGE,
+        arguments=JUDGE_CONTAINER_ARGUMENTS,
+        cgroupParent=CGROUP_PARENT,
+        memoryLimitMB=256,
+        pidsLimit=64,
+        volumeMountInfoList=[VolumeMountInfo(path="/home/guest", volume=volume)],
+    )
+    assert container.start().message == ""
+    yield container
+    container.remove()
+    volume.remove()
+
+
+# アップロードしたファイルを標準入力付きのコマンドで読めるか確かめるテスト
+def test_UploadAndExec(sandbox, tmp_path):
+    (tmp_path / "hello.txt").write_text("hello\n")
+    err = sandbox.uploadArchive(
+        entries=[TarEntry(srcInHost=tmp_path / "hello.txt", arcname="hello.txt")],
+        dstInContainer=Path("/home/guest"),
+    )
+    assert err.message == ""
+
+    result, err = sandbox.exec_run(
+        command=["sh", "-c", "cat hello.txt; cat; exit 3"],
+        user="root",
+        stdin=b"world\n",
+    )
+    test_logger.info(result)
+    assert err.message == ""
+    assert result.exitCode == 3
+    assert result.stdout == "hello\nworld\n"
+
+
+# タイムアウトしたコマンドのプロセスだけがkillされ、コンテナはそのまま使えるか確かめるテスト
+def test_Timeout(sandbox):
+    result, err = sandbox.exec_run(command=["sleep", "10"], user="root", timeoutSec=1.0)
+    test_logger.info(result)
+    assert err.message != ""
+    assert result.timedOut
+    assert sandbox.get_status() == "running"
+
+    result, err = sandbox.exec_run(command=["echo", "alive"], user="root", timeoutSec=5.0)
+    assert err.message == ""
+    assert result.stdout == "alive\n"
+
+
+# watchdogがタスクごとのcgroupを作り、そのタスクの最大メモリ使用量とメモリ制限超過を計測できるか確かめるテスト
+def test_WatchdogTaskCgroup(sandbox):
+    # tailは改行の無い入力を全てメモリに保持するので、64MBほど使う
+    task = {"command": "head -c 64m /dev/zero | tail > /dev/null", "stdin": "", "timeoutMS": 5000, "uid": int(GUEST_UID), "gid": int(GUEST_GID)}
+    tasks = [dict(task, memoryLimitMB=128), dict(task, memoryLimitMB=32)]
+    result, err = sandbox.exec_run(command=["/home/watchdog"], user="root", stdin=json.dumps(tasks).encode(), timeoutSec=20.0)
+    test_logger.info(result)
+    assert err.message == ""
+    within_limit, exceeded = [json.loads(line) for line in result.stdout.splitlines()]
+    assert not within_limit["MLE"]
+    assert within_limit["memoryKB"] >= 64 * 1024
+    assert exceeded["MLE"]
+    assert exceeded["memoryKB"] <= 32 * 1024
+
+
+# DockerBackendと同じく、コンテナ内のプロセスにseccompのフィルターが適用されているか確かめるテスト
+def test_Seccomp(sandbox):
+    result, err = sandbox.exec_run(command=["grep", "^Seccomp:", "/proc/self/status"], user="root", timeoutSec=5.0)
+    test_logger.info(result)
+    assert err.message == ""
+    # 2: SECCOMP_MODE_FILTER
+    assert result.stdout.split() == ["Seccomp:", "2"]
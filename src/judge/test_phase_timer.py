@@ -0,0 +1,40 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_phase_timer.py
+from threading import Thread
+import time
+
+from .phase_timer import PhaseTimer
+from .metrics import judge_metrics
+
+
+# 段階ごとの時間が計測順に記録され、同じ段階は合計されるか確かめるテスト
+def test_MeasurePhases():
+    timer = PhaseTimer()
+    with timer.measure("prepare"):
+        time.sleep(0.05)
+    # バックグラウンドのスレッドからも記録できる
+    thread = Thread(target=lambda: timer.record("runner_start", 30))
+    thread.start()
+    thread.join()
+    timer.record("prepare", 10)
+
+    elapsed = timer.elapsed_ms()
+    assert list(elapsed.keys()) == ["prepare", "runner_start"]
+    assert elapsed["prepare"] >= 60
+    assert elapsed["runner_start"] == 30
+    assert "prepare=" in timer.summary() and "total=" in timer.summary()
+
+
+# publishで/metricsに合計時間と回数が加算されるか確かめるテスト
+def test_Publish():
+    before = judge_metrics.snapshot()
+    timer = PhaseTimer()
+    timer.record("build", 100)
+    timer.publish()
+    timer.publish()
+
+    after = judge_metrics.snapshot()
+    assert after["phase_build_ms_total"] == before.get("phase_build_ms_total", 0) + 200
+    assert after["phase_build_count"] == before.get("phase_build_count", 0) + 2
+    assert after["phase_total_count"] == before.get("phase_total_count", 0) + 2
@@ -0,0 +1,139 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_pipeline.py
+import asyncio
+import threading
+import time
+import pytest
+
+from . import pipeline
+from .pipeline import StagedPipeline, STAGE_NAMES
+from .admission import AdmissionController
+from .sandbox.cpuset import CpuAllocator
+from .sandbox.my_error import Error
+from .metrics import judge_metrics
+
+
+class FakeSubmission:
+    def __init__(self, id: int, build_sec: float, fail_on: str | None = None):
+        self.id = id
+        self.build_sec = build_sec
+        self.fail_on = fail_on
+
+
+class FakeJudgeInfo:
+    """
+    DockerやDBを使わずに、各段階の実行順と割り当てられたCPUを記録する
+    """
+    lock = threading.Lock()
+    events: list[tuple[str, int, float]] = []  # (段階, 提出ID, 時刻)
+    running_cpusets: dict[int, list[int] | None] = {}  # run段階を実行中の提出ID -> 割り当てられたCPU
+
+    def __init__(self, submission: FakeSubmission, **kwargs):
+        self.submission = submission
+        self.build_cpuset = kwargs.get("build_cpuset")
+        self.cpuset = None
+
+    def stages(self):
+        return [self.prepare, self.build, self.run, self.persist]
+
+    def _record(self, stage: str) -> Error | None:
+        with FakeJudgeInfo.lock:
+            FakeJudgeInfo.events.append((stage, self.submission.id, time.monotonic()))
+        if self.submission.fail_on == stage:
+            return Error(f"failed on {stage}")
+        return None
+
+    def prepare(self):
+        return self._record("prepare")
+
+    def build(self):
+        time.sleep(self.submission.build_sec)
+        return self._record("build")
+
+    def assign_cpuset(self, cpuset):
+        self.cpuset = cpuset
+
+    def run(self):
+        with FakeJudgeInfo.lock:
+            # 同時に実行中のジャッジとCPUが重ならない
+            for other in FakeJudgeInfo.running_cpusets.values():
+                assert set(other).isdisjoint(self.cpuset)
+            FakeJudgeInfo.running_cpusets[self.submission.id] = self.cpuset
+        time.sleep(0.1)
+        with FakeJudgeInfo.lock:
+            FakeJudgeInfo.running_cpusets.pop(self.submission.id)
+        return self._record("run")
+
+    def persist(self):
+        err = self._record("persist")
+        return err if err is not None else Error.Nothing()
+
+    def finish(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_judge_info(monkeypatch):
+    FakeJudgeInfo.events = []
+    FakeJudgeInfo.running_cpusets = {}
+    monkeypatch.setattr(pipeline, "JudgeInfo", FakeJudgeInfo)
+
+
+async def run_pipeline(submissions: list[FakeSubmission], **kwargs) -> dict[int, Error | Exception]:
+    staged_pipeline = StagedPipeline(
+        admission=AdmissionController(max_workers=2),
+        cpu_allocator=CpuAllocator([0, 1]),
+        **kwargs
+    )
+    staged_pipeline.start()
+    results: dict[int, Error | Exception] = {}
+    for submission in submissions:
+        await staged_pipeline.wait_for_admission(0)
+        assert staged_pipeline.submit_judge(
+            f"submission-{submission.id}", submission,
+            on_done=lambda result, id=submission.id: results.__setitem__(id, result)
+        )
+    await asyncio.wait_for(staged_pipeline.join(), timeout=10)
+    assert staged_pipeline.admission.reserved == {}
+    assert staged_pipeline.cpu_allocator.allocated == {}
+    staged_pipeline.shutdown()
+    return results
+
+
+# コンパイルに時間のかかる提出があっても、他の提出の実行が待たされないか確かめるテスト
+def test_SlowBuildDoesNotBlockRunSlots():
+    submissions = [FakeSubmission(1, build_sec=1.0)] + [FakeSubmission(id, build_sec=0.05) for id in range(2, 6)]
+    results = asyncio.run(run_pipeline(submissions, build_workers=2))
+
+    assert all(result.message == "" for result in results.values())
+    finished_at = {id: t for stage, id, t in FakeJudgeInfo.events if stage == "persist"}
+    # 提出1がビルドしている間に、他の提出は実行まで終わっている
+    assert all(finished_at[id] < finished_at[1] for id in range(2, 6))
+    # 各提出は prepare -> build -> run -> persist の順に処理される
+    for submission in submissions:
+        stages = [stage for stage, id, _ in FakeJudgeInfo.events if id == submission.id]
+        assert stages == STAGE_NAMES
+
+
+# 途中の段階でジャッジが終了した場合は、後の段階を実行しないか確かめるテスト
+def test_StopOnStageError():
+    submissions = [FakeSubmission(1, build_sec=0.0, fail_on="build"), FakeSubmission(2, build_sec=0.0)]
+    results = asyncio.run(run_pipeline(submissions))
+
+    assert results[1].message == "failed on build"
+    assert results[2].message == ""
+    assert [stage for stage, id, _ in FakeJudgeInfo.events if id == 1] == ["prepare", "build"]
+
+
+# 段階ごとの処理数とキューの長さが統計情報に記録されるか確かめるテスト
+def test_StageMetrics():
+    before = judge_metrics.snapshot()
+    asyncio.run(run_pipeline([FakeSubmission(id, build_sec=0.0) for id in range(1, 4)], queue_size=1))
+
+    after = judge_metrics.snapshot()
+    for stage in STAGE_NAMES:
+        assert after[f"stage_{stage}_completed"] == before.get(f"stage_{stage}_completed", 0) + 3
+        assert after[f"stage_{stage}_queue_depth"] == 0
+        assert after[f"stage_{stage}_busy"] == 0
+    assert after["stage_build_busy_ms_total"] >= before.get("stage_build_busy_ms_total", 0)
@@ -0,0 +1,110 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_resource_volume.py
+import logging
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from dotenv import load_dotenv
+import os
+
+from . import resource_volume
+from .resource_volume import ResourceVolumeManager, RESOURCE_MOUNT_PATH
+from .container_pool import create_runner_container
+from .sandbox.execute import DockerVolume, VolumeMountInfo, TaskInfo, WatchDogResult
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger(__name__)
+
+load_dotenv()
+GUEST_UID = os.getenv("GUEST_UID")
+GUEST_GID = os.getenv("GUEST_GID")
+
+
+def write_file(path: Path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+# 同じ問題ではボリュームが使い回され、問題が更新されたら古いボリュームが削除されるか確かめるテスト
+def test_ReuseAndReplaceResourceVolume(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(resource_volume, "RESOURCE_DIR", Path(tmpdir))
+        write_file(Path(tmpdir) / "1/main.h", "int f(void);\n")
+        write_file(Path(tmpdir) / "1/in/1.txt", "1 2\n")
+
+        manager = ResourceVolumeManager()
+        args = dict(key=(1, 1, False), arranged_files=["1/main.h"], stdin_files=["1/in/1.txt"], uid=int(GUEST_UID), gid=int(GUEST_GID))
+
+        first, err = manager.acquire(**args)
+        assert err.message == ""
+        second, err = manager.acquire(**args)
+        assert err.message == ""
+        assert second is first
+        assert first.refcount == 2
+
+        # 問題を更新すると、新しいボリュームが作られる
+        write_file(Path(tmpdir) / "1/in/1.txt", "3 4 5\n")
+        updated, err = manager.acquire(**args)
+        assert err.message == ""
+        assert updated is not first
+        assert first.stale
+
+        # 古いボリュームは、使い終わった時点で削除される
+        manager.release(first)
+        manager.release(second)
+        assert first.volume.name not in [v.name for v in manager.client.volumes.list()]
+
+        manager.release(updated)
+        manager.close()
+        assert updated.volume.name not in [v.name for v in manager.client.volumes.list()]
+
+
+# リソースボリュームの標準入力がwatchdogに渡され、ユーザーからは読めないか確かめるテスト
+def test_StdinFromResourceVolume(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        monkeypatch.setattr(resource_volume, "RESOURCE_DIR", Path(tmpdir))
+        write_file(Path(tmpdir) / "1/main.h", "int f(void);\n")
+        write_file(Path(tmpdir) / "1/in/1.txt", "hello\n")
+
+        manager = ResourceVolumeManager()
+        volume, err = manager.acquire(
+            key=(1, 1, False), arranged_files=["1/main.h"], stdin_files=["1/in/1.txt"], uid=int(GUEST_UID), gid=int(GUEST_GID)
+        )
+        assert err.message == ""
+
+        working_volume, err = DockerVolume.create(client=manager.client)
+        assert err.message == ""
+        container = create_runner_container(
+            working_volume=working_volume,
+            memoryLimitMB=256,
+            resource_mount=VolumeMountInfo(path=RESOURCE_MOUNT_PATH, volume=volume.volume, read_only=True)
+        )
+        try:
+            assert container.start().message == ""
+            assert container.uploadArchive(entries=[], dstInContainer="/home/guest/", prebuiltMembers=[volume.links]).message == ""
+
+            task = TaskInfo(
+                command="cat; cat main.h; cat /home/resource/stdin/1/in/1.txt",
+                stdin="",
+                stdinPath=volume.stdin_path("1/in/1.txt"),
+                timeoutMS=2000,
+                memoryLimitMB=256,
+                uid=int(GUEST_UID),
+                gid=int(GUEST_GID)
+            )
+            result, err = container.exec_run(
+                command=["/home/watchdog"], user="root", timeoutSec=10.0, stdin=f"[{task.model_dump_json()}]".encode()
+            )
+            test_logger.info(result)
+            assert err.message == ""
+            watchdog_result = WatchDogResult.model_validate_json(result.stdout.splitlines()[0])
+            # 標準入力とarranged_filesは読めるが、標準入力のファイルを直接開くことはできない
+            assert watchdog_result.stdout == "hello\nint f(void);\n"
+            assert "Permission denied" in watchdog_result.stderr
+        finally:
+            container.remove()
+            working_volume.remove()
+            manager.release(volume)
+            manager.close()
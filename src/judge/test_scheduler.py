@@ -0,0 +1,82 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_scheduler.py
+from datetime import datetime
+from .db import records
+from .scheduler import FIFOScheduler, FairShareScheduler, EDFScheduler
+
+
+def make_submission(id: int, user_id: str, batch: bool = False) -> records.QueuedSubmission:
+    return records.QueuedSubmission(
+        id=id,
+        ts=datetime.now(),
+        evaluation_status_id=1 if batch else None,
+        user_id=user_id,
+        lecture_id=1,
+        assignment_id=1,
+        eval=batch,
+    )
+
+
+def claim_one_by_one(scheduler, candidates: list[records.QueuedSubmission], count: int) -> list[records.QueuedSubmission]:
+    # ワーカーが1つずつ空くたびに1件claimする状況を再現する
+    claimed = []
+    for _ in range(count):
+        selected = scheduler.select(candidates, 1)
+        assert len(selected) == 1
+        claimed += selected
+        candidates = [candidate for candidate in candidates if candidate.id != selected[0].id]
+    return claimed
+
+
+# FIFOでは古い順に選ばれるか確かめるテスト
+def test_FIFOScheduler():
+    candidates = [make_submission(3, "a"), make_submission(1, "b"), make_submission(2, "a")]
+    selected = FIFOScheduler().select(candidates, 2)
+    assert [submission.id for submission in selected] == [1, 2]
+
+
+# 一人の学生が連続提出しても、他の学生の提出が待たされないか確かめるテスト
+def test_FairShareBetweenUsers():
+    candidates = [make_submission(i, "spammer") for i in range(1, 21)]
+    candidates += [make_submission(100, "alice"), make_submission(101, "alice")]
+    selected = FairShareScheduler().select(candidates, 4)
+    assert [submission.user_id for submission in selected] == ["spammer", "alice", "spammer", "alice"]
+
+
+# 採点用のバッチが大量にあっても、学生の提出が重みの比率で優先されるか確かめるテスト
+def test_FairShareBetweenClasses():
+    scheduler = FairShareScheduler(interactive_weight=4, batch_weight=1)
+    candidates = [make_submission(i, f"student{i}", batch=True) for i in range(1, 101)]
+    candidates += [make_submission(1000 + i, f"user{i % 5}") for i in range(50)]
+    claimed = claim_one_by_one(scheduler, candidates, 20)
+    batch_count = len([submission for submission in claimed if submission.eval])
+    assert batch_count == 4
+
+
+# 学生の提出が無い間は、バッチが全てのワーカーを使えるか確かめるテスト
+def test_BatchDrainsWhenIdle():
+    scheduler = FairShareScheduler()
+    candidates = [make_submission(i, f"student{i}", batch=True) for i in range(1, 11)]
+    selected = scheduler.select(candidates, 6)
+    assert [submission.id for submission in selected] == [1, 2, 3, 4, 5, 6]
+
+
+# 締め切りが早い順に選ばれ、締め切り後の提出は最後になるか確かめるテスト
+def test_EDFScheduler():
+    closing = datetime(2026, 1, 10, 17, 0)
+    later = datetime(2026, 1, 17, 17, 0)
+    candidates = [
+        make_submission(1, "a", batch=True),
+        make_submission(2, "b"),
+        make_submission(3, "c"),
+        make_submission(4, "c"),
+        make_submission(5, "d"),
+    ]
+    candidates[1].deadline = later
+    candidates[2].deadline = closing
+    candidates[3].deadline = closing
+    candidates[4].deadline = closing
+    selected = EDFScheduler().select(candidates, 5)
+    # 締め切りが同じ提出の間では、ユーザー間で交互になる
+    assert [submission.id for submission in selected] == [3, 5, 4, 2, 1]
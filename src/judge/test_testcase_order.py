@@ -0,0 +1,65 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_testcase_order.py
+from .db import records
+from .testcase_order import RunOrderer, RunStats, order_testcases
+
+
+def make_testcase(testcase_id: int, command: str = "./main") -> records.TestCases:
+    return records.TestCases(
+        id=testcase_id, lecture_id=1, assignment_id=1, eval=False, type=records.EvaluationType.Judge,
+        score=1, title="", description=None, message_on_fail=None, command=command, args=None,
+        stdin_path=None, stdout_path=None, stderr_path=None, exit_code=0
+    )
+
+
+# 失敗しやすく、実行時間の短いテストケースが先になるか確かめるテスト
+def test_OrderByFailRateAndTime():
+    testcase_list = [make_testcase(i) for i in range(1, 5)]
+    stats = {
+        1: RunStats(runs=100, failures=0, mean_time_ms=10),  # ほぼ失敗しない
+        2: RunStats(runs=100, failures=50, mean_time_ms=1000),  # よく失敗するが遅い
+        3: RunStats(runs=100, failures=50, mean_time_ms=10),  # よく失敗して速い
+        # 4: 統計なし (失敗率0.5, 実行時間は時間制限)
+    }
+    ordered = order_testcases(testcase_list, stats, default_time_ms=2000)
+    # 2は遅いが、失敗率が高いので1より先になる
+    assert [testcase.id for testcase in ordered] == [3, 2, 1, 4]
+
+
+# 統計が無い場合は元の順番のままになるか確かめるテスト
+def test_StableWithoutStats():
+    testcase_list = [make_testcase(i) for i in (5, 3, 9)]
+    ordered = order_testcases(testcase_list, {}, default_time_ms=1000)
+    assert [testcase.id for testcase in ordered] == [5, 3, 9]
+
+
+# 同じバージョンの問題では統計を読み直さず、同じ順番になるか確かめるテスト
+def test_DeterministicPerVersion():
+    loads = []
+    stats = {1: RunStats(runs=10, failures=0, mean_time_ms=10), 2: RunStats(runs=10, failures=9, mean_time_ms=10)}
+
+    def load_stats(testcase_id_list):
+        loads.append(testcase_id_list)
+        return stats
+
+    orderer = RunOrderer(enabled=True, ttl_sec=0, load_stats=load_stats)
+    testcase_list = [make_testcase(1), make_testcase(2)]
+    assert [testcase.id for testcase in orderer.order((1, 1, False), testcase_list, 1000, 256)] == [2, 1]
+
+    # 統計が変わっても、同じバージョンでは同じ順番
+    stats[1] = RunStats(runs=10, failures=10, mean_time_ms=1)
+    assert [testcase.id for testcase in orderer.order((1, 1, False), testcase_list, 1000, 256)] == [2, 1]
+    assert len(loads) == 1
+
+    # テストケースの定義が変わったら、統計を読み直す
+    changed_list = [make_testcase(1, command="./main2"), make_testcase(2)]
+    assert [testcase.id for testcase in orderer.order((1, 1, False), changed_list, 1000, 256)] == [1, 2]
+    assert len(loads) == 2
+
+
+# 無効な場合は統計を読まずにそのままの順番になるか確かめるテスト
+def test_Disabled():
+    orderer = RunOrderer(enabled=False, load_stats=lambda ids: 1 / 0)
+    testcase_list = [make_testcase(2), make_testcase(1)]
+    assert orderer.order((1, 1, False), testcase_list, 1000, 256) is testcase_list
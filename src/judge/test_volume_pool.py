@@ -0,0 +1,70 @@
+# テストプログラム実行方法
+# $ cd src
+# $ pytest --log-cli-level=INFO test_volume_pool.py
+import logging
+import time
+import docker
+from dotenv import load_dotenv
+import os
+
+from .volume_pool import VolumePool
+from .container_pool import create_build_container
+from .sandbox.execute import DockerVolume
+
+# ロガーの設定
+logging.basicConfig(level=logging.INFO)
+test_logger = logging.getLogger(__name__)
+
+load_dotenv()
+GUEST_UID = os.getenv("GUEST_UID")
+GUEST_GID = os.getenv("GUEST_GID")
+
+
+# tmpfs上のボリュームを作業用ディレクトリとして使え、サイズ上限を超えて書き込めないか確かめるテスト
+def test_TmpfsVolume():
+    client = docker.from_env()
+    volume, err = DockerVolume.create(client=client, tmpfsSizeMB=16)
+    assert err.message == ""
+
+    container = create_build_container(working_volume=volume)
+    try:
+        assert container.start().message == ""
+        result, err = container.exec_run(
+            command=["sh", "-c", "df -P /home/guest | tail -1; ls -a /home/guest; dd if=/dev/zero of=/home/guest/big bs=1M count=32"],
+            user=f"{GUEST_UID}:{GUEST_GID}",
+            timeoutSec=10.0
+        )
+        test_logger.info(result)
+        assert err.message == ""
+        assert result.stdout.startswith("tmpfs")
+        # ゲストユーザーが書き込めるが、16MBまで
+        assert result.exitCode != 0
+        assert "No space left on device" in result.stderr
+    finally:
+        container.remove()
+        volume.remove()
+
+
+# 貸し出したボリュームが返却後に削除され、新しいものが用意されるか確かめるテスト
+def test_VolumePool():
+    client = docker.from_env()
+    pool = VolumePool(size=2)
+    pool.start()
+    deadline = time.monotonic() + 30.0
+    while len(pool._ready) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    volume, err = pool.acquire()
+    assert err.message == ""
+    pool.release(volume)
+
+    deadline = time.monotonic() + 30.0
+    while len(pool._ready) < 2 or volume.name in [v.name for v in client.volumes.list()]:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    ready = list(pool._ready)
+    pool.close()
+    names = [v.name for v in client.volumes.list()]
+    assert all(v.name not in names for v in ready)
@@ -0,0 +1,138 @@
+"""
+過去のJudgeResultから求めたテストケースごとの失敗率・平均実行時間を使って、Judgeテストケースを実行する順番を決める
+
+失敗しやすく、実行時間の短いテストケースから実行する(失敗率 / 平均実行時間 の大きい順)。
+JUDGE_STOP_AFTER_FAILURESで打ち切る場合に、最初の失敗(=結果の確定)までの時間が短くなる。
+* 順番は、問題のバージョン(テストケースの定義と時間・メモリ制限)ごとに、最初に統計を読んだ時点で決めたものを使い続ける。
+  同じバージョンの提出は同じ順番で実行されるので、結果が再現できる。
+  JUDGE_TESTCASE_ORDER_TTL_SEC > 0 の場合は、その間隔で統計を読み直して順番を決め直す
+* 統計の無い(少ない)テストケースは、失敗率0.5・実行時間は問題の時間制限として扱い、実行回数に応じて実績に近づける
+* 優先度が同じ場合は、元の順番(DBから取得した順番)のまま
+"""
+from dotenv import load_dotenv
+from threading import Lock
+from typing import Callable
+import os
+import time
+
+from .db import records, crud
+from .db.database import SessionLocal
+from .metrics import judge_metrics
+from .log.config import judge_logger
+
+load_dotenv()
+
+# 過去の結果を使って、Judgeテストケースを実行する順番を決めるか
+JUDGE_TESTCASE_ORDERING = os.getenv("JUDGE_TESTCASE_ORDERING", "false").lower() == "true"
+# 統計を読み直して順番を決め直す間隔[秒]。0の場合は、問題のバージョンが変わるまで同じ順番を使う
+JUDGE_TESTCASE_ORDER_TTL_SEC = float(os.getenv("JUDGE_TESTCASE_ORDER_TTL_SEC", "0"))
+
+
+class RunStats:
+    runs: int  # 実行回数
+    failures: int  # AC以外になった回数
+    mean_time_ms: float  # 平均実行時間[ms]
+
+    def __init__(self, runs: int = 0, failures: int = 0, mean_time_ms: float = 0):
+        self.runs = runs
+        self.failures = failures
+        self.mean_time_ms = mean_time_ms
+
+    def fail_rate(self) -> float:
+        # 実行回数が少ない場合は0.5に寄せる(ラプラス平滑化)
+        return (self.failures + 1) / (self.runs + 2)
+
+    def expected_time_ms(self, default_time_ms: float) -> float:
+        # 実行回数が少ない場合はdefault_time_msに寄せる
+        return (self.mean_time_ms * self.runs + default_time_ms) / (self.runs + 1)
+
+
+def order_testcases(
+    testcase_list: list[records.TestCases],
+    stats: dict[int, RunStats],
+    default_time_ms: float
+) -> list[records.TestCases]:
+    """
+    失敗率 / 実行時間 の大きい順に並べ替える(同じ場合は元の順番)
+    """
+    def priority(testcase: records.TestCases) -> float:
+        testcase_stats = stats.get(testcase.id, RunStats())
+        return testcase_stats.fail_rate() / max(1.0, testcase_stats.expected_time_ms(default_time_ms))
+    # sortedは安定なので、優先度が同じテストケースは元の順番になる
+    return sorted(testcase_list, key=lambda testcase: -priority(testcase))
+
+
+def version_of(testcase_list: list[records.TestCases], time_ms: int, memory_mb: int) -> tuple:
+    """
+    問題のバージョン。テストケースの定義か時間・メモリ制限が変わったら別のバージョンになる
+    """
+    return (time_ms, memory_mb) + tuple(
+        (testcase.id, testcase.command, testcase.args, testcase.stdin_path, testcase.stdout_path,
+         testcase.stderr_path, testcase.exit_code)
+        for testcase in testcase_list
+    )
+
+
+def load_testcase_stats(testcase_id_list: list[int]) -> dict[int, RunStats]:
+    with SessionLocal() as db:
+        rows = crud.fetch_testcase_stats(db=db, testcase_id_list=testcase_id_list)
+    return {
+        testcase_id: RunStats(runs=runs, failures=failures, mean_time_ms=mean_time_ms)
+        for testcase_id, (runs, failures, mean_time_ms) in rows.items()
+    }
+
+
+class RunOrderer:
+    enabled: bool
+    ttl_sec: float  # 順番を決め直す間隔[秒] (0の場合は決め直さない)
+    _orders: dict  # キー -> (バージョン, 決めた時刻, testcase_idの順番)
+    _lock: Lock
+    _load_stats: Callable[[list[int]], dict[int, RunStats]]
+
+    def __init__(
+        self,
+        enabled: bool = JUDGE_TESTCASE_ORDERING,
+        ttl_sec: float = JUDGE_TESTCASE_ORDER_TTL_SEC,
+        load_stats: Callable[[list[int]], dict[int, RunStats]] = load_testcase_stats
+    ):
+        self.enabled = enabled
+        self.ttl_sec = ttl_sec
+        self._orders = {}
+        self._lock = Lock()
+        self._load_stats = load_stats
+
+    def order(self, key, testcase_list: list[records.TestCases], time_ms: int, memory_mb: int) -> list[records.TestCases]:
+        """
+        testcase_listを実行する順番に並べ替えたリストを返す(無効な場合や、統計が読めない場合はそのまま)
+        """
+        if not self.enabled or len(testcase_list) <= 1:
+            return testcase_list
+        version = version_of(testcase_list, time_ms, memory_mb)
+        with self._lock:
+            cached = self._orders.get(key)
+            if cached is not None and cached[0] == version and (
+                self.ttl_sec <= 0 or time.monotonic() - cached[1] < self.ttl_sec
+            ):
+                judge_metrics.increment("testcase_order_hits")
+                return self._apply(cached[2], testcase_list)
+
+            # 同じ問題の提出が続けて来ても、統計は1回だけ読む
+            judge_metrics.increment("testcase_order_misses")
+            try:
+                stats = self._load_stats([testcase.id for testcase in testcase_list])
+            except Exception as e:
+                judge_logger.error(f"failed to load testcase stats of {key}: {e}")
+                return testcase_list
+            ordered_id_list = [testcase.id for testcase in order_testcases(testcase_list, stats, default_time_ms=time_ms)]
+            self._orders[key] = (version, time.monotonic(), ordered_id_list)
+            judge_logger.info(f"testcase order of {key}: {ordered_id_list}")
+            return self._apply(ordered_id_list, testcase_list)
+
+    @staticmethod
+    def _apply(ordered_id_list: list[int], testcase_list: list[records.TestCases]) -> list[records.TestCases]:
+        testcase_by_id = {testcase.id: testcase for testcase in testcase_list}
+        return [testcase_by_id[testcase_id] for testcase_id in ordered_id_list]
+
+
+# (lecture_id, assignment_id, eval) -> Judgeテストケースの順番
+judge_testcase_orderer = RunOrderer()
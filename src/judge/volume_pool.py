@@ -0,0 +1,129 @@
+"""
+ジャッジごとの作業用ボリューム(/home/guest)
+
+* JUDGE_WORKDIR_TMPFS_MB > 0 の場合は、ディスクではなくサイズ上限付きのtmpfs上に作業用ボリュームを作る。
+  ビルドの生成物はすぐに実行されて捨てられるので、ディスクに書き込む必要はない。
+  tmpfsのページは書き込んだコンテナのメモリとしてカウントされるので、メモリーリミットの範囲に収まる
+* VolumePoolは、作成済みの作業用ボリュームをJUDGE_VOLUME_POOL_SIZE個用意しておき、ジャッジに貸し出す。
+  返却されたボリュームは使い回さず、プール専用のスレッドで削除して作り直すので、
+  ボリュームの作成・削除のDockerデーモンとのやり取りがジャッジの処理時間に含まれなくなる
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import threading
+import os
+
+from .sandbox.backend import SandboxVolume
+from .sandbox.my_error import Error
+from .sandbox_backend import get_sandbox_backend
+from .log.config import judge_logger
+
+load_dotenv()
+
+# 作業用ボリュームのtmpfsのサイズ上限[MB]。0の場合はディスク上にボリュームを作る
+JUDGE_WORKDIR_TMPFS_MB = int(os.getenv("JUDGE_WORKDIR_TMPFS_MB", "0"))
+# プールに用意しておく作業用ボリュームの数。0の場合はプールを使わず、ジャッジごとにボリュームを作成する
+JUDGE_VOLUME_POOL_SIZE = int(os.getenv("JUDGE_VOLUME_POOL_SIZE", "0"))
+
+
+def create_working_volume() -> tuple[SandboxVolume, Error]:
+    """
+    作業用ボリュームを作成する(JUDGE_WORKDIR_TMPFS_MB > 0 の場合はtmpfs上に作る)
+    """
+    return get_sandbox_backend().create_volume(tmpfsSizeMB=JUDGE_WORKDIR_TMPFS_MB)
+
+
+class VolumePool:
+    size: int  # 用意しておく作業用ボリュームの数
+    _ready: deque[SandboxVolume]  # 作成済みで、まだ使われていないボリューム
+    _pending: int  # 作成中のボリュームの数
+    _closed: bool
+    _lock: threading.Lock
+    _executor: ThreadPoolExecutor  # ボリュームの作成・削除を行うスレッド
+
+    def __init__(self, size: int = JUDGE_VOLUME_POOL_SIZE):
+        self.size = size
+        self._ready = deque()
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="volume-pool")
+
+    def start(self) -> None:
+        """
+        バックグラウンドでボリュームを用意し始める
+        """
+        self._replenish()
+
+    def _replenish(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            shortage = max(0, self.size - len(self._ready) - self._pending)
+            self._pending += shortage
+        for _ in range(shortage):
+            self._executor.submit(self._create_into_pool)
+
+    def _create_into_pool(self) -> None:
+        volume, err = create_working_volume()
+        with self._lock:
+            self._pending -= 1
+            if err.silence() and not self._closed:
+                self._ready.append(volume)
+                return
+        if not err.silence():
+            # Dockerデーモンの異常などで作成に失敗した場合は、次の貸し出しまで作り直さない
+            judge_logger.error(f"volume pool: {err.message}")
+        else:
+            volume.remove()
+
+    def acquire(self) -> tuple[SandboxVolume, Error]:
+        """
+        作業用ボリュームを貸し出す。用意されたものが無ければ、その場で作成する
+        """
+        with self._lock:
+            volume = self._ready.popleft() if len(self._ready) > 0 else None
+        self._replenish()
+        if volume is None:
+            judge_logger.info("volume pool is empty. creating a new volume...")
+            return create_working_volume()
+        return volume, Error.Nothing()
+
+    def release(self, volume: SandboxVolume) -> None:
+        """
+        使い終わった作業用ボリュームを返却する。削除はバックグラウンドで行う
+        (ボリュームをマウントしているコンテナは、返却前に削除しておくこと)
+        """
+        try:
+            self._executor.submit(self._remove, volume)
+        except RuntimeError:
+            # close()済みの場合
+            self._remove(volume)
+
+    def _remove(self, volume: SandboxVolume) -> None:
+        err = volume.remove()
+        if not err.silence():
+            judge_logger.error(f"volume pool: failed to remove volume: {err.message}")
+
+    def close(self) -> None:
+        """
+        新しいボリュームの作成をやめ、作成中・削除中のものを待ってから、用意されたボリュームを全て削除する
+        """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            ready = list(self._ready)
+            self._ready.clear()
+        for volume in ready:
+            self._remove(volume)
+
+
+def create_volume_pool() -> VolumePool | None:
+    """
+    JUDGE_VOLUME_POOL_SIZE=0の場合はNone(プールを使わない)
+    """
+    if JUDGE_VOLUME_POOL_SIZE <= 0:
+        return None
+    return VolumePool()